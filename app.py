@@ -1,27 +1,74 @@
 import os
 import os
-from flask import Flask, render_template, redirect, url_for, flash, send_from_directory
+from flask import Flask, Response, abort, current_app, render_template, redirect, url_for, flash, request, jsonify
+from flask.cli import AppGroup
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField, ValidationError
 from wtforms.validators import DataRequired, Email, EqualTo, Length
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from sqlalchemy import bindparam, delete, event, exists, select, text, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+from concurrent.futures import ThreadPoolExecutor
+from markupsafe import Markup
+from jinja2 import FileSystemBytecodeCache
+import collections
 import datetime
+import functools
+import hmac
+import json
+import math
+import secrets
+import threading
+import time
+import uuid
+import click
+
+from streaming import send_video_path, video_mimetype
+import assets
+import caching
+import counters
+import database
+import importer
+import jobs
+import metrics
+import mp4
+import passwords
+import search
+import storage
+import throttle
+import uploads
+from pagination import keyset_page
 
 UPLOAD_FOLDER = 'uploads/videos'
 ALLOWED_EXTENSIONS = {'mp4', 'mov', 'avi', 'mkv'}
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24) # Generate a random secret key
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True) # Create upload folder if it doesn't exist
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
+db = SQLAlchemy()
+instrumentation = metrics.Instrumentation()
+login_manager = LoginManager()
 login_manager.login_view = 'login' # view to redirect to when login is required
+routes = [] # (rule, options, view) for every page, added to each app by create_app
+cli = AppGroup('learnai') # Commands added to each app's `flask` CLI by create_app
+
+def route(rule, **options):
+    """Like ``app.route``, for the app(s) create_app builds later."""
+    def decorator(view):
+        routes.append((rule, options, view))
+        return view
+    return decorator
+
+def schema_command(name):
+    """A CLI command that brings the schema up to date before it runs."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            ensure_schema()
+            return f(*args, **kwargs)
+        return cli.command(name)(wrapper)
+    return decorator
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -29,6 +76,8 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
     is_editor = db.Column(db.Boolean, default=False)
+    storage_used = db.Column(db.BigInteger, nullable=False, default=0, server_default='0') # Sum of the sizes of their videos
+    storage_quota = db.Column(db.BigInteger, nullable=True) # Bytes; None for STORAGE_QUOTA
 
     def __repr__(self):
         return f"User('{self.username}', '{self.email}')"
@@ -37,17 +86,551 @@ class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=True)
-    filename = db.Column(db.String(100), nullable=False)
+    filename = db.Column(db.String(100), nullable=False, index=True) # Name of the stored blob, <digest>.<ext>
+    original_filename = db.Column(db.String(100), nullable=True)
+    digest = db.Column(db.String(64), nullable=True, index=True)
+    size = db.Column(db.BigInteger, nullable=True)
+    duration = db.Column(db.Float, nullable=True) # Seconds; None when the container was not inspected
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    codec = db.Column(db.String(16), nullable=True) # Sample entry type of the video track, e.g. avc1
+    bitrate = db.Column(db.Integer, nullable=True) # Bits per second over the whole file
     uploaded_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    status = db.Column(db.String(16), nullable=False, default='ready', server_default='ready') # processing, ready or failed
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id'), nullable=True) # Post-upload processing job
+    version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0') # Catalog version of the last change
     uploader = db.relationship('User', backref=db.backref('videos', lazy=True))
+    job = db.relationship('Job')
+    stats = db.relationship('VideoStats', uselist=False, cascade='all, delete-orphan')
+
+    # Serve the newest-first keyset scan in video_list and the delta sync scan without a sort step
+    __table_args__ = (db.Index('ix_video_uploaded_at_id', 'uploaded_at', 'id'),
+                      db.Index('ix_video_version_id', 'version', 'id'))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'description': self.description,
+            'uploader': self.uploader.username,
+            'uploaded_at': self.uploaded_at.isoformat(),
+            'duration': self.duration,
+            'width': self.width,
+            'height': self.height,
+            'codec': self.codec,
+            'size': self.size,
+            'url': url_for('serve_video_file', filename=self.filename, v=self.id),
+        }
 
     def __repr__(self):
         return f"Video('{self.title}', '{self.filename}')"
 
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    title = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text, nullable=True)
+    filename = db.Column(db.String(100), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow) # Last chunk received; idle sessions expire
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    chunks = db.relationship('UploadChunk', backref='upload', lazy=True, cascade='all, delete-orphan')
+
+    def received_indexes(self):
+        return sorted(chunk.index for chunk in self.chunks)
+
+    def to_dict(self):
+        received = self.received_indexes()
+        return {
+            'upload_id': self.id,
+            'filename': self.filename,
+            'size': self.total_size,
+            'chunk_size': self.chunk_size,
+            'chunk_count': uploads.chunk_count(self.total_size, self.chunk_size),
+            'received': received,
+            'offset': uploads.contiguous_offset(received, self.total_size, self.chunk_size),
+        }
+
+    def __repr__(self):
+        return f"UploadSession('{self.id}', '{self.filename}')"
+
+class UploadChunk(db.Model):
+    # One row per received chunk; inserts never conflict between concurrent PUTs
+    upload_id = db.Column(db.String(32), db.ForeignKey('upload_session.id'), primary_key=True)
+    index = db.Column(db.Integer, primary_key=True)
+    block_digests = db.Column(db.LargeBinary, nullable=False) # See storage.BlockHasher
+
+class VideoStats(db.Model):
+    # Written only by counters.ViewCounter, in batches, never once per request
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    bytes_served = db.Column(db.BigInteger, nullable=False, default=0)
+
+    # Lets popular_videos read the top rows straight off the index
+    __table_args__ = (db.Index('ix_video_stats_views', 'views', 'video_id'),)
+
+class Job(db.Model):
+    # A background task run by `flask run-jobs`; see jobs.py
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False) # JSON keyword arguments for the handler
+    status = db.Column(db.String(16), nullable=False, default=jobs.QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow) # Not before; pushed back on retry
+    locked_by = db.Column(db.String(100), nullable=True) # host:pid of the dispatcher running it
+    locked_at = db.Column(db.DateTime, nullable=True) # Lease heartbeat
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    # Serves the dispatcher's "oldest due queued job" lookup
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'run_at': self.run_at.isoformat(),
+            # Only the exception line; the full traceback stays in the table
+            'error': self.last_error.strip().splitlines()[-1] if self.last_error else None,
+        }
+
+    def __repr__(self):
+        return f"Job({self.id}, '{self.kind}', '{self.status}')"
+
+class CatalogState(db.Model):
+    # A single row; see next_catalog_version
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+
+class VideoTombstone(db.Model):
+    # A deleted video, listed in delta sync's ``removed`` from the version that deleted it
+    video_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+
+    __table_args__ = (db.Index('ix_video_tombstone_version_video_id', 'version', 'video_id'),)
+
+class Blob(db.Model):
+    # Every blob put in the store, recorded before its file is written; gc-blobs
+    # deletes the ones no video names any more
+    name = db.Column(db.String(100), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=True)
+    touched_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow) # Last recorded upload
+
+class ImportCheckpoint(db.Model):
+    # How far `flask import-videos` got through a source; committed with each batch
+    source = db.Column(db.String(1024), primary_key=True) # Absolute path of the manifest or directory
+    position = db.Column(db.Integer, nullable=False) # Entries fully processed
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        search.create_index(connection)
+
+@event.listens_for(db.metadata, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        search.drop_index(connection)
+
+@event.listens_for(db.metadata, 'after_drop')
+def reset_schema_version(target, connection, **kw):
+    # drop_all() leaves nothing for later migrations to alter; start again from the first
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('PRAGMA user_version = 0')
+
+def get_page_cache():
+    if 'page_cache' not in current_app.extensions:
+        # One primary key lookup per page; it sees commits from every process,
+        # including `flask run-jobs` and `flask import-videos`
+        current_app.extensions['page_cache'] = caching.PageCache(
+            current_app.config['PAGE_CACHE_SIZE'], current_app.config['PAGE_CACHE_TTL'], current_app.config['PAGE_CACHE_DIR'],
+            version=catalog_version)
+    return current_app.extensions['page_cache']
+
+def cached_fragment(key, render):
+    if not current_app.config['PAGE_CACHE_ENABLED']:
+        return render()
+    return get_page_cache().get_or_render(key, render)
+
+@event.listens_for(Video, 'after_insert')
+@event.listens_for(Video, 'after_update')
+@event.listens_for(Video, 'after_delete')
+def mark_catalog_changed(mapper, connection, target):
+    object_session(target).info['catalog_changed'] = True
+
+# Invalidate only once the change is committed, so no request can re-cache
+# the old rows under the new generation in between.
+@event.listens_for(Session, 'after_commit')
+def invalidate_page_cache(session):
+    if session.info.pop('catalog_changed', False):
+        get_page_cache().invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def forget_catalog_change(session):
+    session.info.pop('catalog_changed', None)
+
+CATALOG_VERSION_SQL = text("""
+    INSERT INTO catalog_state (id, version) VALUES (1, 1)
+    ON CONFLICT (id) DO UPDATE SET version = version + 1
+    RETURNING version
+""")
+
+def next_catalog_version(session):
+    """Take the next catalog version for the rows this transaction writes.
+
+    The increment takes the write lock, so versions are handed out in commit
+    order and a client that has synced up to version N never later misses a
+    row committed at or below N.
+    """
+    return session.execute(CATALOG_VERSION_SQL).scalar()
+
+def catalog_version():
+    return db.session.query(CatalogState.version).filter_by(id=1).scalar() or 0
+
+TOMBSTONE_SQL = text("""
+    INSERT INTO video_tombstone (video_id, version) VALUES (:video_id, :version)
+    ON CONFLICT (video_id) DO UPDATE SET version = excluded.version
+""")
+
+@event.listens_for(Session, 'before_flush')
+def stamp_catalog_version(session, flush_context, instances):
+    changed = [obj for obj in session.new if isinstance(obj, Video)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Video) and session.is_modified(obj)]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Video)]
+    if changed or deleted:
+        version = next_catalog_version(session)
+        for video in changed:
+            video.version = version
+        if deleted:
+            # The rows are about to go, so delta sync learns of them from here
+            session.execute(TOMBSTONE_SQL, [{'video_id': video_id, 'version': version} for video_id in deleted])
+
+def add_storage_used(connection, user_id, delta):
+    if user_id is not None and delta:
+        users = User.__table__
+        connection.execute(users.update().where(users.c.id == user_id)
+                           .values(storage_used=users.c.storage_used + delta))
+
+# Usage moves with each video row in the same flush, so it never needs a
+# full SUM over the video table to stay right
+@event.listens_for(Video, 'after_insert')
+def charge_storage(mapper, connection, target):
+    add_storage_used(connection, target.user_id, target.size or 0)
+
+@event.listens_for(Video, 'after_delete')
+def refund_storage(mapper, connection, target):
+    add_storage_used(connection, target.user_id, -(target.size or 0))
+
+@event.listens_for(Video, 'after_update')
+def recharge_storage(mapper, connection, target):
+    state = db.inspect(target)
+    size, user_id = state.attrs.size.history, state.attrs.user_id.history
+    if not size.has_changes() and not user_id.has_changes():
+        return
+    old_size = size.deleted[0] if size.deleted else target.size
+    old_user_id = user_id.deleted[0] if user_id.deleted else target.user_id
+    add_storage_used(connection, old_user_id, -(old_size or 0))
+    add_storage_used(connection, target.user_id, target.size or 0)
+
+def storage_headroom(user_id):
+    """Bytes ``user_id`` may still upload, net of unfinished resumable uploads; None if unlimited."""
+    used, quota = db.session.query(User.storage_used, User.storage_quota).filter_by(id=user_id).one()
+    if quota is None:
+        quota = current_app.config['STORAGE_QUOTA']
+    if quota is None:
+        return None
+    # Uploads idle for BLOB_GC_GRACE are abandoned, and gc-blobs will delete them
+    active = datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config['BLOB_GC_GRACE'])
+    reserved = db.session.query(db.func.coalesce(db.func.sum(UploadSession.total_size), 0)).filter(
+        UploadSession.user_id == user_id, UploadSession.updated_at >= active).scalar()
+    return quota - used - reserved
+
+BLOB_TOUCH_SQL = text("""
+    INSERT INTO blob (name, size, touched_at) VALUES (:name, :size, :now)
+    ON CONFLICT (name) DO UPDATE SET touched_at = excluded.touched_at
+""").bindparams(bindparam('now', type_=db.DateTime))
+
+def record_blob(name, size):
+    """Note blob ``name`` in the ledger; call before writing it to the store.
+
+    Committed on its own connection, so a blob whose upload dies before the
+    video row commits is still known to gc-blobs. Re-recording a stored
+    blob restarts its grace period, so gc-blobs cannot delete it out from
+    under an upload that is about to name it again.
+    """
+    with db.engine.begin() as connection:
+        connection.execute(BLOB_TOUCH_SQL, {'name': name, 'size': size, 'now': datetime.datetime.utcnow()})
+
+@event.listens_for(db.metadata, 'after_create')
+def reset_page_cache(target, connection, **kw):
+    get_page_cache().invalidate()
+
+class CachedUser(UserMixin):
+    """Read-only snapshot of the User fields requests need, kept in the identity cache."""
+
+    def __init__(self, id, username, is_editor):
+        self.id = id
+        self.username = username
+        self.is_editor = is_editor
+
+    def __repr__(self):
+        return f"CachedUser('{self.username}')"
+
+def get_identity_cache():
+    if 'identity_cache' not in current_app.extensions:
+        current_app.extensions['identity_cache'] = caching.TTLCache(current_app.config['IDENTITY_CACHE_SIZE'],
+                                                            current_app.config['IDENTITY_CACHE_TTL'])
+    return current_app.extensions['identity_cache']
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def mark_user_changed(mapper, connection, target):
+    object_session(target).info.setdefault('changed_users', set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_identity_cache(session):
+    for user_id in session.info.pop('changed_users', ()):
+        get_identity_cache().delete(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_user_changes(session):
+    session.info.pop('changed_users', None)
+
+@event.listens_for(db.metadata, 'after_create')
+def reset_identity_cache(target, connection, **kw):
+    get_identity_cache().clear()
+
+def get_view_counter():
+    if 'view_counter' not in current_app.extensions:
+        current_app.extensions['view_counter'] = counters.ViewCounter(
+            db.engine, current_app.config['VIEW_COUNTER_FLUSH_INTERVAL'], current_app.config['VIEW_COUNTER_MAX_PENDING'],
+            current_app.logger.warning)
+    return current_app.extensions['view_counter']
+
+@event.listens_for(db.metadata, 'after_drop')
+def reset_view_counter(target, connection, **kw):
+    # The counted videos are gone; their ids will be reused
+    get_view_counter().clear()
+
+def get_password_hasher():
+    if 'password_hasher' not in current_app.extensions:
+        config = current_app.config
+        current_app.extensions['password_hasher'] = passwords.PasswordHasher(
+            config['PASSWORD_HASH_METHOD'], config['PASSWORD_HASH_WORKERS'], config['PASSWORD_HASH_MAX_PENDING'])
+    return current_app.extensions['password_hasher']
+
+def get_admission():
+    if 'admission' not in current_app.extensions:
+        config = current_app.config
+        current_app.extensions['admission'] = throttle.Admission(
+            config['VIDEO_RATE_LIMITS'], config['VIDEO_MAX_STREAMS'], config['VIDEO_STREAM_QUEUE_TIMEOUT'])
+    return current_app.extensions['admission']
+
+def video_throttled(error):
+    return Response('Too many video requests; please slow down.\n', 429,
+                    {'Retry-After': str(max(1, math.ceil(error.retry_after)))}, mimetype='text/plain')
+
+def hasher_busy(error):
+    return Response('Too many sign-ins at once; please try again in a moment.\n', 503,
+                    {'Retry-After': '1'}, mimetype='text/plain')
+
+def get_blob_store():
+    if 'blob_store' not in current_app.extensions:
+        config = current_app.config
+        if config['STORAGE_BACKEND'] == 'local':
+            store = storage.LocalStore(config['UPLOAD_FOLDER'])
+        elif config['STORAGE_BACKEND'] == 'tiered':
+            store = storage.CachedStore(storage.DirectoryTier(config['STORAGE_SLOW_FOLDER']),
+                                        config['UPLOAD_FOLDER'], config['STORAGE_CACHE_SIZE'])
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND {config['STORAGE_BACKEND']!r}")
+        current_app.extensions['blob_store'] = store
+    return current_app.extensions['blob_store']
+
+def get_assets():
+    if 'assets' not in current_app.extensions:
+        # Built once per process; deploys can run `flask build-assets` first
+        manifest = assets.AssetManifest(os.path.join(current_app.root_path, 'static'),
+                                        current_app.config['STATIC_BUILD_DIR'])
+        current_app.extensions['assets'] = manifest.build()
+    return current_app.extensions['assets']
+
+def fingerprint_static_url(endpoint, values):
+    # url_for('static', filename='css/style.css') -> /static/css/style.<hash>.css
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = get_assets().url_name(values['filename']) or values['filename']
+
+def serve_static(filename):
+    return get_assets().send(filename)
+
+def compress_page(response):
+    if current_app.config['GZIP_PAGES']:
+        assets.compress_response(response, current_app.config['GZIP_LEVEL'], current_app.config['GZIP_MIN_SIZE'])
+    return response
+
+def cache_metrics():
+    stats = get_page_cache().stats()
+    store_stats = get_blob_store().stats()
+    families = [
+        ('learnai_page_cache_hits_total', 'counter', 'Fragment cache hits in process memory.', stats['hits']),
+        ('learnai_page_cache_disk_hits_total', 'counter', 'Fragment cache hits in the shared disk tier.', stats['disk_hits']),
+        ('learnai_page_cache_misses_total', 'counter', 'Fragments rendered because they were not cached.', stats['misses']),
+        ('learnai_page_cache_entries', 'gauge', 'Fragments held in process memory.', stats['entries']),
+        ('learnai_identity_cache_entries', 'gauge', 'User snapshots held by load_user.', len(get_identity_cache())),
+        ('learnai_view_counter_pending', 'gauge', 'Videos with view counts not yet written.', len(get_view_counter())),
+        ('learnai_video_streams_active', 'gauge', 'Video responses currently streaming.', get_admission().active),
+        ('learnai_video_rejected_requests_total', 'counter', 'Video requests refused by the per-user request rate.',
+         get_admission().rejected['requests']),
+        ('learnai_video_rejected_bytes_total', 'counter', 'Video requests refused while the user was over their byte rate.',
+         get_admission().rejected['bytes']),
+        ('learnai_video_rejected_streams_total', 'counter', 'Video requests refused at the concurrent stream cap.',
+         get_admission().rejected['streams']),
+        ('learnai_password_hash_rejected_total', 'counter', 'Logins and registrations turned away with 503.',
+         get_password_hasher().rejected),
+    ]
+    if store_stats: # Only a CachedStore has any
+        families += [
+            ('learnai_blob_cache_hits_total', 'counter', 'Blob reads served from the cache folder.', store_stats['hits']),
+            ('learnai_blob_cache_misses_total', 'counter', 'Blobs fetched from the slow tier on a read.', store_stats['misses']),
+            ('learnai_blob_cache_fetched_bytes_total', 'counter', 'Bytes copied in from the slow tier.', store_stats['fetched_bytes']),
+            ('learnai_blob_cache_evictions_total', 'counter', 'Blobs evicted from the cache folder.', store_stats['evictions']),
+            ('learnai_blob_cache_evicted_bytes_total', 'counter', 'Bytes evicted from the cache folder.', store_stats['evicted_bytes']),
+        ]
+    return families
+
+instrumentation.registry.add_collector(cache_metrics) # Reads whichever app is serving /metrics
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    # Every authenticated request, including each Range request from a video
+    # player, lands here; a short-lived snapshot keeps them off the database.
+    user_id = int(user_id)
+    cache = get_identity_cache()
+    identity = cache.get(user_id)
+    if identity is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        identity = CachedUser(user.id, user.username, bool(user.is_editor))
+        if current_app.config['IDENTITY_CACHE_TTL'] > 0:
+            cache.set(user_id, identity)
+    return identity
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def remux_for_faststart(path):
+    """Inspect a stored video and write a faststart copy of it when needed.
+
+    Returns ``(media_fields, remuxed_path, hasher)``: the ``Video`` columns
+    read from the container, then the rewritten temp file and its hasher,
+    or None twice when the file is fine as it is.
+    """
+    try:
+        info = mp4.probe(path)
+    except mp4.InvalidContainer:
+        return {}, None, None # AVI, MKV or a damaged file; served as uploaded
+    fields = {'duration': info.duration, 'width': info.width, 'height': info.height,
+              'codec': info.codec, 'bitrate': info.bitrate}
+    if not info.needs_faststart:
+        return fields, None, None
+    remuxed = uploads.partial_path(partial_upload_folder(), uuid.uuid4().hex)
+    hasher = storage.BlockHasher()
+    rewritten = False
+    try:
+        rewritten = mp4.faststart(path, remuxed, hasher)
+    except mp4.InvalidContainer:
+        pass
+    finally:
+        if not rewritten and os.path.exists(remuxed):
+            os.remove(remuxed)
+    return (fields, remuxed, hasher) if rewritten else (fields, None, None)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}'
+
+def get_job_queue():
+    if 'job_queue' not in current_app.extensions:
+        current_app.extensions['job_queue'] = jobs.JobQueue(Job.__table__, current_app.config['JOB_RETRY_DELAY'], current_app.config['JOB_LEASE'])
+    return current_app.extensions['job_queue']
+
+def enqueue_job(kind, **payload):
+    """Add a job to the session; it is queued when the caller commits."""
+    job = Job(kind=kind, payload=json.dumps(payload), max_attempts=current_app.config['JOB_MAX_ATTEMPTS'])
+    db.session.add(job)
+    return job
+
+_job_app = None # The app whose dispatcher forked this worker process
+
+def execute_job(kind, payload):
+    # Runs in a pool process, or inline with --workers 0
+    with (_job_app or current_app).app_context():
+        try:
+            jobs.HANDLERS[kind].run(**json.loads(payload))
+        finally:
+            db.session.remove()
+
+def give_up_job(kind, payload, error):
+    handler = jobs.HANDLERS.get(kind)
+    if handler is not None and handler.on_give_up is not None:
+        with current_app.app_context():
+            handler.on_give_up(error=error, **json.loads(payload))
+
+def init_job_worker(app):
+    global _job_app
+    _job_app = app
+    # Forked workers must not share the parent's SQLite connections
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def get_dispatcher(processes=0, log=None, poll_interval=1.0):
+    # Pool processes are forked, so the app is handed over without pickling
+    initializer = functools.partial(init_job_worker, current_app._get_current_object())
+    return jobs.Dispatcher(get_job_queue(), db.engine, execute_job, give_up_job, processes,
+                           initializer, poll_interval, log)
+
+def mark_video_failed(video_id, error):
+    video = db.session.get(Video, video_id)
+    if video is not None and video.status == 'processing':
+        video.status = 'failed'
+        db.session.commit()
+
+@jobs.handler('process_video', on_give_up=mark_video_failed)
+def process_video(video_id):
+    """Read container metadata and remux for faststart, then publish the video."""
+    video = db.session.get(Video, video_id)
+    if video is None or video.status != 'processing':
+        return # Deleted, or finished by an earlier attempt
+    store = get_blob_store()
+    path = store.local_path(video.filename)
+    if path is None:
+        raise FileNotFoundError(f'Blob {video.filename} is missing')
+    media, remuxed, hasher = remux_for_faststart(path)
+    if remuxed is not None:
+        # The rewritten file is new content with its own address. The original
+        # blob stays where it is, as other videos may share it.
+        video.digest = hasher.hexdigest()
+        video.size = hasher.size
+        video.filename = storage.blob_name(video.digest, video.filename)
+        record_blob(video.filename, video.size)
+        store.put(remuxed, video.filename)
+    for name, value in media.items():
+        setattr(video, name, value)
+    video.status = 'ready'
+    db.session.commit()
+
+def partial_upload_folder():
+    folder = current_app.config['UPLOAD_TEMP_FOLDER'] or os.path.join(current_app.config['UPLOAD_FOLDER'], '.partial')
+    os.makedirs(folder, exist_ok=True)
+    return folder
 
 class VideoUploadForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired()])
@@ -77,17 +660,17 @@ class LoginForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Login')
 
-@app.route('/')
+@route('/')
 def hello_world():
     if current_user.is_authenticated:
         return redirect(url_for('video_list'))
     return redirect(url_for('login'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = generate_password_hash(form.password.data, method='pbkdf2:sha256')
+        hashed_password = get_password_hasher().hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data, password_hash=hashed_password)
         db.session.add(user)
         db.session.commit()
@@ -95,12 +678,20 @@ def register():
         return redirect(url_for('login'))
     return render_template('register.html', form=form)
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and check_password_hash(user.password_hash, form.password.data):
+        hasher = get_password_hasher()
+        if user and hasher.verify(user.password_hash, form.password.data):
+            if hasher.needs_rehash(user.password_hash):
+                # The password is known right now, so move it to the current parameters
+                try:
+                    user.password_hash = hasher.hash(form.password.data)
+                    db.session.commit()
+                except passwords.HasherBusy:
+                    pass # Next login, then
             login_user(user)
             flash('Login successful.', 'success')
             return redirect(url_for('hello_world'))
@@ -108,61 +699,812 @@ def login():
             flash('Login unsuccessful. Check email and password.', 'danger')
     return render_template('login.html', form=form)
 
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('You have been logged out.', 'info')
     return redirect(url_for('login'))
 
-@app.route('/upload_video', methods=['GET', 'POST'])
+@route('/upload_video', methods=['GET', 'POST'])
 @login_required
 def upload_video():
     if not current_user.is_editor:
         flash('You do not have permission to upload videos.', 'danger')
         return redirect(url_for('hello_world'))
     
+    if request.method == 'POST':
+        # Checked before the form is parsed, so an over-quota body is never
+        # written to disk. The body is a little larger than the file in it.
+        headroom = storage_headroom(current_user.id)
+        if headroom is not None and (request.content_length is None or request.content_length > headroom):
+            flash('This upload would exceed your storage quota.', 'danger')
+            return redirect(url_for('upload_video'))
+
     form = VideoUploadForm()
     if form.validate_on_submit():
         video_file = form.video_file.data
         filename = secure_filename(video_file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        video_file.save(file_path)
+        temp_path = uploads.partial_path(partial_upload_folder(), uuid.uuid4().hex)
+        try:
+            hasher = storage.copy_and_hash(video_file.stream, temp_path)
+            digest = hasher.hexdigest()
+            blob = storage.blob_name(digest, filename)
+            record_blob(blob, hasher.size)
+            get_blob_store().put(temp_path, blob)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
         video = Video(
             title=form.title.data,
             description=form.description.data,
-            filename=filename,
-            user_id=current_user.id
+            filename=blob,
+            original_filename=filename,
+            digest=digest,
+            size=hasher.size,
+            user_id=current_user.id,
+            status='processing'
         )
         db.session.add(video)
+        db.session.flush()
+        video.job = enqueue_job('process_video', video_id=video.id)
         db.session.commit()
-        flash('Video uploaded successfully!', 'success')
+        flash('Video uploaded successfully! It will be listed once processing finishes.', 'success')
         return redirect(url_for('hello_world')) # Or a video list page
 
     return render_template('upload_video.html', form=form)
 
-@app.route('/videos')
+def api_error(message, status):
+    return jsonify(error=message), status
+
+def get_upload_session(upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        return None
+    return upload
+
+# --- Resumable chunked upload API ---
+# The browser form above is kept as a fallback; upload_video.html drives this
+# API when the browser supports Blob.slice so large files never sit in memory.
+
+@route('/api/uploads', methods=['POST'])
+@login_required
+def upload_init():
+    if not current_user.is_editor:
+        return api_error('You do not have permission to upload videos.', 403)
+    data = request.get_json(silent=True) or {}
+    title = (data.get('title') or '').strip()
+    filename = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+    if not title:
+        return api_error('A title is required.', 400)
+    if not allowed_file(filename):
+        return api_error('Videos only!', 400)
+    if not isinstance(size, int) or size <= 0:
+        return api_error('The file size must be a positive integer.', 400)
+    headroom = storage_headroom(current_user.id)
+    if headroom is not None and size > headroom:
+        return api_error('This upload would exceed your storage quota.', 413)
+
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        title=title[:100],
+        description=data.get('description'),
+        filename=filename,
+        total_size=size,
+        chunk_size=uploads.aligned_chunk_size(current_app.config['UPLOAD_CHUNK_SIZE'], storage.HASH_BLOCK_SIZE),
+        user_id=current_user.id
+    )
+    uploads.create_partial(uploads.partial_path(partial_upload_folder(), upload.id), size)
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify(upload.to_dict()), 201
+
+@route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    upload = get_upload_session(upload_id)
+    if upload is None:
+        return api_error('Unknown upload.', 404)
+    return jsonify(upload.to_dict())
+
+@route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    upload = get_upload_session(upload_id)
+    if upload is None:
+        return api_error('Unknown upload.', 404)
+    if index >= uploads.chunk_count(upload.total_size, upload.chunk_size):
+        return api_error('Chunk index out of range.', 416)
+    expected = uploads.chunk_length(index, upload.total_size, upload.chunk_size)
+    if request.content_length is None:
+        return api_error('Content-Length is required.', 411)
+    if request.content_length != expected:
+        return api_error(f'Chunk {index} must be exactly {expected} bytes.', 400)
+
+    path = uploads.partial_path(partial_upload_folder(), upload.id)
+    hasher = storage.BlockHasher()
+    try:
+        uploads.write_chunk(path, index * upload.chunk_size, request.stream, expected, hasher)
+    except uploads.IncompleteChunk:
+        return api_error('Chunk body was truncated.', 400)
+    upload.updated_at = datetime.datetime.utcnow()
+    chunk = db.session.get(UploadChunk, (upload.id, index))
+    if chunk is not None:
+        chunk.block_digests = hasher.digests() # A re-sent chunk replaces what was there
+        db.session.commit()
+    else:
+        db.session.add(UploadChunk(upload_id=upload.id, index=index, block_digests=hasher.digests()))
+        try:
+            db.session.commit()
+        except IntegrityError: # A retried PUT of the same chunk got there first
+            db.session.rollback()
+    db.session.refresh(upload)
+    return jsonify(upload.to_dict())
+
+@route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def upload_complete(upload_id):
+    upload = get_upload_session(upload_id)
+    if upload is None:
+        return api_error('Unknown upload.', 404)
+    missing = set(range(uploads.chunk_count(upload.total_size, upload.chunk_size))) - set(upload.received_indexes())
+    if missing:
+        return jsonify(error='Upload is incomplete.', missing=sorted(missing)), 409
+
+    chunks = sorted(upload.chunks, key=lambda chunk: chunk.index)
+    digest = storage.combine_block_digests(b''.join(chunk.block_digests for chunk in chunks))
+    blob = storage.blob_name(digest, upload.filename)
+    record_blob(blob, upload.total_size)
+    try:
+        # The partial file lives on the same filesystem, so the rename is atomic
+        get_blob_store().put(uploads.partial_path(partial_upload_folder(), upload.id), blob)
+    except FileNotFoundError:
+        # A concurrent complete for this session moved the file first
+        db.session.rollback()
+        if get_upload_session(upload_id) is None:
+            return api_error('Unknown upload.', 404)
+        raise
+    video = Video(
+        title=upload.title,
+        description=upload.description,
+        filename=blob,
+        original_filename=upload.filename,
+        digest=digest,
+        size=upload.total_size,
+        user_id=current_user.id,
+        status='processing'
+    )
+    # Claimed under the write lock, so only one complete (or an abort racing it) removes the session
+    db.session.execute(delete(UploadChunk).where(UploadChunk.upload_id == upload.id))
+    if db.session.execute(delete(UploadSession).where(UploadSession.id == upload.id)).rowcount != 1:
+        db.session.rollback()
+        return api_error('Unknown upload.', 404)
+    db.session.add(video)
+    db.session.flush()
+    video.job = enqueue_job('process_video', video_id=video.id)
+    db.session.commit()
+    flash('Video uploaded successfully! It will be listed once processing finishes.', 'success')
+    return jsonify(video_id=video.id, status_url=url_for('video_status', video_id=video.id),
+                   redirect=url_for('hello_world')), 201
+
+@route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def upload_abort(upload_id):
+    upload = get_upload_session(upload_id)
+    if upload is None:
+        return api_error('Unknown upload.', 404)
+    path = uploads.partial_path(partial_upload_folder(), upload.id)
+    if os.path.exists(path):
+        os.remove(path)
+    db.session.delete(upload)
+    db.session.commit()
+    return '', 204
+
+@route('/api/videos/<int:video_id>/status')
+@login_required
+def video_status(video_id):
+    video = db.session.get(Video, video_id)
+    if video is None or (video.user_id != current_user.id and not current_user.is_editor):
+        return api_error('Unknown video.', 404)
+    return jsonify(video_id=video.id, status=video.status, job=video.job.to_dict() if video.job else None)
+
+# --- JSON catalog API ---
+# Every response carries a weak ETag of the catalog version, which moves on
+# any committed change to a video, so polling clients get 304s until then.
+
+def catalog_response(etag, build):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def parse_sync_cursor(cursor):
+    """``(version, video_id)`` from a delta sync cursor, or None if it is not one of ours."""
+    version, dot, video_id = (cursor or '').partition('.')
+    if not (dot and version.isdigit() and video_id.isdigit()):
+        return None
+    return int(version), int(video_id)
+
+@route('/api/videos')
+@login_required
+def api_video_list():
+    per_page = request.args.get('per_page', current_app.config['VIDEOS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['VIDEOS_MAX_PER_PAGE']))
+    after = request.args.get('after')
+
+    def build():
+        query = Video.query.filter_by(status='ready').options(db.joinedload(Video.uploader))
+        videos, next_cursor = keyset_page(query, Video.uploaded_at, Video.id, after, per_page)
+        return {'videos': [video.to_dict() for video in videos], 'next': next_cursor}
+
+    return catalog_response(f'catalog-{catalog_version()}', build)
+
+@route('/api/videos/<int:video_id>')
+@login_required
+def api_video(video_id):
+    video = db.session.get(Video, video_id)
+    if video is None or video.status != 'ready':
+        return api_error('Unknown video.', 404)
+    return catalog_response(f'video-{video.id}-{video.version}', video.to_dict)
+
+@route('/api/videos/changes')
+@login_required
+def api_video_changes():
+    """Videos added or changed after ``since``, oldest change first.
+
+    Pass the returned ``cursor`` as ``since`` on the next sync; without
+    ``since`` the whole catalog is returned, in pages of ``limit``. Videos
+    that were deleted or are no longer ready (e.g. failed or reprocessing)
+    are listed by id in ``removed``.
+    """
+    since = request.args.get('since')
+    position = parse_sync_cursor(since) if since else (-1, 0)
+    if position is None:
+        return api_error('Invalid since cursor.', 400)
+    limit = max(1, min(request.args.get('limit', current_app.config['VIDEOS_MAX_PER_PAGE'], type=int),
+                       current_app.config['VIDEOS_MAX_PER_PAGE']))
+
+    def build():
+        rows = (Video.query.options(db.joinedload(Video.uploader))
+                .filter(tuple_(Video.version, Video.id) > position)
+                .order_by(Video.version, Video.id).limit(limit + 1).all())
+        changes = [(video.version, video.id, video) for video in rows]
+        if since: # A full sync has nothing to remove
+            tombstones = (db.session.query(VideoTombstone.version, VideoTombstone.video_id)
+                          .filter(tuple_(VideoTombstone.version, VideoTombstone.video_id) > position)
+                          .order_by(VideoTombstone.version, VideoTombstone.video_id).limit(limit + 1).all())
+            changes += [(version, video_id, None) for version, video_id in tombstones]
+            changes.sort(key=lambda change: change[:2])
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        cursor = f'{changes[-1][0]}.{changes[-1][1]}' if changes else since
+        return {
+            'videos': [video.to_dict() for _, _, video in changes if video is not None and video.status == 'ready'],
+            'removed': [video_id for _, video_id, video in changes if video is None or video.status != 'ready'],
+            'cursor': cursor,
+            'has_more': has_more,
+        }
+
+    return catalog_response(f'catalog-{catalog_version()}', build)
+
+@route('/videos')
 @login_required
 def video_list():
-    videos = Video.query.all()
-    return render_template('video_list.html', videos=videos)
+    per_page = request.args.get('per_page', current_app.config['VIDEOS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['VIDEOS_MAX_PER_PAGE']))
+    after = request.args.get('after')
 
-@app.route('/video/<int:video_id>')
+    # The stats line is cached with the rest, so it lags the counters by up to PAGE_CACHE_TTL
+    def render():
+        query = (Video.query.filter_by(status='ready') # One query for the page, its uploaders and stats
+                 .options(db.joinedload(Video.uploader), db.joinedload(Video.stats)))
+        videos, next_cursor = keyset_page(query, Video.uploaded_at, Video.id, after, per_page)
+        return render_template('_video_list.html', videos=videos, next_cursor=next_cursor,
+                               per_page=per_page, is_first_page=after is None)
+
+    fragment = cached_fragment(f'video_list:{per_page}:{after or ""}', render)
+    return render_template('video_list.html', fragment=Markup(fragment))
+
+@route('/videos/popular')
+@login_required
+def popular_videos():
+    def render():
+        videos = (Video.query.join(Video.stats).filter(Video.status == 'ready')
+                  .options(db.contains_eager(Video.stats), db.joinedload(Video.uploader))
+                  .order_by(VideoStats.views.desc(), VideoStats.video_id.desc())
+                  .limit(current_app.config['POPULAR_VIDEOS_COUNT']).all())
+        return render_template('_video_list.html', videos=videos, next_cursor=None, is_first_page=True)
+
+    # Rankings move slowly; a page cache TTL of staleness is fine
+    fragment = cached_fragment('popular', render)
+    return render_template('video_list.html', heading='Most Viewed', fragment=Markup(fragment))
+
+@route('/search')
+@login_required
+def video_search():
+    query = request.args.get('q', '').strip()
+    page = max(1, min(request.args.get('page', 1, type=int), current_app.config['SEARCH_MAX_PAGE']))
+    per_page = current_app.config['SEARCH_RESULTS_PER_PAGE']
+    hits = search.search_videos(db.session.connection(), query, per_page + 1, (page - 1) * per_page)
+    has_next = len(hits) > per_page and page < current_app.config['SEARCH_MAX_PAGE']
+    hits = hits[:per_page]
+    videos = (Video.query.options(db.joinedload(Video.uploader))
+              .filter(Video.id.in_([hit[0] for hit in hits]), Video.status == 'ready'))
+    videos = {video.id: video for video in videos}
+    results = [(videos[video_id], title, snippet) for video_id, title, snippet in hits if video_id in videos]
+    return render_template('search.html', query=query, results=results, page=page, has_next=has_next)
+
+@route('/video/<int:video_id>')
 @login_required
 def view_video(video_id):
-    video = db.session.get(Video, video_id)
-    if not video:
+    def render():
+        video = db.session.get(Video, video_id)
+        if not video:
+            return None
+        return {'title': video.title, 'html': render_template('_video_detail.html', video=video)}
+
+    page = cached_fragment(f'video:{video_id}', render)
+    if not page:
         return render_template('404.html'), 404 # Assuming you have a 404.html or will create one
-    return render_template('view_video.html', video=video)
+    counter = get_view_counter()
+    counter.record(video_id, views=1)
+    # Outside the cached fragment so the counts move; unflushed counts in this worker are added on top
+    views, bytes_served = db.session.query(VideoStats.views, VideoStats.bytes_served).filter_by(
+        video_id=video_id).first() or (0, 0)
+    pending_views, pending_bytes = counter.pending(video_id)
+    return render_template('view_video.html', title=page['title'], fragment=Markup(page['html']),
+                           views=views + pending_views, bytes_served=bytes_served + pending_bytes)
 
-@app.route('/uploads/videos/<filename>')
+@route('/uploads/videos/<filename>')
 @login_required
 def serve_video_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Content-addressed names carry their own strong validator and never change
+    digest = storage.digest_from_blob_name(filename)
+    path = get_blob_store().local_path(filename) # Fetched into the cache first if it is on the slow tier
+    if path is None:
+        abort(404)
+    ticket = None
+    if request.method == 'GET': # A HEAD response has no body to meter or wait for
+        # The ASGI streamer has already waited for a stream slot, and paces the body in its event loop
+        paced = throttle.TICKET_ENVIRON in request.environ
+        ticket = get_admission().admit(current_user.id, 'editor' if current_user.is_editor else 'viewer',
+                                       reserved=paced)
+        if paced:
+            ticket.paced_by_server = True
+            request.environ[throttle.TICKET_ENVIRON] = ticket
+    response = send_video_path(path, etag=digest, immutable=digest is not None, ticket=ticket,
+                               refetch=lambda: get_blob_store().local_path(filename))
+    # Blobs can be shared, so the player names the video it is playing in ?v=
+    video_id = request.args.get('v', type=int)
+    if video_id is not None and response.status_code in (200, 206) and response.content_length:
+        get_view_counter().record(video_id, bytes_served=response.content_length)
+    return instrumentation.count_bytes(response)
+
+@route('/metrics')
+def prometheus_metrics():
+    if not current_app.config['METRICS_ENABLED']:
+        return render_template('404.html'), 404
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('Unauthorized\n', 401, mimetype='text/plain')
+    return Response(instrumentation.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@schema_command('migrate-blobs')
+def migrate_blobs():
+    """One-time move of videos saved under their upload names into content-addressed blobs."""
+    folder = current_app.config['UPLOAD_FOLDER']
+    migrated = missing = 0
+    for video in Video.query.filter(Video.digest.is_(None)).all():
+        if video.digest is not None: # Already moved along with a row sharing its file
+            continue
+        path = os.path.join(folder, video.filename)
+        if not os.path.isfile(path):
+            missing += 1
+            click.echo(f'Missing file for video {video.id}: {video.filename}', err=True)
+            continue
+        hasher = storage.hash_file(path)
+        digest = hasher.hexdigest()
+        blob = storage.blob_name(digest, video.filename)
+        # Rows that shared the old name all move to the same blob
+        sharing = Video.query.filter_by(filename=video.filename, digest=None).all()
+        record_blob(blob, hasher.size)
+        get_blob_store().put(path, blob)
+        for row in sharing:
+            row.original_filename = row.filename
+            row.filename = blob
+            row.digest = digest
+            row.size = hasher.size
+            migrated += 1
+        db.session.commit()
+    click.echo(f'Migrated {migrated} videos, {missing} missing files.')
+
+BLOB_RECORD_SQL = text("""
+    INSERT INTO blob (name, size, touched_at) VALUES (:name, NULL, :now)
+    ON CONFLICT (name) DO NOTHING
+""").bindparams(bindparam('now', type_=db.DateTime))
+
+@schema_command('gc-blobs')
+@click.option('--batch-size', type=click.IntRange(1), default=500, show_default=True,
+              help='Blobs checked and deleted per transaction.')
+@click.option('--scan', is_flag=True,
+              help='First list the store once and record blobs the ledger has not seen, e.g. from before it existed.')
+@click.option('--dry-run', is_flag=True, help='Report what would be deleted without deleting it.')
+def gc_blobs(batch_size, scan, dry_run):
+    """Delete stored blobs that no video names any more.
+
+    Orphans are found by comparing the blob ledger with the video table in
+    batches, so a run does not list the store. Anything recorded within
+    BLOB_GC_GRACE seconds is left alone, as its upload may not have
+    committed yet; so are partial uploads written to within that time.
+    Resumable uploads that have received no chunk for that long are
+    expired, along with their partial files.
+    """
+    store = get_blob_store()
+    now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=current_app.config['BLOB_GC_GRACE'])
+    if scan:
+        names = store.names()
+        for start in range(0, len(names), batch_size):
+            with db.engine.begin() as connection:
+                connection.execute(BLOB_RECORD_SQL, [{'name': name, 'now': now} for name in names[start:start + batch_size]])
+        click.echo(f'Scanned {len(names)} stored blobs.')
+
+    orphaned = (Blob.touched_at < cutoff) & ~exists().where(Video.filename == Blob.name)
+    deleted = reclaimed = 0
+    after = ''
+    while True:
+        names = db.session.execute(select(Blob.name).where(orphaned, Blob.name > after)
+                                   .order_by(Blob.name).limit(batch_size)).scalars().all()
+        db.session.rollback() # Nothing to keep; just end the read
+        if not names:
+            break
+        after = names[-1]
+        if dry_run:
+            deleted += len(names)
+            continue
+        with db.engine.begin() as connection:
+            # Checked again under the write lock, which also holds off any upload
+            # recording one of these names until its file is gone
+            rows = connection.execute(delete(Blob).where(Blob.name.in_(names), orphaned)
+                                      .returning(Blob.name, Blob.size)).all()
+            for name, size in rows:
+                store.delete(name)
+                deleted += 1
+                reclaimed += size or 0
+
+    idle = UploadSession.updated_at < cutoff
+    if dry_run:
+        expired = [upload_id for (upload_id,) in db.session.query(UploadSession.id).filter(idle)]
+    else:
+        with db.engine.begin() as connection:
+            # Checked again in the delete, so a chunk arriving meanwhile keeps its session
+            expired = connection.execute(delete(UploadSession).where(idle).returning(UploadSession.id)).scalars().all()
+            if expired:
+                connection.execute(delete(UploadChunk).where(UploadChunk.upload_id.in_(expired)))
+
+    # The partial folder only holds uploads in progress, so listing it is cheap
+    sessions = {upload_id for (upload_id,) in db.session.query(UploadSession.id)} - set(expired)
+    db.session.rollback()
+    stale = time.time() - current_app.config['BLOB_GC_GRACE']
+    partials = 0
+    for entry in os.scandir(partial_upload_folder()):
+        if not entry.name.endswith('.part'):
+            continue
+        upload_id = entry.name[:-len('.part')]
+        if upload_id in sessions or (upload_id not in expired and entry.stat().st_mtime >= stale):
+            continue
+        if not dry_run:
+            os.remove(entry.path)
+        partials += 1
+    verb = 'Would delete' if dry_run else 'Deleted'
+    click.echo(f'{verb} {deleted} orphaned blobs ({reclaimed / 1e6:.1f} MB), {len(expired)} expired uploads '
+               f'and {partials} abandoned partial files.')
+
+@cli.command('build-assets')
+def build_assets():
+    """Fingerprint and gzip the static files ahead of the first request."""
+    for name, built in get_assets().names.items():
+        click.echo(f'{name} -> {built}')
+
+@schema_command('rebuild-search-index')
+def rebuild_search_index():
+    """Re-index every video for full-text search."""
+    with db.engine.begin() as connection:
+        search.create_index(connection)
+        search.rebuild_index(connection)
+    click.echo(f'Indexed {Video.query.count()} videos.')
+
+@schema_command('import-videos')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--uploader', help='Username or email credited for entries that do not name one.')
+@click.option('--workers', type=click.IntRange(1), default=min(8, os.cpu_count() or 1), show_default=True,
+              help='Files hashed and copied in parallel.')
+@click.option('--batch-size', type=click.IntRange(1), default=500, show_default=True,
+              help='Videos inserted per transaction.')
+@click.option('--link/--copy', default=True, show_default=True,
+              help='Hardlink files into UPLOAD_FOLDER where possible, or always copy them.')
+@click.option('--restart', is_flag=True, help='Ignore the saved position and start SOURCE from the beginning.')
+def import_videos(source, uploader, workers, batch_size, link, restart):
+    """Import a directory of videos, or a CSV/JSONL manifest of them.
+
+    An interrupted import resumes after the last committed batch when run again.
+    """
+    source = os.path.abspath(source)
+    try:
+        if os.path.isdir(source):
+            entries = importer.scan_directory(source, ALLOWED_EXTENSIONS)
+        else:
+            entries = importer.read_manifest(source)
+    except importer.ManifestError as e:
+        raise click.ClickException(str(e))
+
+    # Resolve every uploader up front, so no file is stored for a row that cannot be inserted
+    uploader_ids = {}
+    for name in {entry.uploader or uploader for entry in entries} - {None}:
+        user = User.query.filter((User.username == name) | (User.email == name)).first()
+        uploader_ids[name] = user.id if user else None
+    if uploader is not None and uploader_ids.get(uploader) is None:
+        raise click.ClickException(f'No user named {uploader!r}')
+
+    checkpoint = db.session.get(ImportCheckpoint, source)
+    if checkpoint is not None and restart:
+        db.session.delete(checkpoint)
+        db.session.commit()
+        checkpoint = None
+    start = checkpoint.position if checkpoint is not None else 0
+    if start:
+        click.echo(f'Resuming after {start} of {len(entries)} entries.')
+
+    store = get_blob_store()
+    temp_folder = partial_upload_folder()
+
+    def ingest(entry):
+        name = entry.uploader or uploader
+        try:
+            if name is None:
+                raise ValueError('no uploader given; pass --uploader')
+            if uploader_ids[name] is None:
+                raise ValueError(f'unknown uploader {name!r}')
+            if not allowed_file(entry.path):
+                raise ValueError('not an allowed video type')
+            if len(entry.title) > 100:
+                raise ValueError('title is longer than 100 characters')
+            uploaded_at = datetime.datetime.fromisoformat(entry.uploaded_at) if entry.uploaded_at else None
+            blob, digest, size = importer.ingest(entry.path, store, temp_folder, link)
+        except (OSError, ValueError) as e:
+            return entry, None, e
+        return entry, {
+            'title': entry.title,
+            'description': entry.description,
+            'filename': blob,
+            'original_filename': secure_filename(os.path.basename(entry.path))[:100],
+            'digest': digest,
+            'size': size,
+            'uploaded_at': uploaded_at or datetime.datetime.utcnow(),
+            'user_id': uploader_ids[name],
+        }, None
+
+    batch = []
+    imported = failed = imported_bytes = 0
+    began = last_commit = time.perf_counter()
+
+    def commit_batch(position):
+        nonlocal last_commit
+        if batch:
+            version = next_catalog_version(db.session)
+            for row in batch:
+                row['version'] = version
+            db.session.execute(Video.__table__.insert(), batch)
+            # Core inserts skip the ORM events that normally flag this and charge storage
+            db.session.info['catalog_changed'] = True
+            charged = collections.Counter()
+            for row in batch:
+                charged[row['user_id']] += row['size']
+            connection = db.session.connection()
+            for user_id, size in charged.items():
+                add_storage_used(connection, user_id, size)
+            # Recorded with the rows rather than ahead of the file; an interrupted
+            # import stores these blobs again when it resumes
+            now = datetime.datetime.utcnow()
+            connection.execute(BLOB_TOUCH_SQL, [{'name': row['filename'], 'size': row['size'], 'now': now}
+                                                for row in batch])
+        db.session.merge(ImportCheckpoint(source=source, position=position))
+        db.session.commit()
+        batch.clear()
+        last_commit = time.perf_counter()
+        elapsed = last_commit - began
+        click.echo(f'{position}/{len(entries)} entries, {imported} imported, {failed} failed, '
+                   f'{imported_bytes / 1e6:.1f} MB, {(position - start) / elapsed:.1f} files/s', err=True)
+
+    with ThreadPoolExecutor(workers) as executor:
+        for entry, row, error in importer.ordered_map(executor, ingest, entries[start:], workers * 4):
+            if error is not None:
+                failed += 1
+                click.echo(f'Skipped {entry.path}: {error}', err=True)
+            else:
+                batch.append(row)
+                imported += 1
+                imported_bytes += row['size']
+            # Also commit on a timer, so a library of huge files still makes resumable progress
+            if len(batch) >= batch_size or time.perf_counter() - last_commit >= 10:
+                commit_batch(entry.position + 1)
+    if start < len(entries):
+        commit_batch(len(entries))
+
+    elapsed = time.perf_counter() - began
+    click.echo(f'Imported {imported} videos ({imported_bytes / 1e6:.1f} MB) in {elapsed:.1f}s: '
+               f'{imported / elapsed:.1f} files/s, {imported_bytes / 1e6 / elapsed:.1f} MB/s; {failed} failed.')
+
+@schema_command('run-jobs')
+@click.option('--workers', type=click.IntRange(0), default=os.cpu_count() or 1, show_default=True,
+              help='Worker processes; 0 runs jobs one at a time in this process.')
+@click.option('--drain', is_flag=True, help='Exit once no jobs are due instead of waiting for more.')
+@click.option('--poll-interval', type=float, default=1.0, show_default=True, help='Seconds between queue checks.')
+def run_jobs(workers, drain, poll_interval):
+    """Run queued background jobs, such as post-upload video processing."""
+    dispatcher = get_dispatcher(workers, click.echo, poll_interval)
+    try:
+        dispatcher.run(drain=drain)
+    except KeyboardInterrupt:
+        click.echo('Interrupted; running jobs were recorded before exit.')
+    click.echo(f'{dispatcher.succeeded} jobs done, {dispatcher.failed} failed attempts; '
+               f'queue: {get_job_queue().counts(db.engine)}')
+
+@cli.command('migrate-db')
+def migrate_db():
+    """Apply any pending schema migrations."""
+    version = database.migrate(db.engine, log=click.echo)
+    click.echo(f'Database schema is at version {version}.')
+
+_schema_lock = threading.Lock()
+
+def ensure_schema():
+    """Apply pending migrations the first time the current app touches the database.
+
+    Runs from the first request or CLI command rather than at import, so
+    starting a worker costs no database I/O. Workers starting together are
+    serialised by ``database.migrate`` itself.
+    """
+    app = current_app._get_current_object()
+    if app.extensions.get('schema_ready'):
+        return
+    with _schema_lock:
+        if not app.extensions.get('schema_ready'):
+            database.migrate(db.engine) # Replaces db.create_all(); see database.MIGRATIONS
+            app.extensions['schema_ready'] = True
+
+def load_secret_key(path):
+    """The session signing key shared by every worker, created by whichever starts first."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+        f.write(secrets.token_bytes(32))
+    try:
+        os.link(temp_path, path) # Atomic and never overwrites: if another worker won, use its key
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+def create_app(config=None):
+    """Build the app from the defaults below, then $LEARNAI_* variables, then ``config``.
+
+    Nothing here connects to the database or creates the upload folder; the
+    schema is checked by ensure_schema on first use.
+    """
+    app = Flask(__name__, static_folder=None) # /static is served by serve_static
+    app.config['SECRET_KEY'] = None # Read from SECRET_KEY_FILE unless set
+    app.config['SECRET_KEY_FILE'] = os.path.join(app.instance_path, 'secret_key') # Created with a random key if missing
+    app.config['SQLALCHEMY_DATABASE_URI'] = database.database_uri() # $DATABASE_URL, else sqlite:///site.db
+    app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+    app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+    app.config['SQLITE_PRAGMAS'] = dict(database.DEFAULT_PRAGMAS) # Applied to every new SQLite connection
+    app.config['TEMPLATE_CACHE_DIR'] = os.path.join(app.instance_path, 'template-cache') # Compiled Jinja bytecode; None disables
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['VIDEO_MAX_RANGES'] = 16 # Reject Range headers asking for more parts than this
+    app.config['VIDEO_USE_MMAP'] = True # Serve multi-range responses from an mmap of the file
+    app.config['STREAM_MAX_CONNECTIONS'] = 1000 # Open streams the ASGI video streamer allows before answering 503
+    app.config['STREAM_RATE_LIMIT'] = None # Bytes per second per ASGI stream; None for no cap
+    app.config['STREAM_CHUNK_SIZE'] = 256 * 1024 # Bytes read and sent per step by the ASGI streamer
+    app.config['STREAM_IO_THREADS'] = 32 # Threads running the view and file reads for the ASGI streamer
+    app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024 # Size of each chunk in the resumable upload API
+    app.config['VIDEOS_PER_PAGE'] = 20 # Default page size for video_list
+    app.config['VIDEOS_MAX_PER_PAGE'] = 100 # Upper bound for the ?per_page= override
+    app.config['SEARCH_RESULTS_PER_PAGE'] = 20
+    app.config['SEARCH_MAX_PAGE'] = 50 # Deeper bm25 pages cost more and are never read
+    app.config['PAGE_CACHE_ENABLED'] = True # Cache rendered video_list/view_video fragments
+    app.config['PAGE_CACHE_SIZE'] = 512 # Entries kept in each worker's in-process LRU
+    # Seconds before a cached fragment is re-rendered regardless. View and byte counts
+    # in the video lists are part of the fragment, and counter flushes do not
+    # invalidate it, so they can be this old; the video page shows live counts.
+    app.config['PAGE_CACHE_TTL'] = 300
+    app.config['PAGE_CACHE_DIR'] = None # Optional directory shared by worker processes as a second tier
+    app.config['IDENTITY_CACHE_TTL'] = 30 # Seconds load_user may reuse a user snapshot; 0 disables
+    app.config['IDENTITY_CACHE_SIZE'] = 10000
+    app.config['VIEW_COUNTER_FLUSH_INTERVAL'] = 10 # Seconds between batched writes of view/bytes counters
+    app.config['VIEW_COUNTER_MAX_PENDING'] = 1000 # Flush early once this many videos have unwritten counts
+    app.config['POPULAR_VIDEOS_COUNT'] = 20 # Length of the "most viewed" listing
+    app.config['METRICS_ENABLED'] = True # Serve Prometheus metrics on /metrics
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') # If set, scrapers must send it as a Bearer token
+    app.config['SLOW_REQUEST_THRESHOLD'] = None # Seconds; log slower requests with their SQL queries
+    app.config['JOB_MAX_ATTEMPTS'] = 5 # Attempts before a background job is marked failed
+    app.config['JOB_RETRY_DELAY'] = 30 # Seconds before the first retry; doubles on each further attempt
+    app.config['JOB_LEASE'] = 600 # Seconds without a heartbeat before a running job is handed to another worker
+    app.config['UPLOAD_TEMP_FOLDER'] = None # Where partial uploads live; defaults to UPLOAD_FOLDER/.partial
+    app.config['STORAGE_BACKEND'] = 'local' # 'local': blobs live in UPLOAD_FOLDER; 'tiered': see below
+    app.config['STORAGE_SLOW_FOLDER'] = None # With 'tiered', where blobs live; UPLOAD_FOLDER is then an LRU cache
+    app.config['STORAGE_CACHE_SIZE'] = 20 * 1024 ** 3 # Bytes of cached blobs UPLOAD_FOLDER may hold with 'tiered'
+    app.config['STORAGE_QUOTA'] = None # Bytes of video each user may upload, unless User.storage_quota says otherwise
+    app.config['BLOB_GC_GRACE'] = 24 * 3600 # Seconds gc-blobs leaves a new blob or partial upload alone; idle resumable uploads then expire
+    app.config['STATIC_BUILD_DIR'] = os.path.join(app.instance_path, 'static-build') # Fingerprinted and gzipped copies of static/
+    app.config['GZIP_PAGES'] = True # Gzip HTML and JSON responses for clients that accept it
+    app.config['GZIP_LEVEL'] = 6
+    app.config['GZIP_MIN_SIZE'] = 500 # Bytes; smaller bodies are sent as they are
+    app.config['VIDEO_RATE_LIMITS'] = { # Per user of each tier; a missing tier or rate is unlimited
+        'viewer': {'requests_per_second': 20, 'request_burst': 100, 'bytes_per_second': None, 'byte_burst': None},
+        'editor': {'requests_per_second': 50, 'request_burst': 200, 'bytes_per_second': None, 'byte_burst': None},
+    } # A byte rate reads the tier's files through Python, without sendfile
+    app.config['VIDEO_MAX_STREAMS'] = None # Video responses open at once per process before new ones wait, then 429
+    app.config['VIDEO_STREAM_QUEUE_TIMEOUT'] = 2 # Seconds a request waits for a stream slot
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256' # werkzeug method; older hashes are upgraded at login
+    app.config['PASSWORD_HASH_WORKERS'] = max(1, (os.cpu_count() or 2) // 2) # Cores logins may use at once
+    app.config['PASSWORD_HASH_MAX_PENDING'] = 32 # Hashes allowed to wait for a thread before logins get 503
+    app.config.from_prefixed_env('LEARNAI') # e.g. LEARNAI_VIDEOS_PER_PAGE=50; values are parsed as JSON
+    app.config.update(config or {})
+    if app.config['STORAGE_BACKEND'] == 'tiered' and not app.config['STORAGE_SLOW_FOLDER']:
+        raise ValueError("STORAGE_BACKEND 'tiered' needs STORAGE_SLOW_FOLDER, the folder blobs are kept in")
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', database.engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'],
+        pool_size=app.config['DATABASE_POOL_SIZE'],
+        max_overflow=app.config['DATABASE_MAX_OVERFLOW']))
+    if not app.config['SECRET_KEY']:
+        # Every worker must sign sessions with the same key, or users are logged
+        # out whenever a request lands on a different one
+        app.config['SECRET_KEY'] = load_secret_key(app.config['SECRET_KEY_FILE'])
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    with app.app_context():
+        database.configure_sqlite(db.engine, app.config['SQLITE_PRAGMAS'])
+        instrumentation.init_app(app, db.engine)
+    app.before_request(ensure_schema)
+    app.after_request(compress_page)
+    app.register_error_handler(passwords.HasherBusy, hasher_busy)
+    app.register_error_handler(throttle.Throttled, video_throttled)
+    app.url_defaults(fingerprint_static_url)
+    app.add_url_rule('/static/<path:filename>', endpoint='static', view_func=serve_static)
+    for rule, options, view in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    for command in cli.commands.values():
+        app.cli.add_command(command)
+
+    app.add_template_global(video_mimetype)
+    app.add_template_filter(format_duration, 'duration')
+    if app.config['TEMPLATE_CACHE_DIR']:
+        # Workers load compiled templates instead of each re-parsing every one
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+    return app
 
-with app.app_context():
-    db.create_all()
+def __getattr__(name):
+    # `from app import app` (tests, `flask --app app`) gets a default app, built on first use
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
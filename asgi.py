@@ -0,0 +1,259 @@
+"""Asyncio delivery of video files for deployments with many slow viewers.
+
+Under WSGI every in-progress playback holds a worker for the whole transfer.
+``VideoStreamer`` is an ASGI application for ``/uploads/videos/``: the
+request itself, including the Flask-Login session check, Range and
+conditional GET handling and view counting, still runs through
+``serve_video_file`` on a thread, but the file body is then sent from the
+event loop in chunks, so one process can hold thousands of open streams.
+
+Each connection can be capped at ``STREAM_RATE_LIMIT`` bytes per second,
+and once ``STREAM_MAX_CONNECTIONS`` streams are open, new requests are
+answered 503 with a Retry-After header. The per-user limits of
+``throttle.Admission`` apply as under WSGI, but the wait for a stream slot
+and the pauses of a throttled body happen in the event loop, not on the
+threads every request's view needs. Run it next to the WSGI server and
+send only video requests to it, e.g.::
+
+    uvicorn asgi:application --port 8001
+    # nginx: location /uploads/videos/ { proxy_pass http://127.0.0.1:8001; }
+
+The HTML pages and upload API stay on WSGI; anything else that reaches
+this app gets a 404.
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import throttle
+
+VIDEO_PATH_PREFIX = '/uploads/videos/'
+SLOT_POLL_INTERVAL = 0.05 # Seconds between checks for a free stream slot
+
+
+class StreamedFile:
+    """The ``wsgi.file_wrapper`` this app offers, like a server with sendfile.
+
+    ``streaming.send_video_path`` wraps its file window in one. The streamer then
+    sends ``Content-Length`` bytes from the file's current offset itself,
+    without iterating the wrapper on a thread.
+    """
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.block_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+def wsgi_environ(scope):
+    """A WSGI environ for an ASGI HTTP ``scope`` with an empty request body."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': StreamedFile,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ', ') + value
+        environ[key] = value
+    return environ
+
+
+class Pacer:
+    """Spaces out sends so a connection averages at most ``rate`` bytes per second.
+
+    Sends are also charged to ``ticket``, if it is metered, and wait until
+    the user's byte bucket is out of debt.
+    """
+
+    def __init__(self, rate, clock, ticket=None):
+        self.rate = rate
+        self.clock = clock
+        self.ticket = ticket
+        self.started = clock()
+        self.sent = 0
+
+    async def sent_bytes(self, count):
+        self.sent += count
+        delay = 0.0
+        if self.rate:
+            delay = self.sent / self.rate - (self.clock() - self.started)
+        if self.ticket is not None and self.ticket.metered:
+            delay = max(delay, self.ticket.charge(count))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class VideoStreamer:
+    def __init__(self, app):
+        self.app = app
+        self.max_connections = app.config['STREAM_MAX_CONNECTIONS']
+        self.rate_limit = app.config['STREAM_RATE_LIMIT']
+        self.chunk_size = app.config['STREAM_CHUNK_SIZE']
+        self.executor = ThreadPoolExecutor(app.config['STREAM_IO_THREADS'], thread_name_prefix='video-stream')
+        self.active = 0
+        self.rejected = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if not scope['path'].startswith(VIDEO_PATH_PREFIX) or scope['method'] not in ('GET', 'HEAD'):
+            return await self._plain(send, 404, b'Not Found\n')
+        if self.active >= self.max_connections:
+            self.rejected += 1
+            return await self._plain(send, 503, b'Too many concurrent streams\n', [(b'retry-after', b'1')])
+        self.active += 1
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(self._watch_disconnect(receive, disconnected))
+        try:
+            await self._stream(scope, send, disconnected)
+        finally:
+            self.active -= 1
+            watcher.cancel()
+
+    async def _stream(self, scope, send, disconnected):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        environ = wsgi_environ(scope)
+        admission = None
+        if scope['method'] == 'GET':
+            admission = self._admission()
+            if not await self._reserve_slot(admission):
+                return await self._plain(send, 429, b'Too many video requests; please slow down.\n',
+                                         [(b'retry-after', b'1')])
+            environ[throttle.TICKET_ENVIRON] = None # The view leaves its ticket here
+        # Auth, validators and Range parsing are all the WSGI view's; only the body is sent here
+        try:
+            body = await loop.run_in_executor(self.executor, self.app, environ, start_response)
+        finally:
+            ticket = environ.get(throttle.TICKET_ENVIRON)
+            if admission is not None and ticket is None:
+                admission.release_reserved() # Not admitted: a login redirect, a 404 or a refusal
+        try:
+            headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                       for name, value in started['headers']]
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': headers})
+            length = dict(started['headers']).get('Content-Length')
+            pacer = Pacer(self.rate_limit, loop.time, ticket)
+            if isinstance(body, StreamedFile) and hasattr(body.filelike, 'fileno') and length is not None:
+                await self._send_file(send, body.filelike, int(length), pacer, disconnected)
+            else:
+                await self._send_iterable(send, body, pacer, disconnected)
+            if not disconnected.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(body, 'close'):
+                await loop.run_in_executor(self.executor, body.close)
+
+    def _admission(self):
+        from app import get_admission
+        with self.app.app_context():
+            return get_admission()
+
+    async def _reserve_slot(self, admission):
+        # Polled here rather than waited for by the view, which would hold an executor thread
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + admission.queue_timeout
+        while not admission.reserve():
+            if loop.time() >= deadline:
+                admission.refuse_stream()
+                return False
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+        return True
+
+    async def _send_file(self, send, file, length, pacer, disconnected):
+        loop = asyncio.get_running_loop()
+        fd, offset = file.fileno(), file.tell()
+        while pacer.sent < length and not disconnected.is_set():
+            size = min(self.chunk_size, length - pacer.sent)
+            data = await loop.run_in_executor(self.executor, os.pread, fd, size, offset + pacer.sent)
+            if not data:
+                break # Truncated underneath us; the client sees a short body
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            await pacer.sent_bytes(len(data))
+
+    async def _send_iterable(self, send, body, pacer, disconnected):
+        loop = asyncio.get_running_loop()
+        chunks = iter(body)
+        while not disconnected.is_set():
+            data = await loop.run_in_executor(self.executor, next, chunks, None)
+            if data is None:
+                break
+            if data:
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+                await pacer.sent_bytes(len(data))
+
+    @staticmethod
+    async def _watch_disconnect(receive, disconnected):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    @staticmethod
+    async def _plain(send, status, body, headers=()):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode()),
+                                *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_streamer(config=None):
+    from app import create_app
+    return VideoStreamer(create_app(config))
+
+
+def __getattr__(name):
+    # `uvicorn asgi:application` gets a streamer for the default app, built on first use
+    if name == 'application':
+        globals()['application'] = create_streamer()
+        return globals()['application']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
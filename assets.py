@@ -0,0 +1,110 @@
+"""Fingerprinted, precompressed static files and gzip for rendered pages.
+
+``AssetManifest.build`` copies every file under ``static/`` into a build
+folder under a name carrying its content hash (``css/style.<hash>.css``).
+Each text file also gets a gzip copy next to it, compressed once at
+maximum level. Templates keep calling ``url_for('static', ...)``; the app
+rewrites those URLs to the fingerprinted names. A fingerprinted URL always
+means the same bytes, so browsers may cache it forever and never
+revalidate. Unfingerprinted paths still work, with revalidation on each
+use.
+
+``compress_response`` gzips HTML and JSON bodies on the fly for clients
+that accept it. File bodies, including every video response, are sent
+unchanged.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import uuid
+
+from flask import request, send_file, send_from_directory
+
+FINGERPRINT_LENGTH = 12
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Worth gzipping; images, fonts and video are compressed already
+PRECOMPRESSED_TYPES = {'text/css', 'text/javascript', 'application/javascript', 'application/json',
+                       'image/svg+xml', 'text/plain', 'text/html', 'application/xml'}
+COMPRESSED_PAGE_TYPES = {'text/html', 'application/json'}
+
+
+def fingerprint_name(name, digest):
+    base, ext = os.path.splitext(name)
+    return f'{base}.{digest[:FINGERPRINT_LENGTH]}{ext}'
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path) # Workers building at once write identical bytes
+
+
+class AssetManifest:
+    def __init__(self, source, output):
+        self.source = source
+        self.output = output
+        self.names = {} # logical name -> fingerprinted name
+        self.files = {} # fingerprinted name -> (path, gzip path or None)
+
+    def build(self):
+        """Fingerprint and compress every source file; files already built are kept as they are."""
+        names, files = {}, {}
+        for root, dirs, filenames in os.walk(self.source):
+            dirs.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.source).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                fingerprinted = fingerprint_name(name, hashlib.sha256(data).hexdigest())
+                built = os.path.join(self.output, fingerprinted)
+                if not os.path.exists(built):
+                    _write_atomic(built, data)
+                gz_path = built + '.gz'
+                if mimetypes.guess_type(name)[0] in PRECOMPRESSED_TYPES:
+                    if not os.path.exists(gz_path):
+                        _write_atomic(gz_path, gzip.compress(data, 9, mtime=0))
+                else:
+                    gz_path = None
+                names[name] = fingerprinted
+                files[fingerprinted] = (built, gz_path)
+        self.names, self.files = names, files
+        return self
+
+    def url_name(self, name):
+        return self.names.get(name)
+
+    def send(self, filename):
+        """Response for ``/static/<filename>``, fingerprinted or not."""
+        entry = self.files.get(filename)
+        if entry is None:
+            return send_from_directory(self.source, filename, max_age=0)
+        path, gz_path = entry
+        use_gzip = gz_path is not None and request.accept_encodings['gzip'] > 0
+        response = send_file(gz_path if use_gzip else path, mimetype=mimetypes.guess_type(filename)[0],
+                             conditional=True)
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        if gz_path is not None:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+
+def compress_response(response, level=6, min_size=500):
+    """Gzip an HTML or JSON ``response`` in place if the client accepts it."""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or response.mimetype not in COMPRESSED_PAGE_TYPES or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] <= 0:
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.set_data(gzip.compress(data, level, mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
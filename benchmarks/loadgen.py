@@ -0,0 +1,271 @@
+"""Closed-loop HTTP load generator with per-endpoint latency and memory statistics."""
+import collections
+import http.client
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+_CSRF = re.compile(rb'name="csrf_token" type="hidden" value="([^"]+)"')
+_COOKIE = re.compile(r'^([^=;\s]+)=([^;]*)')
+
+
+class Client:
+    """One keep-alive connection with its own cookie jar, like one browser tab."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookies = {}
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection; retry once on a new one
+                self.close()
+                if attempt == 2:
+                    raise
+        for header in response.msg.get_all('Set-Cookie') or ():
+            match = _COOKIE.match(header)
+            if match:
+                self.cookies[match.group(1)] = match.group(2)
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        return response.status, data
+
+    def csrf_token(self, path):
+        status, data = self.request('GET', path)
+        match = _CSRF.search(data)
+        if status != 200 or not match:
+            raise RuntimeError(f'No CSRF token on {path} (status {status})')
+        return match.group(1).decode()
+
+    def login(self, email, password):
+        token = self.csrf_token('/login')
+        status, _ = self.request('POST', '/login', form_body(csrf_token=token, email=email, password=password),
+                                 {'Content-Type': 'application/x-www-form-urlencoded'})
+        if status != 302:
+            raise RuntimeError(f'Login as {email} failed with status {status}')
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def form_body(**fields):
+    return urlencode(fields)
+
+
+def multipart_body(fields, file_field, filename, content):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f'Content-Type: video/mp4\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class Scenario:
+    """How one endpoint is driven: per-client setup plus a request factory."""
+
+    def __init__(self, name, make_request, expect, setup=None, background=None):
+        self.name = name
+        self.make_request = make_request
+        self.expect = expect
+        self.setup = setup
+        self.background = background # Another scenario kept running, unmeasured, at the same concurrency
+
+
+def _login_as(key):
+    def setup(client, info):
+        client.login(info[key], info['password'])
+        return {}
+    return setup
+
+
+def _login_form_setup(client, info):
+    return {'token': client.csrf_token('/login')}
+
+
+def _login_request(state, info, rng):
+    body = form_body(csrf_token=state['token'], email=info['viewer_email'], password=info['password'])
+    return 'POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def _range_request(state, info, rng):
+    size = info['file_size']
+    length = min(1024 * 1024, size)
+    start = rng.randrange(0, size - length + 1)
+    blob = rng.choice(info['blobs'])
+    return 'GET', f'/uploads/videos/{blob}', None, {'Range': f'bytes={start}-{start + length - 1}'}
+
+
+def _upload_setup(client, info):
+    client.login(info['editor_email'], info['password'])
+    return {'token': client.csrf_token('/upload_video')}
+
+
+def _upload_request(state, info, rng):
+    body, content_type = multipart_body(
+        {'csrf_token': state['token'], 'title': 'Benchmark Upload', 'description': 'load test'},
+        'video_file', 'bench.mp4', rng.randbytes(256 * 1024))
+    return 'POST', '/upload_video', body, {'Content-Type': content_type}
+
+
+LOGIN = Scenario('login', _login_request, 302, _login_form_setup)
+
+SCENARIOS = [
+    LOGIN,
+    Scenario('video_list', lambda state, info, rng: ('GET', '/videos', None, {}), 200, _login_as('viewer_email')),
+    Scenario('view_video', lambda state, info, rng: ('GET', f"/video/{rng.choice(info['video_ids'])}", None, {}),
+             200, _login_as('viewer_email')),
+    Scenario('serve_video_full', lambda state, info, rng: ('GET', f"/uploads/videos/{rng.choice(info['blobs'])}", None, {}),
+             200, _login_as('viewer_email')),
+    Scenario('serve_video_range', _range_request, 206, _login_as('viewer_email')),
+    Scenario('upload_video', _upload_request, 302, _upload_setup),
+    # Pages must stay fast while password checks saturate the hashing threads
+    Scenario('video_list_during_logins', lambda state, info, rng: ('GET', '/videos', None, {}), 200,
+             _login_as('viewer_email'), background=LOGIN),
+]
+
+
+class RssSampler(threading.Thread):
+    """Tracks the peak resident set size of a process from /proc (Linux only)."""
+
+    def __init__(self, pid, interval=0.02):
+        super().__init__(daemon=True)
+        self.path = f'/proc/{pid}/status'
+        self.interval = interval
+        self.peak_kb = None
+        self._stop_event = threading.Event()
+
+    def read_rss_kb(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+        return None
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = self.read_rss_kb()
+            if rss is not None:
+                self.peak_kb = max(self.peak_kb or 0, rss)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        rss = self.read_rss_kb()
+        if rss is not None:
+            self.peak_kb = max(self.peak_kb or 0, rss)
+        return self.peak_kb
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest-rank definition: the smallest value with at least ``fraction`` of samples at or below it
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def run_scenario(scenario, host, port, info, concurrency, duration, server_pid=None, seed=0):
+    clients = [Client(host, port) for _ in range(concurrency)]
+    states = [scenario.setup(client, info) if scenario.setup else {} for client in clients]
+    latencies = [[] for _ in clients]
+    errors = [0] * concurrency
+    received = [0] * concurrency
+    background = scenario.background
+    background_clients = [Client(host, port) for _ in range(concurrency)] if background else []
+    background_states = [background.setup(client, info) if background.setup else {} for client in background_clients]
+    background_statuses = [collections.Counter() for _ in background_clients]
+    start_barrier = threading.Barrier(concurrency + len(background_clients) + 1)
+    deadline = [0.0]
+
+    def worker(i):
+        rng = random.Random(seed * 1000 + i)
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            method, path, body, headers = scenario.make_request(states[i], info, rng)
+            started = time.perf_counter()
+            try:
+                status, data = clients[i].request(method, path, body, headers)
+            except Exception:
+                errors[i] += 1
+                continue
+            latencies[i].append(time.perf_counter() - started)
+            received[i] += len(data)
+            if status != scenario.expect:
+                errors[i] += 1
+
+    def background_worker(i):
+        rng = random.Random(seed * 1000 + concurrency + i)
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            method, path, body, headers = background.make_request(background_states[i], info, rng)
+            try:
+                status, _ = background_clients[i].request(method, path, body, headers)
+            except Exception:
+                status = 'error'
+            background_statuses[i][status] += 1
+
+    sampler = RssSampler(server_pid) if server_pid and os.path.exists(f'/proc/{server_pid}/status') else None
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    threads += [threading.Thread(target=background_worker, args=(i,), daemon=True) for i in range(len(background_clients))]
+    for thread in threads:
+        thread.start()
+    if sampler:
+        sampler.start()
+    began = time.perf_counter()
+    deadline[0] = began + duration
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    peak_kb = sampler.stop() if sampler else None
+    for client in clients + background_clients:
+        client.close()
+
+    samples = sorted(latency for per_client in latencies for latency in per_client)
+    result = {
+        'requests': len(samples),
+        'errors': sum(errors),
+        'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+        'mb_per_sec': sum(received) / elapsed / 1e6 if elapsed else 0.0,
+        'p50_ms': _ms(percentile(samples, 0.50)),
+        'p95_ms': _ms(percentile(samples, 0.95)),
+        'p99_ms': _ms(percentile(samples, 0.99)),
+        'peak_rss_mb': round(peak_kb / 1024, 1) if peak_kb else None,
+    }
+    if background:
+        # e.g. how many logins were turned away with 503 while the pages were measured
+        statuses = sum(background_statuses, collections.Counter())
+        result['background'] = {'name': background.name, 'rps': sum(statuses.values()) / elapsed if elapsed else 0.0,
+                                'statuses': {str(status): count for status, count in statuses.items()}}
+    return result
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
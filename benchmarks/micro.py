@@ -0,0 +1,91 @@
+"""Micro-benchmarks for the hot helpers behind the routes, run in-process."""
+import datetime
+import time
+from contextlib import contextmanager
+
+from caching import TTLCache
+from passwords import PasswordHasher
+from pagination import decode_cursor, encode_cursor
+from search import build_match_query
+from storage import BlockHasher
+from streaming import parse_byte_ranges
+
+ONE_MB = b'\0' * (1024 * 1024)
+
+
+# Each case is a context manager: the code before its yield is setup, the
+# callable it yields is the measured body, and anything after is teardown.
+
+@contextmanager
+def _parse_byte_ranges():
+    yield lambda: parse_byte_ranges('bytes=0-99,200-299,150-250,-500', 10 ** 9)
+
+
+@contextmanager
+def _block_hash_1mb():
+    def body():
+        hasher = BlockHasher()
+        hasher.update(ONE_MB)
+        hasher.hexdigest()
+    yield body
+
+
+@contextmanager
+def _cursor_round_trip():
+    timestamp = datetime.datetime(2024, 5, 1, 12, 30)
+    yield lambda: decode_cursor(encode_cursor(timestamp, 123456))
+
+
+@contextmanager
+def _fts_match_query():
+    yield lambda: build_match_query('intro to python programming')
+
+
+@contextmanager
+def _ttl_cache_hit():
+    cache = TTLCache(1024, 60)
+    cache.set('key', 'value')
+    yield lambda: cache.get('key')
+
+
+@contextmanager
+def _password_verify():
+    # One check at the default cost, through the executor as the login route does it
+    hasher = PasswordHasher()
+    try:
+        pwhash = hasher.hash('benchmark-password')
+        yield lambda: hasher.verify(pwhash, 'benchmark-password')
+    finally:
+        hasher.executor.shutdown()
+
+
+MICRO_BENCHMARKS = {
+    'parse_byte_ranges': _parse_byte_ranges,
+    'block_hash_1mb': _block_hash_1mb,
+    'keyset_cursor_round_trip': _cursor_round_trip,
+    'fts_match_query': _fts_match_query,
+    'ttl_cache_hit': _ttl_cache_hit,
+    'password_verify': _password_verify,
+}
+
+
+def measure(fn, min_time=0.3):
+    """Calls per second of ``fn``, growing the batch until it runs for ``min_time``."""
+    count = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(count):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return count / elapsed
+        count *= 2
+
+
+def run_micro_benchmarks(names=None, min_time=0.3):
+    results = {}
+    for name, case in MICRO_BENCHMARKS.items():
+        if names is None or name in names:
+            with case() as fn:
+                results[name] = {'ops_per_sec': round(measure(fn, min_time), 1)}
+    return results
@@ -0,0 +1,151 @@
+"""Run the benchmark suite and compare it against a stored baseline.
+
+    python -m benchmarks.run                    # run, write results, compare
+    python -m benchmarks.run --save-baseline    # record a new baseline
+    python -m benchmarks.run --concurrency 32 --duration 10 --endpoints video_list,serve_video_range
+
+Exits with status 1 when any metric regresses beyond ``--tolerance``.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.loadgen import SCENARIOS, run_scenario
+from benchmarks.micro import run_micro_benchmarks
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(HERE, 'results', 'latest.json')
+
+# metric -> +1 if bigger is better, -1 if smaller is better
+ENDPOINT_METRICS = {'throughput_rps': 1, 'p95_ms': -1, 'p99_ms': -1, 'peak_rss_mb': -1}
+MICRO_METRICS = {'ops_per_sec': 1}
+# Settings that must match for numbers to be comparable
+COMPARABLE_SETTINGS = ('concurrency', 'users', 'videos', 'file_size')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous clients per endpoint')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds of load per endpoint')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--videos', type=int, default=20000)
+    parser.add_argument('--file-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--endpoints', help='Comma-separated subset of: ' + ', '.join(s.name for s in SCENARIOS))
+    parser.add_argument('--no-micro', action='store_true', help='Skip the in-process micro-benchmarks')
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=JSON',
+                        help='app.config override passed to the server, e.g. PAGE_CACHE_ENABLED=false')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression per metric')
+    parser.add_argument('--workdir', help='Keep the seeded database and files here instead of a temp dir')
+    return parser.parse_args(argv)
+
+
+def start_server(args, workdir):
+    command = [sys.executable, '-m', 'benchmarks.server', '--workdir', workdir, '--users', str(args.users),
+               '--videos', str(args.videos), '--file-size', str(args.file_size)]
+    for override in args.config:
+        command += ['--config', override]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    for line in process.stdout:
+        if line.startswith('READY '):
+            _, port, info = line.split(' ', 2)
+            return process, int(port), json.loads(info)
+    process.wait()
+    raise RuntimeError(f'Benchmark server exited with status {process.returncode} before it was ready')
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of human-readable regressions of ``results`` against ``baseline``."""
+    regressions = []
+    sections = (('endpoints', ENDPOINT_METRICS), ('micro', MICRO_METRICS))
+    for section, metrics in sections:
+        for name, current in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous:
+                continue
+            for metric, direction in metrics.items():
+                old, new = previous.get(metric), current.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old * direction
+                if change < -tolerance:
+                    regressions.append(f'{section}/{name} {metric}: {old} -> {new} ({change:+.0%})')
+    return regressions
+
+
+def print_table(results):
+    print(f"{'endpoint':<26}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'MB/s':>10}{'RSS MB':>10}{'errors':>8}")
+    for name, row in results['endpoints'].items():
+        print(f"{name:<26}{row['throughput_rps']:>10.1f}{row['p50_ms'] or 0:>10.2f}{row['p95_ms'] or 0:>10.2f}"
+              f"{row['p99_ms'] or 0:>10.2f}{row['mb_per_sec']:>10.1f}{row['peak_rss_mb'] or 0:>10.1f}{row['errors']:>8}")
+    for name, row in results.get('micro', {}).items():
+        print(f"{name:<30}{row['ops_per_sec']:>14.1f} ops/s")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    wanted = set(args.endpoints.split(',')) if args.endpoints else None
+    scenarios = [scenario for scenario in SCENARIOS if wanted is None or scenario.name in wanted]
+
+    results = {
+        'settings': {'concurrency': args.concurrency, 'duration': args.duration, 'users': args.users,
+                     'videos': args.videos, 'file_size': args.file_size, 'config': args.config},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'endpoints': {},
+    }
+    if not args.no_micro:
+        results['micro'] = run_micro_benchmarks()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='learnai-bench-')
+    process, port, info = start_server(args, workdir)
+    try:
+        for index, scenario in enumerate(scenarios):
+            results['endpoints'][scenario.name] = run_scenario(
+                scenario, '127.0.0.1', port, info, args.concurrency, args.duration, process.pid, seed=index)
+    finally:
+        process.terminate()
+        process.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare against; run with --save-baseline first.')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    mismatched = [key for key in COMPARABLE_SETTINGS if baseline['settings'].get(key) != results['settings'][key]]
+    if mismatched:
+        print(f"Settings differ from the baseline ({', '.join(mismatched)}); skipping the comparison.")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if any(row['errors'] for row in results['endpoints'].values()):
+        print('Some requests failed; see the errors column.')
+        return 1
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Seed a synthetic catalog and serve the app on a real local WSGI server.
+
+Started by ``benchmarks/run.py`` as a separate process, so its memory can be
+measured on its own. Prints ``READY <port> <json>`` once it is listening; the
+JSON describes the seeded data the load generator should target.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_PASSWORD = 'benchmark-password'
+SEED_FILES = 4
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workdir', required=True, help='Directory for the database and video files')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--videos', type=int, default=20000)
+    parser.add_argument('--file-size', type=int, default=8 * 1024 * 1024, help='Bytes per seeded video file')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=JSON',
+                        help='Override an app.config value, e.g. PAGE_CACHE_ENABLED=false')
+    return parser.parse_args(argv)
+
+
+def seed(app, db, User, Video, args, upload_folder):
+    """Insert users and videos in bulk unless the database is already seeded."""
+    import storage
+    from werkzeug.security import generate_password_hash
+
+    blobs = []
+    rng = random.Random(42)
+    for i in range(SEED_FILES):
+        path = os.path.join(upload_folder, f'seed-{i}.tmp')
+        with open(path, 'wb') as f:
+            remaining = args.file_size
+            while remaining:
+                block = rng.randbytes(min(remaining, 1024 * 1024))
+                f.write(block)
+                remaining -= len(block)
+        digest = storage.hash_file(path).hexdigest()
+        name = storage.blob_name(digest, 'seed.mp4')
+        storage.commit_blob(path, upload_folder, name)
+        blobs.append((name, digest))
+
+    with app.app_context():
+        if User.query.count():
+            return blobs
+        # One hash for everyone: hashing per user would dominate seeding time
+        password_hash = generate_password_hash(BENCH_PASSWORD, method='pbkdf2:sha256')
+        users = [{'id': i + 1, 'username': f'bench{i}', 'email': f'bench{i}@example.com',
+                  'password_hash': password_hash, 'is_editor': i == 0} for i in range(args.users)]
+        db.session.execute(User.__table__.insert(), users)
+        words = ['lecture', 'python', 'algebra', 'history', 'physics', 'intro', 'advanced', 'lab', 'review', 'seminar']
+        start = datetime.datetime(2020, 1, 1)
+        batch = []
+        for i in range(args.videos):
+            name, digest = blobs[i % len(blobs)]
+            batch.append({
+                'title': ' '.join(rng.choices(words, k=4)).title(),
+                'description': ' '.join(rng.choices(words, k=30)),
+                'filename': name,
+                'original_filename': 'seed.mp4',
+                'digest': digest,
+                'size': args.file_size,
+                'uploaded_at': start + datetime.timedelta(minutes=i),
+                'user_id': rng.randint(1, args.users),
+            })
+            if len(batch) == 5000:
+                db.session.execute(Video.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(Video.__table__.insert(), batch)
+        db.session.commit()
+    return blobs
+
+
+class QuietHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like a production server
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.workdir, exist_ok=True)
+    sys.path.insert(0, ROOT)
+    from app import create_app, db, ensure_schema, User, Video
+
+    workdir = os.path.abspath(args.workdir)
+    upload_folder = os.path.join(workdir, 'videos')
+    os.makedirs(upload_folder, exist_ok=True)
+    config = {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'SECRET_KEY_FILE': os.path.join(workdir, 'secret_key'),
+        'TEMPLATE_CACHE_DIR': os.path.join(workdir, 'template-cache'),
+        'STATIC_BUILD_DIR': os.path.join(workdir, 'static-build'),
+        'UPLOAD_FOLDER': upload_folder,
+        'VIDEO_RATE_LIMITS': {}, # Each scenario is one user going as fast as it can
+    }
+    for override in args.config:
+        key, _, value = override.partition('=')
+        config[key] = json.loads(value)
+    app = create_app(config)
+    with app.app_context():
+        ensure_schema()
+
+    blobs = seed(app, db, User, Video, args, upload_folder)
+    with app.app_context():
+        video_ids = [row[0] for row in db.session.query(Video.id).order_by(Video.id).limit(1000)]
+
+    server = make_server('127.0.0.1', args.port, app, threaded=True, request_handler=QuietHandler)
+    info = {
+        'editor_email': 'bench0@example.com',
+        'viewer_email': 'bench1@example.com',
+        'password': BENCH_PASSWORD,
+        'video_ids': video_ids,
+        'blobs': [name for name, _ in blobs],
+        'file_size': args.file_size,
+    }
+    print(f'READY {server.port} {json.dumps(info)}', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
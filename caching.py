@@ -0,0 +1,216 @@
+"""Caches for rendered HTML fragments.
+
+``TTLCache`` is a bounded in-process LRU whose entries also expire.
+``DiskCache`` is an optional shared tier so several worker processes can reuse
+each other's renders. ``PageCache`` combines them and handles invalidation
+with a generation token: every key is scoped by the current token, and
+invalidating just writes a new one, which orphans all older entries at once.
+With a disk tier the token lives in a file, so an upload handled by one
+worker invalidates the cache for all of them. A ``version`` callable, read
+on each lookup, scopes keys further by state every process shares (such
+as the catalog version in the database), so changes made by processes
+that never touch the cache, like CLI commands, are seen too.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache with a per-entry time to live."""
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires, value = entry
+            if expires <= self.clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _write_atomic(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class DiskCache:
+    """JSON entries in a directory shared by every worker process.
+
+    Entries for a generation live in their own subdirectory, which is
+    removed as a whole when the generation is replaced.
+    """
+
+    GENERATION_FILE = 'GENERATION'
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def generation(self):
+        try:
+            with open(os.path.join(self.directory, self.GENERATION_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def new_generation(self):
+        token = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.directory, token), exist_ok=True)
+        _write_atomic(os.path.join(self.directory, self.GENERATION_FILE), token)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name != token and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+        return token
+
+    def _path(self, generation, key):
+        return os.path.join(self.directory, generation, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def get(self, generation, key, default=None):
+        try:
+            with open(self._path(generation, key)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return default
+        if entry['expires'] <= time.time():
+            return default
+        return entry['value']
+
+    def set(self, generation, key, value):
+        path = self._path(generation, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            if generation != self.generation():
+                return # The generation was replaced while this value was being rendered
+            # A concurrent new_generation() swept our directory before losing the race
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            _write_atomic(path, json.dumps({'expires': time.time() + self.ttl, 'value': value}))
+        except FileNotFoundError:
+            pass
+
+
+class PageCache:
+    """Two-tier cache of rendered fragments with hit/miss counters."""
+
+    def __init__(self, maxsize=512, ttl=300, directory=None, version=None):
+        self.local = TTLCache(maxsize, ttl)
+        self.disk = DiskCache(directory, ttl) if directory else None
+        self.version = version
+        self._generation = None
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def generation(self):
+        if self.disk is None:
+            if self._generation is None:
+                self._generation = uuid.uuid4().hex
+            return self._generation
+        generation = self.disk.generation() or self.disk.new_generation()
+        if generation != self._generation:
+            # Another worker invalidated; everything held locally is stale
+            self.local.clear()
+            self._generation = generation
+        return generation
+
+    def _scope(self, key):
+        version = self.version()
+        if version != self._version:
+            # Changed elsewhere; entries under the old version will never be read again
+            self.local.clear()
+            self._version = version
+        return f'{version}:{key}'
+
+    def get_or_render(self, key, render):
+        """Return the cached fragment for ``key`` or render, store and return it.
+
+        ``render`` must return something JSON-serialisable.
+        """
+        generation = self.generation()
+        if self.version is not None:
+            key = self._scope(key)
+        local_key = (generation, key)
+        value = self.local.get(local_key, _MISSING)
+        if value is not _MISSING:
+            self._count('hits')
+            return value
+        if self.disk is not None:
+            value = self.disk.get(generation, key, _MISSING)
+            if value is not _MISSING:
+                self._count('disk_hits')
+                self.local.set(local_key, value)
+                return value
+        self._count('misses')
+        value = render()
+        self.local.set(local_key, value)
+        if self.disk is not None:
+            self.disk.set(generation, key, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self.invalidations += 1
+            self._generation = self.disk.new_generation() if self.disk is not None else uuid.uuid4().hex
+        self.local.clear()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'entries': len(self.local),
+        }
@@ -0,0 +1,115 @@
+"""Write-behind view and bytes-served counters.
+
+Recording a view only bumps an in-memory total, so ``view_video`` and every
+player Range request stay off SQLite's single writer lock. A background
+thread flushes the totals with one batched upsert into ``video_stats``
+every ``interval`` seconds, or sooner once ``max_pending`` videos have
+unflushed counts. Pending counts are also flushed at interpreter exit.
+Counts can still be lost if a worker is killed outright, which is an
+acceptable loss for analytics.
+"""
+import atexit
+import os
+import threading
+
+from sqlalchemy import text
+
+# Rows for videos that have been deleted, or ids that never existed, are dropped
+UPSERT_SQL = text("""
+    INSERT INTO video_stats (video_id, views, bytes_served)
+    SELECT :video_id, :views, :bytes_served WHERE EXISTS (SELECT 1 FROM video WHERE id = :video_id)
+    ON CONFLICT (video_id) DO UPDATE SET
+        views = views + excluded.views,
+        bytes_served = bytes_served + excluded.bytes_served
+""")
+
+
+class ViewCounter:
+    def __init__(self, engine, interval=10.0, max_pending=1000, log=None):
+        self.engine = engine
+        self.interval = interval
+        self.max_pending = max_pending
+        self.log = log
+        self._pending = {} # video_id -> [views, bytes_served]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.flushes = 0
+
+    def record(self, video_id, views=0, bytes_served=0):
+        with self._lock:
+            totals = self._pending.get(video_id)
+            if totals is None:
+                totals = self._pending[video_id] = [0, 0]
+            totals[0] += views
+            totals[1] += bytes_served
+            full = len(self._pending) >= self.max_pending
+        self._ensure_flusher()
+        if full:
+            self._wake.set()
+
+    def pending(self, video_id):
+        """Counts recorded for ``video_id`` in this process and not yet flushed."""
+        with self._lock:
+            return tuple(self._pending.get(video_id, (0, 0)))
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write all pending counts in one transaction; returns the number of videos updated."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            rows = [{'video_id': video_id, 'views': views, 'bytes_served': bytes_served}
+                    for video_id, (views, bytes_served) in pending.items()]
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(UPSERT_SQL, rows)
+            except Exception:
+                # Put the counts back so the next flush retries them
+                with self._lock:
+                    for video_id, (views, bytes_served) in pending.items():
+                        totals = self._pending.setdefault(video_id, [0, 0])
+                        totals[0] += views
+                        totals[1] += bytes_served
+                raise
+            self.flushes += 1
+            return len(rows)
+
+    def _ensure_flusher(self):
+        # Started lazily, and again in each forked worker: threads do not survive fork()
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='view-counter-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                if self.log is not None:
+                    self.log(f'Flushing view counters failed: {e}')
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            if self.log is not None:
+                self.log(f'Flushing view counters at exit failed: {e}')
@@ -0,0 +1,277 @@
+"""SQLite connection tuning and versioned schema migrations.
+
+Every new connection gets the PRAGMAs in ``DEFAULT_PRAGMAS``: WAL lets page
+views keep reading while an upload commits, and ``busy_timeout`` makes a
+writer wait for the lock instead of failing with "database is locked".
+
+The schema version lives in SQLite's ``PRAGMA user_version``. ``migrate``
+applies every entry of ``MIGRATIONS`` above that version, each in its own
+``BEGIN IMMEDIATE`` transaction, so workers starting together apply each
+step exactly once. Add a new entry whenever a model changes; never edit one
+that has shipped.
+"""
+import os
+
+from sqlalchemy import event
+
+import search
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL', # Durable at checkpoints; safe against corruption in WAL mode
+    'busy_timeout': 5000, # Milliseconds to wait for a competing writer
+    'cache_size': -20000, # Negative means KiB, i.e. a 20 MB page cache per connection
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def database_uri(default='sqlite:///site.db'):
+    return os.environ.get('DATABASE_URL', default)
+
+
+def is_sqlite_file(uri):
+    return uri.startswith('sqlite') and uri != 'sqlite://' and ':memory:' not in uri and 'mode=memory' not in uri
+
+
+def engine_options(uri, pool_size=10, max_overflow=10, pool_timeout=30):
+    """SQLAlchemy engine options for ``uri``; in-memory SQLite keeps its default pool."""
+    if uri.startswith('sqlite') and not is_sqlite_file(uri):
+        return {}
+    return {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout}
+
+
+def configure_sqlite(engine, pragmas=None):
+    """Apply ``pragmas`` to every connection ``engine`` opens from now on."""
+    pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def _columns(connection, table):
+    return {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info("{table}")')}
+
+
+def add_column(connection, table, name, ddl):
+    # Databases created with create_all() may already have the column
+    if name not in _columns(connection, table):
+        connection.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN {ddl}')
+
+
+def _initial_schema(connection):
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER NOT NULL,
+            username VARCHAR(20) NOT NULL,
+            email VARCHAR(120) NOT NULL,
+            password_hash VARCHAR(128) NOT NULL,
+            is_editor BOOLEAN,
+            PRIMARY KEY (id),
+            UNIQUE (username),
+            UNIQUE (email)
+        )""")
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS video (
+            id INTEGER NOT NULL,
+            title VARCHAR(100) NOT NULL,
+            description TEXT,
+            filename VARCHAR(100) NOT NULL,
+            uploaded_at DATETIME,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""")
+
+
+def _resumable_uploads(connection):
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS upload_session (
+            id VARCHAR(32) NOT NULL,
+            title VARCHAR(100) NOT NULL,
+            description TEXT,
+            filename VARCHAR(100) NOT NULL,
+            total_size BIGINT NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            created_at DATETIME,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES user (id)
+        )""")
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS upload_chunk (
+            upload_id VARCHAR(32) NOT NULL,
+            "index" INTEGER NOT NULL,
+            block_digests BLOB NOT NULL,
+            PRIMARY KEY (upload_id, "index"),
+            FOREIGN KEY(upload_id) REFERENCES upload_session (id)
+        )""")
+
+
+def _content_addressed_storage(connection):
+    add_column(connection, 'video', 'original_filename', 'original_filename VARCHAR(100)')
+    add_column(connection, 'video', 'digest', 'digest VARCHAR(64)')
+    add_column(connection, 'video', 'size', 'size BIGINT')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_digest ON video (digest)')
+
+
+def _video_list_indexes(connection):
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_uploaded_at_id ON video (uploaded_at, id)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_user_id ON video (user_id)')
+
+
+def _full_text_search(connection):
+    search.create_index(connection)
+    search.rebuild_index(connection)
+
+
+def _import_checkpoints(connection):
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS import_checkpoint (
+            source VARCHAR(1024) NOT NULL,
+            position INTEGER NOT NULL,
+            updated_at DATETIME,
+            PRIMARY KEY (source)
+        )""")
+
+
+def _media_metadata(connection):
+    add_column(connection, 'video', 'duration', 'duration FLOAT')
+    add_column(connection, 'video', 'width', 'width INTEGER')
+    add_column(connection, 'video', 'height', 'height INTEGER')
+    add_column(connection, 'video', 'codec', 'codec VARCHAR(16)')
+    add_column(connection, 'video', 'bitrate', 'bitrate INTEGER')
+
+
+def _job_queue(connection):
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS job (
+            id INTEGER NOT NULL,
+            kind VARCHAR(50) NOT NULL,
+            payload TEXT NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            attempts INTEGER NOT NULL,
+            max_attempts INTEGER NOT NULL,
+            run_at DATETIME NOT NULL,
+            locked_by VARCHAR(100),
+            locked_at DATETIME,
+            last_error TEXT,
+            created_at DATETIME,
+            finished_at DATETIME,
+            PRIMARY KEY (id)
+        )""")
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_job_status_run_at ON job (status, run_at)')
+    # Existing videos were published as soon as they were uploaded
+    add_column(connection, 'video', 'status', "status VARCHAR(16) DEFAULT 'ready' NOT NULL")
+    add_column(connection, 'video', 'job_id', 'job_id INTEGER REFERENCES job (id)')
+
+
+def _video_stats(connection):
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS video_stats (
+            video_id INTEGER NOT NULL,
+            views INTEGER NOT NULL,
+            bytes_served BIGINT NOT NULL,
+            PRIMARY KEY (video_id),
+            FOREIGN KEY(video_id) REFERENCES video (id)
+        )""")
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_stats_views ON video_stats (views, video_id)')
+
+
+def _catalog_versions(connection):
+    # Rows from before this migration are at version 0, which a first full sync includes
+    add_column(connection, 'video', 'version', 'version BIGINT DEFAULT 0 NOT NULL')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_version_id ON video (version, id)')
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER NOT NULL,
+            version BIGINT NOT NULL,
+            PRIMARY KEY (id)
+        )""")
+
+
+def _storage_accounting(connection):
+    add_column(connection, 'user', 'storage_used', 'storage_used BIGINT DEFAULT 0 NOT NULL')
+    add_column(connection, 'user', 'storage_quota', 'storage_quota BIGINT')
+    connection.exec_driver_sql(
+        'UPDATE "user" SET storage_used = (SELECT COALESCE(SUM(size), 0) FROM video WHERE video.user_id = "user".id)')
+    connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_filename ON video (filename)')
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS blob (
+            name VARCHAR(100) NOT NULL,
+            size BIGINT,
+            touched_at DATETIME NOT NULL,
+            PRIMARY KEY (name)
+        )""")
+    # Blobs on disk that no video names were never recorded; `gc-blobs --scan` finds those once
+    connection.exec_driver_sql("""
+        INSERT INTO blob (name, size, touched_at)
+        SELECT filename, MAX(size), CURRENT_TIMESTAMP FROM video WHERE true GROUP BY filename
+        ON CONFLICT (name) DO NOTHING""")
+
+
+def _video_tombstones(connection):
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS video_tombstone (
+            video_id INTEGER NOT NULL,
+            version BIGINT NOT NULL,
+            PRIMARY KEY (video_id)
+        )""")
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_video_tombstone_version_video_id ON video_tombstone (version, video_id)')
+
+
+def _upload_activity(connection):
+    add_column(connection, 'upload_session', 'updated_at', 'updated_at DATETIME')
+    connection.exec_driver_sql('UPDATE upload_session SET updated_at = created_at WHERE updated_at IS NULL')
+
+
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'resumable upload sessions', _resumable_uploads),
+    (3, 'content-addressed video storage', _content_addressed_storage),
+    (4, 'video_list keyset indexes', _video_list_indexes),
+    (5, 'full-text search index', _full_text_search),
+    (6, 'bulk import checkpoints', _import_checkpoints),
+    (7, 'video container metadata', _media_metadata),
+    (8, 'background job queue', _job_queue),
+    (9, 'view and bytes-served counters', _video_stats),
+    (10, 'catalog versions for delta sync', _catalog_versions),
+    (11, 'per-user storage accounting and the blob ledger', _storage_accounting),
+    (12, 'tombstones for deleted videos in delta sync', _video_tombstones),
+    (13, 'last activity of resumable uploads', _upload_activity),
+]
+
+
+def schema_version(connection):
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def migrate(engine, migrations=MIGRATIONS, log=None):
+    """Bring the database up to the newest migration; returns the final version."""
+    with engine.connect() as connection:
+        version = schema_version(connection)
+    if version >= migrations[-1][0]:
+        return version # Up to date; the common case on every worker start
+    for target, description, apply in migrations:
+        with engine.connect() as connection:
+            # Take the write lock before reading the version so two workers
+            # cannot both decide to apply the same step.
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+            version = schema_version(connection)
+            if target <= version:
+                connection.rollback()
+                continue
+            apply(connection)
+            connection.exec_driver_sql(f'PRAGMA user_version = {target:d}')
+            connection.commit()
+            version = target
+            if log is not None:
+                log(f'Applied migration {target}: {description}')
+    return version
@@ -0,0 +1,130 @@
+"""Bulk ingestion of existing video libraries.
+
+``read_manifest`` and ``scan_directory`` turn a CSV/JSONL manifest or a
+directory tree into ``ImportEntry`` records in a stable order, so a position
+in that order identifies how far an import got. ``ingest`` puts one file
+into a blob store (see storage.py) under its content address. It hardlinks
+the file into the temp folder when source and temp folder share a
+filesystem and copies it otherwise; either way the file is read exactly
+once, to hash it.
+
+The ``import-videos`` command in app.py runs ``ingest`` on a thread pool
+(hashing and file I/O release the GIL) and inserts the resulting rows in
+batches, saving its position in the same transaction as each batch.
+"""
+import csv
+import json
+import os
+import uuid
+from collections import deque, namedtuple
+
+import storage
+import uploads
+
+ImportEntry = namedtuple('ImportEntry', 'position path title description uploader uploaded_at')
+
+
+class ManifestError(ValueError):
+    """A manifest line could not be parsed."""
+
+
+def title_from_filename(filename):
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return ' '.join(stem.replace('_', ' ').replace('-', ' ').split())[:100] or stem[:100]
+
+
+def _entry(position, row, base):
+    path = (row.get('path') or '').strip()
+    if not path:
+        raise ManifestError(f'Entry {position + 1} has no path')
+    path = os.path.join(base, os.path.expanduser(path))
+    return ImportEntry(
+        position=position,
+        path=path,
+        title=(row.get('title') or '').strip() or title_from_filename(path),
+        description=row.get('description') or None,
+        uploader=(row.get('uploader') or '').strip() or None,
+        uploaded_at=(row.get('uploaded_at') or '').strip() or None,
+    )
+
+
+def read_manifest(path):
+    """Entries of a ``.csv`` (with a header row) or ``.jsonl`` manifest.
+
+    Each entry needs a ``path``, relative to the manifest or absolute; ``title``,
+    ``description``, ``uploader`` (username or email) and ``uploaded_at``
+    (ISO 8601) are optional.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    extension = os.path.splitext(path)[1].lower()
+    entries = []
+    with open(path, newline='', encoding='utf-8') as f:
+        if extension == '.csv':
+            for row in csv.DictReader(f):
+                entries.append(_entry(len(entries), row, base))
+        elif extension in ('.jsonl', '.ndjson'):
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise ManifestError(f'Line {line_number}: {e}') from None
+                if not isinstance(row, dict):
+                    raise ManifestError(f'Line {line_number}: expected a JSON object')
+                entries.append(_entry(len(entries), row, base))
+        else:
+            raise ManifestError(f'Unsupported manifest type {extension!r}; use .csv or .jsonl')
+    return entries
+
+
+def scan_directory(directory, extensions):
+    """Entries for every file under ``directory`` with an allowed extension, in sorted order."""
+    entries = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if '.' in name and name.rsplit('.', 1)[1].lower() in extensions:
+                entries.append(_entry(len(entries), {'path': os.path.join(root, name)}, directory))
+    return entries
+
+
+def ingest(path, store, temp_folder, link=True):
+    """Store the file at ``path`` as a blob in ``store``; returns ``(blob, digest, size)``.
+
+    A hardlinked blob shares its inode with the source, so pass ``link=False``
+    if the originals may later be edited in place.
+    """
+    temp_path = uploads.partial_path(temp_folder, uuid.uuid4().hex)
+    try:
+        hasher = None
+        if link:
+            try:
+                os.link(path, temp_path)
+            except OSError:
+                pass # Another filesystem, or links are not supported; copy instead
+            else:
+                hasher = storage.hash_file(temp_path)
+        if hasher is None:
+            with open(path, 'rb') as source:
+                hasher = storage.copy_and_hash(source, temp_path)
+        digest = hasher.hexdigest()
+        blob = storage.blob_name(digest, os.path.basename(path))
+        store.put(temp_path, blob)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return blob, digest, hasher.size
+
+
+def ordered_map(executor, fn, items, window):
+    """Like ``executor.map`` but with at most ``window`` calls in flight, so
+    results come back in order without queueing the whole input."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
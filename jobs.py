@@ -0,0 +1,286 @@
+"""A persistent job queue kept in the application database.
+
+Jobs are rows of the ``job`` table, so queueing one commits atomically with
+the rows it refers to and needs no broker. A ``Dispatcher`` claims due jobs
+and runs them on a process pool. Failed jobs are retried with exponential
+backoff until ``max_attempts`` is reached. While a job runs, its lease is
+renewed, so if a dispatcher dies mid-job, another one requeues the job once
+the lease lapses; a lapsed job with no attempts left (e.g. one whose worker
+keeps getting killed) is failed instead.
+
+Handlers are registered with ``@handler(kind)`` and receive the job's JSON
+payload as keyword arguments. A job can run more than once, e.g. after a
+crash between finishing and recording that, so handlers must be idempotent.
+"""
+import datetime
+import os
+import multiprocessing
+import socket
+import threading
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from sqlalchemy import func, select, update
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+HANDLERS = {}
+
+ClaimedJob = namedtuple('ClaimedJob', 'id kind payload attempts max_attempts')
+
+LEASE_EXPIRED = 'Lease expired: the worker running the job stopped renewing it'
+
+
+class Handler:
+    def __init__(self, kind, run, on_give_up=None):
+        self.kind = kind
+        self.run = run
+        self.on_give_up = on_give_up
+
+
+def handler(kind, on_give_up=None):
+    """Register the decorated function to run jobs of ``kind``.
+
+    ``on_give_up(error=..., **payload)`` is called in the dispatcher once the
+    last attempt has failed.
+    """
+    def decorator(run):
+        HANDLERS[kind] = Handler(kind, run, on_give_up)
+        return run
+    return decorator
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def retry_delay(attempts, base, cap=3600):
+    """Seconds to wait before attempt ``attempts + 1``: base, 2*base, 4*base, ... up to ``cap``."""
+    return min(cap, base * 2 ** (attempts - 1))
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    """Queue operations on the ``job`` table, each in its own transaction."""
+
+    def __init__(self, table, retry_base=30, lease=600):
+        self.table = table
+        self.retry_base = retry_base
+        self.lease = lease
+
+    def claim(self, engine, worker, now=None):
+        """Mark the next due job as running and return it, or None when nothing is due."""
+        t = self.table
+        now = now or utcnow()
+        with engine.begin() as connection:
+            while True:
+                job = connection.execute(
+                    select(t.c.id, t.c.kind, t.c.payload, t.c.attempts, t.c.max_attempts)
+                    .where(t.c.status == QUEUED, t.c.run_at <= now)
+                    .order_by(t.c.run_at, t.c.id).limit(1)).first()
+                if job is None:
+                    return None
+                # Guarded on status: if another dispatcher got there first, try the next job
+                claimed = connection.execute(
+                    update(t).where(t.c.id == job.id, t.c.status == QUEUED)
+                    .values(status=RUNNING, attempts=t.c.attempts + 1, locked_by=worker, locked_at=now))
+                if claimed.rowcount == 1:
+                    return ClaimedJob(job.id, job.kind, job.payload, job.attempts + 1, job.max_attempts)
+
+    def complete(self, engine, job_id):
+        t = self.table
+        with engine.begin() as connection:
+            connection.execute(update(t).where(t.c.id == job_id).values(
+                status=DONE, finished_at=utcnow(), locked_by=None, locked_at=None, last_error=None))
+
+    def fail(self, engine, job, error):
+        """Record a failed attempt; returns True if the job will be retried."""
+        t = self.table
+        now = utcnow()
+        retry = job.attempts < job.max_attempts
+        values = {'last_error': error[-4000:], 'locked_by': None, 'locked_at': None}
+        if retry:
+            values.update(status=QUEUED, run_at=now + datetime.timedelta(seconds=retry_delay(job.attempts, self.retry_base)))
+        else:
+            values.update(status=FAILED, finished_at=now)
+        with engine.begin() as connection:
+            connection.execute(update(t).where(t.c.id == job.id).values(**values))
+        return retry
+
+    def renew(self, engine, job_ids):
+        if not job_ids:
+            return
+        t = self.table
+        with engine.begin() as connection:
+            connection.execute(update(t).where(t.c.id.in_(job_ids), t.c.status == RUNNING).values(locked_at=utcnow()))
+
+    def requeue_expired(self, engine):
+        """Return jobs whose dispatcher stopped renewing their lease to the queue.
+
+        Jobs that have used all their attempts are failed instead, and
+        returned as ``ClaimedJob`` tuples so the caller can give up on them.
+        """
+        t = self.table
+        now = utcnow()
+        lapsed = (t.c.status == RUNNING) & (t.c.locked_at < now - datetime.timedelta(seconds=self.lease))
+        with engine.begin() as connection:
+            failed = connection.execute(
+                update(t).where(lapsed, t.c.attempts >= t.c.max_attempts)
+                .values(status=FAILED, finished_at=now, locked_by=None, locked_at=None, last_error=LEASE_EXPIRED)
+                .returning(t.c.id, t.c.kind, t.c.payload, t.c.attempts, t.c.max_attempts)).all()
+            connection.execute(update(t).where(lapsed)
+                               .values(status=QUEUED, locked_by=None, locked_at=None, run_at=now))
+        return [ClaimedJob(*row) for row in failed]
+
+    def counts(self, engine):
+        t = self.table
+        with engine.connect() as connection:
+            return dict(connection.execute(select(t.c.status, func.count()).group_by(t.c.status)).all())
+
+
+class Dispatcher:
+    """Claims jobs from ``queue`` and runs ``execute(kind, payload)`` for each.
+
+    With ``processes`` > 0 jobs run on a pool of forked processes and
+    ``initializer`` runs in each new process first (e.g. to drop database
+    connections inherited from the parent). With ``processes=0`` they run
+    inline, one at a time.
+    """
+
+    def __init__(self, queue, engine, execute, give_up, processes=0, initializer=None,
+                 poll_interval=1.0, log=None):
+        self.queue = queue
+        self.engine = engine
+        self.execute = execute
+        self.give_up = give_up
+        self.processes = processes
+        self.initializer = initializer
+        self.poll_interval = poll_interval
+        self.log = log or (lambda message: None)
+        self.worker = worker_name()
+        self.stopping = False
+        self._requeued = time.monotonic()
+        self.succeeded = 0
+        self.failed = 0
+
+    def _finish(self, job, error=None):
+        if error is None:
+            self.queue.complete(self.engine, job.id)
+            self.succeeded += 1
+            self.log(f'Job {job.id} ({job.kind}) done')
+            return
+        self.failed += 1
+        if self.queue.fail(self.engine, job, error):
+            self.log(f'Job {job.id} ({job.kind}) failed, attempt {job.attempts} of {job.max_attempts}; will retry')
+        else:
+            self.log(f'Job {job.id} ({job.kind}) failed permanently: {error.strip().splitlines()[-1]}')
+            self.give_up(job.kind, job.payload, error)
+
+    def _requeue_expired(self):
+        self._requeued = time.monotonic()
+        for job in self.queue.requeue_expired(self.engine):
+            self.failed += 1
+            self.log(f'Job {job.id} ({job.kind}) failed permanently: {LEASE_EXPIRED}')
+            self.give_up(job.kind, job.payload, LEASE_EXPIRED)
+
+    def _requeue_expired_if_due(self):
+        # Checked on every pass, busy or not, so new work cannot starve the recovery of crashed jobs
+        if time.monotonic() - self._requeued >= self.queue.lease / 4:
+            self._requeue_expired()
+
+    def _heartbeat(self, job_id, stop):
+        # Inline jobs block the dispatcher loop, so their lease is renewed from here
+        while not stop.wait(self.queue.lease / 4):
+            try:
+                self.queue.renew(self.engine, [job_id])
+            except Exception:
+                self.log(f'Could not renew the lease on job {job_id}:\n{traceback.format_exc()}')
+
+    def run_inline(self, drain=True):
+        """Run due jobs in this process; with ``drain``, stop once none are due."""
+        self._requeue_expired()
+        while not self.stopping:
+            self._requeue_expired_if_due()
+            job = self.queue.claim(self.engine, self.worker)
+            if job is None:
+                if drain:
+                    return
+                self._sleep()
+                continue
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job.id, stop), daemon=True)
+            heartbeat.start()
+            try:
+                self.execute(job.kind, job.payload)
+            except Exception:
+                error = traceback.format_exc()
+            else:
+                error = None
+            finally:
+                stop.set()
+                heartbeat.join()
+            self._finish(job, error)
+
+    def run(self, drain=False):
+        if self.processes == 0:
+            return self.run_inline(drain)
+        context = multiprocessing.get_context('fork') # Children inherit the registered handlers
+        executor = ProcessPoolExecutor(self.processes, mp_context=context, initializer=self.initializer)
+        running = {}
+        renewed = time.monotonic()
+        try:
+            self._requeue_expired()
+            while not self.stopping:
+                self._requeue_expired_if_due()
+                while len(running) < self.processes:
+                    job = self.queue.claim(self.engine, self.worker)
+                    if job is None:
+                        break
+                    running[executor.submit(self.execute, job.kind, job.payload)] = job
+                if not running:
+                    if drain:
+                        break
+                    self._sleep()
+                    continue
+                done, _ = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        self._finish(job, 'Worker process died while running the job')
+                    except Exception:
+                        self._finish(job, traceback.format_exc())
+                    else:
+                        self._finish(job)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # A crashed child takes the whole pool down; its other futures fail on the next
+                    # pass, and new jobs go to a fresh pool
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(self.processes, mp_context=context, initializer=self.initializer)
+                if time.monotonic() - renewed >= self.queue.lease / 4:
+                    self.queue.renew(self.engine, [job.id for job in running.values()])
+                    renewed = time.monotonic()
+        finally:
+            # Let running jobs finish so they are recorded rather than left to the lease
+            for future in list(running):
+                job = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    self._finish(job, traceback.format_exc())
+                else:
+                    self._finish(job)
+            executor.shutdown()
+
+    def _sleep(self):
+        time.sleep(self.poll_interval)
@@ -0,0 +1,215 @@
+"""Request instrumentation exposed in the Prometheus text format.
+
+``Instrumentation`` hooks into a Flask app and its SQLAlchemy engine and
+records, per endpoint: request latency, the number and total time of SQL
+queries, and Jinja render time. Requests slower than a threshold are logged
+together with the queries they ran. Metrics are kept per process; under a
+multi-worker server each worker reports its own series.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app, g, has_request_context, request, template_rendered, before_render_template
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), then sum and count
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    le = bound if bound == '+Inf' else _format_value(float(bound))
+                    lines.append(f'{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}')
+                label_text = _format_labels(self.labelnames, labels)
+                lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+                lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """``collect()`` returns ``[(name, type, documentation, value), ...]`` read at scrape time."""
+        self.collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for name, kind, documentation, value in collect():
+                lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}', f'{name} {_format_value(value)}']
+        return '\n'.join(lines) + '\n'
+
+
+class Instrumentation:
+    def __init__(self, prefix='learnai'):
+        self.registry = Registry()
+        self.requests = self.registry.register(Counter(
+            f'{prefix}_http_requests_total', 'HTTP requests by endpoint, method and status.',
+            ('endpoint', 'method', 'status')))
+        self.latency = self.registry.register(Histogram(
+            f'{prefix}_http_request_duration_seconds', 'Time spent in the view, up to the first response byte.',
+            ('endpoint',)))
+        self.query_count = self.registry.register(Histogram(
+            f'{prefix}_sql_queries_per_request', 'SQL statements executed per request.',
+            ('endpoint',), QUERY_COUNT_BUCKETS))
+        self.query_time = self.registry.register(Histogram(
+            f'{prefix}_sql_duration_seconds', 'Total SQL time per request.', ('endpoint',)))
+        self.render_time = self.registry.register(Histogram(
+            f'{prefix}_template_render_seconds', 'Total Jinja render time per request.', ('endpoint',)))
+        self.bytes_sent = self.registry.register(Counter(
+            f'{prefix}_video_bytes_sent_total', 'Video bytes handed to the server by serve_video_file.'))
+        self.slow_requests = self.registry.register(Counter(
+            f'{prefix}_slow_requests_total', 'Requests slower than SLOW_REQUEST_THRESHOLD.', ('endpoint',)))
+
+    def init_app(self, app, engine):
+        from sqlalchemy import event
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def count_bytes(self, response):
+        """Count the body of a video response as it is handed to the server.
+
+        Bodies are passed through untouched so sendfile still applies, which
+        means bytes are counted by Content-Length rather than as they leave.
+        """
+        if response.status_code in (200, 206) and response.content_length:
+            self.bytes_sent.inc(response.content_length)
+        return response
+
+    @staticmethod
+    def _start_request():
+        g._metrics_started = time.perf_counter()
+        g._metrics_queries = []
+        g._metrics_render_depth = 0
+        g._metrics_render_time = 0.0
+
+    def _finish_request(self, response):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        queries = g.pop('_metrics_queries', [])
+        self.requests.inc(1, endpoint, request.method, str(response.status_code))
+        self.latency.observe(elapsed, endpoint)
+        self.query_count.observe(len(queries), endpoint)
+        self.query_time.observe(sum(duration for _, duration in queries), endpoint)
+        self.render_time.observe(g.pop('_metrics_render_time', 0.0), endpoint)
+
+        threshold = current_app.config.get('SLOW_REQUEST_THRESHOLD')
+        if threshold is not None and elapsed >= threshold:
+            self.slow_requests.inc(1, endpoint)
+            details = ''.join(f'\n  {duration * 1000:8.2f} ms  {statement}' for statement, duration in queries)
+            current_app.logger.warning('Slow request: %s %s took %.1f ms with %d queries%s',
+                                    request.method, request.full_path.rstrip('?'), elapsed * 1000,
+                                    len(queries), details)
+        return response
+
+    @staticmethod
+    def _before_render(sender, template, context, **extra):
+        if has_request_context() and '_metrics_started' in g:
+            if g._metrics_render_depth == 0:
+                g._metrics_render_started = time.perf_counter()
+            g._metrics_render_depth += 1
+
+    @staticmethod
+    def _after_render(sender, template, context, **extra):
+        if has_request_context() and g.get('_metrics_render_depth'):
+            g._metrics_render_depth -= 1
+            if g._metrics_render_depth == 0:
+                g._metrics_render_time += time.perf_counter() - g._metrics_render_started
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            conn.info.setdefault('_metrics_started', []).append(time.perf_counter())
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and conn.info.get('_metrics_started'):
+            duration = time.perf_counter() - conn.info['_metrics_started'].pop()
+            queries = g.get('_metrics_queries')
+            if queries is not None:
+                queries.append((' '.join(statement.split()), duration))
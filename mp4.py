@@ -0,0 +1,248 @@
+"""Streaming inspection and faststart remuxing of MP4/MOV (ISO BMFF) files.
+
+Only box headers are read while walking the top level of the file, so even
+multi-gigabyte uploads are scanned with a handful of small reads. The
+``moov`` box, which holds all the metadata and is typically a few hundred
+KB, is the only part loaded into memory; ``mdat`` payloads are copied in
+fixed-size blocks.
+
+A file is "faststart" when ``moov`` precedes the media data. Otherwise a
+browser has to fetch the tail of the file before it can start playback.
+``faststart`` rewrites such a file with ``moov`` moved in front of the first
+``mdat``, shifting the chunk offsets in every ``stco``/``co64`` table by the
+size of ``moov``.
+"""
+import os
+import struct
+from collections import namedtuple
+
+COPY_BUFFER_SIZE = 1024 * 1024
+MAX_MOOV_SIZE = 64 * 1024 * 1024 # Larger moov boxes are treated as malformed
+
+# Box types that may appear at the top level of an MP4 or QuickTime file
+TOP_LEVEL_TYPES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'uuid', b'pdin', b'meta',
+                   b'moof', b'mfra', b'styp', b'sidx', b'pnot', b'udta'}
+# Containers on the path from moov down to the sample tables
+CONTAINER_TYPES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'dinf'}
+
+Box = namedtuple('Box', 'type offset size header_size')
+MediaInfo = namedtuple('MediaInfo', 'duration width height codec bitrate needs_faststart')
+
+
+class InvalidContainer(ValueError):
+    """The file is not an ISO base media file, or its box structure is broken."""
+
+
+def _parse_header(data, offset, end):
+    if end - offset < 8:
+        raise InvalidContainer(f'Truncated box header at offset {offset}')
+    size, box_type = struct.unpack_from('>I4s', data, offset)
+    header_size = 8
+    if size == 1:
+        if end - offset < 16:
+            raise InvalidContainer(f'Truncated box header at offset {offset}')
+        size = struct.unpack_from('>Q', data, offset + 8)[0]
+        header_size = 16
+    elif size == 0:
+        size = end - offset # The box runs to the end of its parent
+    if size < header_size or offset + size > end:
+        raise InvalidContainer(f'Box {box_type!r} at offset {offset} has an invalid size {size}')
+    return Box(box_type, offset, size, header_size)
+
+
+def iter_file_boxes(f):
+    """Yield the top-level boxes of the open binary file ``f``."""
+    end = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset < end:
+        f.seek(offset)
+        box = _parse_header(f.read(16), 0, end - offset)._replace(offset=offset)
+        if offset == 0 and box.type not in TOP_LEVEL_TYPES:
+            raise InvalidContainer('Not an MP4/QuickTime file')
+        yield box
+        offset += box.size
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield the boxes laid out back to back in ``data[start:end]``."""
+    end = len(data) if end is None else end
+    offset = start
+    while offset < end:
+        box = _parse_header(data, offset, end)
+        yield box
+        offset += box.size
+
+
+def _children(data, box):
+    return iter_boxes(data, box.offset + box.header_size, box.offset + box.size)
+
+
+def _find(data, box, *path):
+    """First descendant of ``box`` along a path of box types, or None."""
+    for box_type in path:
+        box = next((child for child in _children(data, box) if child.type == box_type), None)
+        if box is None:
+            return None
+    return box
+
+
+def _payload(box):
+    return box.offset + box.header_size
+
+
+def _read_version(data, box):
+    return data[_payload(box)]
+
+
+def _duration(data, box):
+    # mvhd and mdhd share this layout: (timescale, duration) after creation/modification times
+    start = _payload(box) + 4
+    if _read_version(data, box) == 1:
+        timescale, duration = struct.unpack_from('>IQ', data, start + 16)
+    else:
+        timescale, duration = struct.unpack_from('>II', data, start + 8)
+    return duration / timescale if timescale and duration not in (0, 0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF) else None
+
+
+def _track_size(data, tkhd):
+    # Display width and height, as 16.16 fixed point, after the 52 bytes of layer/volume/matrix fields
+    start = _payload(tkhd) + 4 + (32 if _read_version(data, tkhd) == 1 else 20) + 52
+    width, height = struct.unpack_from('>II', data, start)
+    return width >> 16, height >> 16
+
+
+def _sample_entry(data, stsd):
+    entries = iter_boxes(data, _payload(stsd) + 8, stsd.offset + stsd.size)
+    return next(entries, None)
+
+
+def read_moov(f, boxes):
+    moov = next((box for box in boxes if box.type == b'moov'), None)
+    if moov is None:
+        raise InvalidContainer('No moov box')
+    if moov.size > MAX_MOOV_SIZE:
+        raise InvalidContainer(f'moov box is too large ({moov.size} bytes)')
+    f.seek(moov.offset)
+    data = f.read(moov.size)
+    if len(data) != moov.size:
+        raise InvalidContainer('Truncated moov box')
+    return moov, data
+
+
+def probe(path):
+    """Return the ``MediaInfo`` of the file at ``path``.
+
+    ``duration`` is in seconds and ``bitrate`` in bits per second over the
+    whole file; fields the file does not describe are None.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        boxes = list(iter_file_boxes(f))
+        moov, data = read_moov(f, boxes)
+    try:
+        return _probe_moov(data, boxes, moov, size)
+    except struct.error:
+        raise InvalidContainer('Truncated box inside moov') from None
+
+
+def _probe_moov(data, boxes, moov, size):
+    root = Box(b'moov', 0, len(data), moov.header_size)
+    mvhd = _find(data, root, b'mvhd')
+    duration = _duration(data, mvhd) if mvhd else None
+    width = height = codec = None
+    track_durations = []
+    for trak in (box for box in _children(data, root) if box.type == b'trak'):
+        hdlr = _find(data, trak, b'mdia', b'hdlr')
+        mdhd = _find(data, trak, b'mdia', b'mdhd')
+        stsd = _find(data, trak, b'mdia', b'minf', b'stbl', b'stsd')
+        if mdhd:
+            track_durations.append(_duration(data, mdhd))
+        handler = bytes(data[_payload(hdlr) + 8:_payload(hdlr) + 12]) if hdlr else None
+        entry = _sample_entry(data, stsd) if stsd else None
+        if handler == b'vide' and width is None: # The first video track describes the file
+            codec = entry.type.decode('latin-1').strip() if entry else None
+            tkhd = _find(data, trak, b'tkhd')
+            width, height = _track_size(data, tkhd) if tkhd else (0, 0)
+            if not (width and height) and entry and entry.size >= 36:
+                # Fall back to the coded size in the visual sample entry
+                width, height = struct.unpack_from('>HH', data, entry.offset + 32)
+    if duration is None:
+        duration = max((d for d in track_durations if d), default=None)
+    first_mdat = next((box for box in boxes if box.type == b'mdat'), None)
+    return MediaInfo(
+        duration=duration,
+        width=width or None,
+        height=height or None,
+        codec=codec,
+        bitrate=int(size * 8 / duration) if duration else None,
+        needs_faststart=first_mdat is not None and first_mdat.offset < moov.offset,
+    )
+
+
+def _chunk_offset_tables(data, box):
+    """Yield ``(type, entries_offset, count)`` for each stco/co64 under ``box``."""
+    for child in _children(data, box):
+        if child.type in (b'stco', b'co64'):
+            count = struct.unpack_from('>I', data, _payload(child) + 4)[0]
+            width = 4 if child.type == b'stco' else 8
+            if _payload(child) + 8 + count * width > child.offset + child.size:
+                raise InvalidContainer(f'{child.type.decode()} table overruns its box')
+            yield child.type, _payload(child) + 8, count
+        elif child.type in CONTAINER_TYPES:
+            yield from _chunk_offset_tables(data, child)
+
+
+def _copy_range(f, out, offset, length, hasher):
+    f.seek(offset)
+    while length:
+        block = f.read(min(COPY_BUFFER_SIZE, length))
+        if not block:
+            raise InvalidContainer('File ended inside a box')
+        out.write(block)
+        if hasher is not None:
+            hasher.update(block)
+        length -= len(block)
+
+
+def faststart(source, destination, hasher=None):
+    """Write ``source`` to ``destination`` with ``moov`` ahead of the media data.
+
+    Every byte written is also fed to ``hasher`` when one is given. Returns
+    False, writing nothing, when the file is already faststart or cannot be
+    rewritten (a 32-bit ``stco`` offset would overflow).
+    """
+    with open(source, 'rb') as f:
+        boxes = list(iter_file_boxes(f))
+        moov, data = read_moov(f, boxes)
+        first_mdat = next((box for box in boxes if box.type == b'mdat'), None)
+        if first_mdat is None or moov.offset < first_mdat.offset:
+            return False
+
+        # Everything from the first mdat up to moov moves down by moov's size
+        data = bytearray(data)
+        root = Box(b'moov', 0, len(data), moov.header_size)
+        try:
+            tables = list(_chunk_offset_tables(data, root))
+        except struct.error:
+            raise InvalidContainer('Truncated box inside moov') from None
+        updates = []
+        for box_type, start, count in tables:
+            fmt = f'>{count}I' if box_type == b'stco' else f'>{count}Q'
+            offsets = struct.unpack_from(fmt, data, start)
+            shifted = [o + moov.size if first_mdat.offset <= o < moov.offset else o for o in offsets]
+            if box_type == b'stco' and shifted and max(shifted) > 0xFFFFFFFF:
+                return False
+            updates.append((fmt, start, shifted))
+        for fmt, start, shifted in updates:
+            struct.pack_into(fmt, data, start, *shifted)
+
+        with open(destination, 'wb') as out:
+            for box in boxes:
+                if box is moov:
+                    continue
+                if box is first_mdat:
+                    out.write(data)
+                    if hasher is not None:
+                        hasher.update(data)
+                _copy_range(f, out, box.offset, box.size, hasher)
+    return True
@@ -0,0 +1,41 @@
+"""Keyset (cursor) pagination.
+
+Pages are addressed by the sort key of the last row already shown instead of
+an OFFSET, so fetching page N costs the same index range scan as page 1.
+"""
+import base64
+import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f'{timestamp.isoformat()}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return ``(timestamp, row_id)`` for a cursor, or None if it is not one of ours."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.split('|')
+        return datetime.datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def keyset_page(query, timestamp_column, id_column, cursor, per_page):
+    """Fetch one page of ``query`` newest first, continuing after ``cursor``.
+
+    Returns ``(rows, next_cursor)``; ``next_cursor`` is None on the last page.
+    One extra row is fetched to find out whether another page exists.
+    """
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        query = query.filter(tuple_(timestamp_column, id_column) < position)
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, timestamp_column.key), getattr(last, id_column.key))
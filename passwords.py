@@ -0,0 +1,72 @@
+"""Password hashing on a small, bounded pool of threads.
+
+A pbkdf2 or scrypt check burns a core for a good fraction of a second. Run
+inline, a burst of logins gives every request thread one, and pages and
+video requests queue behind them. ``PasswordHasher`` runs them on
+``workers`` threads; hashlib releases the GIL while it hashes, so the rest
+of the process keeps running. At most ``max_pending`` more may wait. Past
+that, ``HasherBusy`` is raised at once, so the caller can answer 503 and
+the client can retry later.
+
+``method`` is a werkzeug method string such as ``pbkdf2:sha256:600000``.
+Parameters left out take werkzeug's defaults. A stored hash made with
+other parameters reports ``needs_rehash``, so it can be replaced the next
+time its user logs in with the right password. The user table holds 128
+characters, enough for pbkdf2 but not for an scrypt hash.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+SCRYPT_DEFAULTS = ('32768', '8', '1')
+
+
+class HasherBusy(Exception):
+    """Every hashing thread is busy and the backlog is full."""
+
+
+def normalize_method(method):
+    """``method`` with every parameter spelled out, as it appears in a stored hash."""
+    name, *params = method.split(':')
+    if name == 'pbkdf2':
+        hash_name = params[0] if params else 'sha256'
+        iterations = int(params[1]) if len(params) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    if name == 'scrypt':
+        return ':'.join([name, *params, *SCRYPT_DEFAULTS[len(params):]])
+    raise ValueError(f'Unsupported password hash method {method!r}')
+
+
+class PasswordHasher:
+    def __init__(self, method='pbkdf2:sha256', workers=1, max_pending=16):
+        self.method = normalize_method(method)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        self._slots = threading.Semaphore(workers + max_pending)
+        self.rejected = 0
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy()
+        try:
+            future = self.executor.submit(self._release_after, fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        return future.result()
+
+    def _release_after(self, fn, *args):
+        try:
+            return fn(*args)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.method
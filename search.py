@@ -0,0 +1,105 @@
+"""Full-text search over video titles and descriptions with SQLite FTS5.
+
+``video_fts`` is an external-content FTS5 table: it indexes ``video.title``
+and ``video.description`` without keeping a second copy of the text, and
+triggers on ``video`` keep it in step with every insert, update and delete,
+including ones that bypass the ORM.
+"""
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import text
+
+# Titles weigh ten times as much as descriptions in the bm25 ranking
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+MIN_PREFIX_LENGTH = 3
+
+# Control characters cannot appear in the escaped output, so highlight()
+# marks matches with them and they are swapped for <mark> after escaping.
+_OPEN, _CLOSE = '\x02', '\x03'
+
+CREATE_STATEMENTS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS video_fts USING fts5(
+        title, description,
+        content='video', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS video_fts_insert AFTER INSERT ON video BEGIN
+        INSERT INTO video_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS video_fts_delete AFTER DELETE ON video BEGIN
+        INSERT INTO video_fts(video_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS video_fts_update AFTER UPDATE OF title, description ON video BEGIN
+        INSERT INTO video_fts(video_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO video_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    # Make ORDER BY rank use the weighted bm25 so FTS5 can sort inside the index scan
+    f"INSERT INTO video_fts(video_fts, rank) VALUES ('rank', 'bm25({TITLE_WEIGHT}, {DESCRIPTION_WEIGHT})')",
+]
+
+DROP_STATEMENTS = [
+    'DROP TRIGGER IF EXISTS video_fts_insert',
+    'DROP TRIGGER IF EXISTS video_fts_delete',
+    'DROP TRIGGER IF EXISTS video_fts_update',
+    'DROP TABLE IF EXISTS video_fts',
+]
+
+# Only ready videos are listed, so the status filter has to apply before
+# LIMIT/OFFSET or pages come up short
+SEARCH_SQL = text(f"""
+    SELECT video_fts.rowid,
+           highlight(video_fts, 0, '{_OPEN}', '{_CLOSE}') AS title,
+           snippet(video_fts, 1, '{_OPEN}', '{_CLOSE}', '…', 24) AS snippet
+    FROM video_fts
+    JOIN video ON video.id = video_fts.rowid
+    WHERE video_fts MATCH :query AND video.status = 'ready'
+    ORDER BY video_fts.rank
+    LIMIT :limit OFFSET :offset
+""")
+
+
+def create_index(connection):
+    for statement in CREATE_STATEMENTS:
+        connection.execute(text(statement))
+
+
+def drop_index(connection):
+    for statement in DROP_STATEMENTS:
+        connection.execute(text(statement))
+
+
+def rebuild_index(connection):
+    """Re-read every row of ``video`` into the index, e.g. after a bulk load."""
+    connection.execute(text("INSERT INTO video_fts(video_fts) VALUES ('rebuild')"))
+
+
+def build_match_query(user_query):
+    """Turn free text into an FTS5 query that can never be a syntax error.
+
+    Every word becomes a quoted term and all terms must match. Words of
+    MIN_PREFIX_LENGTH or more characters also match as prefixes, so typing
+    ``intro pyth`` finds "Introduction to Python"; shorter ones would expand
+    to a large share of the vocabulary and make ranking slow.
+    """
+    terms = re.findall(r'\w+', user_query)
+    return ' '.join(f'"{term}"*' if len(term) >= MIN_PREFIX_LENGTH else f'"{term}"' for term in terms)
+
+
+def _highlight(value):
+    if value is None:
+        return None
+    return Markup(str(escape(value)).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>'))
+
+
+def search_videos(connection, user_query, limit, offset=0):
+    """Return ``[(video_id, title_html, snippet_html), ...]`` for ready videos, best match first."""
+    match = build_match_query(user_query)
+    if not match:
+        return []
+    rows = connection.execute(SEARCH_SQL, {'query': match, 'limit': limit, 'offset': offset})
+    return [(row.rowid, _highlight(row.title), _highlight(row.snippet)) for row in rows]
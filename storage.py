@@ -0,0 +1,348 @@
+"""Content-addressed video storage.
+
+Blobs are named ``<digest>.<ext>`` inside the upload folder, so identical
+uploads share one file and a blob name never refers to different bytes.
+
+The digest is a hash tree rather than a plain sha256 of the file: the
+sha256 of the concatenated sha256 digests of each HASH_BLOCK_SIZE block
+(the scheme Dropbox uses for ``content_hash``). Block digests can be
+computed independently, so chunks of a resumable upload are hashed as they
+stream in, in whatever order they arrive, without a second read pass.
+
+Where blobs live is up to a store. ``LocalStore`` keeps them in one
+directory. ``CachedStore`` keeps them on a slower, cheaper tier, with a
+size-bounded LRU cache directory on fast disk in front of it. The cache
+reads through on a miss, since serving needs a local file (for sendfile,
+mmap and probing). ``DirectoryTier`` is the slow tier: it stands in for
+an object store, with a directory on another volume in place of a
+bucket. Another tier only needs its methods.
+"""
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from werkzeug.security import safe_join
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+COPY_BUFFER_SIZE = 64 * 1024
+_BLOB_NAME = re.compile(r'^([0-9a-f]{64})(\.[a-z0-9]+)?$')
+
+
+class BlockHasher:
+    """Incrementally collects the per-block digests of a byte stream."""
+
+    def __init__(self, block_size=None):
+        self.block_size = block_size or HASH_BLOCK_SIZE
+        self.block_digests = []
+        self.size = 0
+        self._block = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.block_size - self._filled)
+            self._block.update(view[:take])
+            self._filled += take
+            self.size += take
+            view = view[take:]
+            if self._filled == self.block_size:
+                self._finish_block()
+
+    def _finish_block(self):
+        self.block_digests.append(self._block.digest())
+        self._block = hashlib.sha256()
+        self._filled = 0
+
+    def digests(self):
+        """Digests of all blocks seen so far, including a trailing partial block."""
+        if self._filled:
+            self._finish_block()
+        return b''.join(self.block_digests)
+
+    def hexdigest(self):
+        return combine_block_digests(self.digests())
+
+
+def combine_block_digests(block_digests):
+    return hashlib.sha256(block_digests).hexdigest()
+
+
+def hash_file(path, block_size=None):
+    hasher = BlockHasher(block_size)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            hasher.update(block)
+    return hasher
+
+
+def copy_and_hash(stream, path, block_size=None):
+    """Write ``stream`` to ``path`` and hash it in the same pass."""
+    hasher = BlockHasher(block_size)
+    with open(path, 'wb') as f:
+        for block in iter(lambda: stream.read(COPY_BUFFER_SIZE), b''):
+            hasher.update(block)
+            f.write(block)
+    return hasher
+
+
+def blob_name(digest, filename):
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    return f'{digest}.{ext}' if ext else digest
+
+
+def digest_from_blob_name(name):
+    """Return the digest a blob name was derived from, or None for legacy names."""
+    match = _BLOB_NAME.match(name)
+    return match.group(1) if match else None
+
+
+def commit_blob(temp_path, folder, name):
+    """Move a fully written temp file into place under its content address.
+
+    Returns True if the blob was new. When identical content is already
+    stored the temp file is dropped and the existing blob is reused; its
+    inode and mtime stay put, so cached validators remain valid.
+    """
+    final_path = os.path.join(folder, name)
+    if os.path.exists(final_path):
+        os.remove(temp_path)
+        return False
+    os.replace(temp_path, final_path)
+    return True
+
+
+class LocalStore:
+    """Blobs as files in one local directory."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def put(self, temp_path, name):
+        """Move the temp file in as blob ``name``; returns True if the blob was new."""
+        os.makedirs(self.folder, exist_ok=True)
+        return commit_blob(temp_path, self.folder, name)
+
+    def local_path(self, name):
+        """Path of a local file holding blob ``name``, or None if there is none."""
+        path = safe_join(self.folder, name)
+        return path if path is not None and os.path.isfile(path) else None
+
+    def exists(self, name):
+        return self.local_path(name) is not None
+
+    def delete(self, name):
+        path = self.local_path(name)
+        if path is None:
+            return False
+        os.remove(path)
+        return True
+
+    def names(self):
+        return [entry.name for entry in _scan(self.folder)]
+
+    def stats(self):
+        return {}
+
+
+def _scan(folder):
+    # Blob files only: temp files and the partial upload folder start with a dot
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return []
+    return [entry for entry in entries if not entry.name.startswith('.') and entry.is_file()]
+
+
+class DirectoryTier:
+    """A slow storage tier with object-store semantics, kept in a directory.
+
+    Blobs are copied in and out whole and never served in place. The
+    directory is usually on another volume, so writes are copies that are
+    renamed into place once complete.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, name):
+        path = safe_join(self.folder, name)
+        if path is None:
+            raise ValueError(f'Invalid blob name {name!r}')
+        return path
+
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
+
+    def upload(self, path, name):
+        """Copy the file at ``path`` in as ``name``; returns False if it was already there."""
+        destination = self._path(name)
+        if os.path.exists(destination):
+            return False
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path = os.path.join(self.folder, f'.upload-{uuid.uuid4().hex}')
+        try:
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, destination)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return True
+
+    def download(self, name, destination):
+        """Copy blob ``name`` to ``destination``; raises FileNotFoundError if it is missing."""
+        shutil.copyfile(self._path(name), destination)
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def names(self):
+        return [entry.name for entry in _scan(self.folder)]
+
+
+class CachedStore:
+    """Blobs kept on ``tier``, read through an LRU cache in ``folder`` of at most ``max_bytes``.
+
+    Recency is the cached file's atime, refreshed explicitly on each hit, so
+    every worker sharing the folder evicts by the same order. mtime is left
+    alone because it is the file's Last-Modified. A file evicted while it is
+    being served stays readable until it is closed.
+
+    The folder's size is kept as a running total, so only a put or fetch
+    that takes it over ``max_bytes`` scans the folder. The total is re-read
+    from a scan every RESYNC_INTERVAL seconds, to pick up files other
+    workers sharing the folder added or evicted.
+    """
+
+    TOUCH_INTERVAL = 60 # Seconds; hits closer together than this skip the utime call
+    RESYNC_INTERVAL = 300 # Seconds between scans when the running total says there is room
+
+    def __init__(self, tier, folder, max_bytes, clock=time.monotonic):
+        self.tier = tier
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._total = None # Bytes in the folder; None until the first scan
+        self._synced = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.fetched_bytes = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def local_path(self, name):
+        path = safe_join(self.folder, name)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return self._fetch(name, path)
+        now = time.time()
+        if stat.st_atime < now - self.TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, stat.st_mtime))
+            except FileNotFoundError:
+                return self._fetch(name, path) # Evicted in between
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def _fetch(self, name, path):
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path = os.path.join(self.folder, f'.fetch-{uuid.uuid4().hex}')
+        try:
+            self.tier.download(name, temp_path)
+        except FileNotFoundError:
+            return None
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path) # A concurrent fetch of the same blob wrote the same bytes
+        with self._lock:
+            self.misses += 1
+            self.fetched_bytes += size
+        self._account(size)
+        self.evict(keep=name)
+        return path
+
+    def put(self, temp_path, name):
+        new = self.tier.upload(temp_path, name)
+        # A fresh upload is about to be processed and watched; keep it cached
+        os.makedirs(self.folder, exist_ok=True)
+        size = os.path.getsize(temp_path)
+        if commit_blob(temp_path, self.folder, name):
+            self._account(size)
+        self.evict(keep=name)
+        return new
+
+    def exists(self, name):
+        path = safe_join(self.folder, name)
+        return (path is not None and os.path.isfile(path)) or self.tier.exists(name)
+
+    def delete(self, name):
+        path = safe_join(self.folder, name)
+        if path is not None and os.path.isfile(path):
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._account(-size)
+        return self.tier.delete(name)
+
+    def names(self):
+        return self.tier.names()
+
+    def _account(self, delta):
+        with self._lock:
+            if self._total is not None:
+                self._total += delta
+
+    def evict(self, keep=None):
+        """Delete least recently used cache files until the folder fits in ``max_bytes``.
+
+        Returns the folder's size in bytes, as last scanned or tracked since.
+        """
+        with self._lock:
+            if (self._total is not None and self._total <= self.max_bytes
+                    and self.clock() - self._synced < self.RESYNC_INTERVAL):
+                return self._total
+        files = []
+        for entry in _scan(self.folder):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_atime, entry.name, stat.st_size))
+        total = sum(size for _, _, size in files)
+        for _, name, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass # Another worker evicted it first
+            total -= size
+            with self._lock:
+                self.evictions += 1
+                self.evicted_bytes += size
+        with self._lock:
+            self._total = total
+            self._synced = self.clock()
+        return total
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'fetched_bytes': self.fetched_bytes,
+                    'evictions': self.evictions, 'evicted_bytes': self.evicted_bytes}
@@ -0,0 +1,311 @@
+"""HTTP delivery of video files: byte ranges, validators and zero-copy transfer."""
+import mimetypes
+import mmap
+import os
+import secrets
+
+from flask import Response, current_app, request
+from werkzeug.exceptions import NotFound
+from werkzeug.http import http_date, unquote_etag
+from werkzeug.wsgi import wrap_file
+
+VIDEO_MIME_TYPES = {
+    'mp4': 'video/mp4',
+    'mov': 'video/quicktime',
+    'avi': 'video/x-msvideo',
+    'mkv': 'video/x-matroska',
+}
+BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    """None of the requested byte ranges overlap the file."""
+
+
+def video_mimetype(filename):
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext in VIDEO_MIME_TYPES:
+        return VIDEO_MIME_TYPES[ext]
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def file_etag(stat):
+    # inode, size and mtime change whenever the file is replaced or rewritten,
+    # which makes this a strong validator for an on-disk file.
+    return f'{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+
+def parse_byte_ranges(header, size, max_ranges=DEFAULT_MAX_RANGES):
+    """Turn a ``Range`` header into a sorted list of ``(start, stop)`` pairs.
+
+    ``stop`` is exclusive. Returns ``None`` when the header is absent or
+    malformed (the caller then sends the full file, as RFC 9110 allows).
+    Overlapping and adjacent ranges are coalesced so a client cannot make us
+    send the same bytes twice.
+    """
+    units, _, spec = (header or '').partition('=')
+    if units.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    # werkzeug's parser rejects overlapping or out-of-order ranges, which RFC
+    # 9110 permits, so the byte-range-set is parsed here.
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = (p.strip() for p in part.partition('-'))
+        if not dash or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            if not last:
+                return None
+            start, stop = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            stop = min(int(last) + 1, size) if last else size
+        if start < stop:
+            ranges.append((start, stop))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, stop in ranges[1:]:
+        last_start, last_stop = merged[-1]
+        if start <= last_stop:
+            merged[-1] = (last_start, max(last_stop, stop))
+        else:
+            merged.append((start, stop))
+    if len(merged) > max_ranges:
+        raise RangeNotSatisfiable()
+    return merged
+
+
+class FileSlice:
+    """A read-only window onto an open file.
+
+    It keeps ``fileno()`` so WSGI servers with sendfile support (gunicorn's
+    ``wsgi.file_wrapper``) can transfer the window straight from the page
+    cache; they start at the current offset and stop at Content-Length.
+    Servers without sendfile iterate ``read()``, which stops at the window end.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class MeteredFile:
+    """A FileSlice read on behalf of a throttled client.
+
+    Every block read is charged to ``ticket``, which may pause until the
+    client's byte bucket allows it. There is no ``fileno``, so servers cannot
+    sendfile around the charge. Closing also closes the ticket.
+    """
+
+    def __init__(self, file, ticket):
+        self.file = file
+        self.ticket = ticket
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if data and self.ticket.meters_reads:
+            self.ticket.charge(len(data))
+        return data
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.ticket.close()
+
+
+class TicketedFile(FileSlice):
+    """A FileSlice that closes ``ticket`` with itself; sendfile still applies."""
+
+    def __init__(self, file, start, length, ticket):
+        super().__init__(file, start, length)
+        self.ticket = ticket
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.ticket.close()
+
+
+class MeteredBody:
+    """A multipart body iterated on behalf of a throttled client.
+
+    Like ``MeteredFile``, it charges each block to ``ticket`` and closes the
+    ticket with itself, even if it is closed before the first block.
+    """
+
+    def __init__(self, body, ticket):
+        self.body = body
+        self.ticket = ticket
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        block = next(self.body)
+        if self.ticket.meters_reads:
+            self.ticket.charge(len(block))
+        return block
+
+    def close(self):
+        try:
+            self.body.close()
+        finally:
+            self.ticket.close()
+
+
+def _multipart_body(path, ranges, part_headers, closing, use_mmap):
+    with open(path, 'rb') as f:
+        # Slicing the mapping copies straight out of the page cache, without a
+        # seek/read syscall pair per block. WSGI requires bytes, not views.
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap else None
+        try:
+            for (start, stop), head in zip(ranges, part_headers):
+                yield head
+                pos = start
+                while pos < stop:
+                    end = min(pos + BLOCK_SIZE, stop)
+                    if mm is not None:
+                        yield mm[pos:end]
+                    else:
+                        f.seek(pos)
+                        yield f.read(end - pos)
+                    pos = end
+            yield closing
+        finally:
+            if mm is not None:
+                mm.close()
+
+
+def _not_modified(etag, mtime):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+
+def _if_range_matches(etag, mtime):
+    if_range = request.if_range
+    if if_range.etag is not None:
+        # If-Range needs a strong match; werkzeug's parser drops the W/ prefix
+        is_weak = unquote_etag(request.headers['If-Range'])[1]
+        return not is_weak and if_range.etag == etag
+    if if_range.date is not None:
+        return int(mtime) == int(if_range.date.timestamp())
+    return True
+
+
+def send_video_path(path, etag=None, immutable=False, ticket=None, refetch=None):
+    """Serve the file at ``path`` with Range and conditional GET support.
+
+    ``path`` must already be known to be safe to serve. ``etag`` overrides
+    the stat-based validator, e.g. with a content digest. ``immutable`` lets
+    clients cache the file for a year without revalidating. ``ticket`` (a
+    ``throttle.Ticket``) is closed when the body is, and its byte bucket is
+    charged as the body is read. If the file is gone before it is opened,
+    e.g. evicted from a cache, ``refetch()`` is asked once for a new path;
+    without one, or if it returns None, the response is a 404.
+    """
+    try:
+        try:
+            response = _video_response(path, etag, immutable, ticket)
+        except FileNotFoundError:
+            path = refetch() if refetch is not None else None
+            if path is None:
+                raise NotFound()
+            response = _video_response(path, etag, immutable, ticket)
+    except BaseException:
+        if ticket is not None:
+            ticket.close()
+        raise
+    if ticket is not None and not response.response:
+        ticket.close() # No body to stream: 304, 416
+    return response
+
+
+def _video_response(path, etag, immutable, ticket):
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = etag or file_etag(stat)
+    mimetype = video_mimetype(os.path.basename(path))
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': 'private, max-age=31536000, immutable' if immutable else 'private, no-cache',
+    }
+    if _not_modified(etag, stat.st_mtime):
+        return Response(status=304, headers=headers)
+
+    ranges = None
+    if 'Range' in request.headers and _if_range_matches(etag, stat.st_mtime):
+        max_ranges = current_app.config.get('VIDEO_MAX_RANGES', DEFAULT_MAX_RANGES)
+        try:
+            ranges = parse_byte_ranges(request.headers['Range'], size, max_ranges)
+        except RangeNotSatisfiable:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+
+    if ranges is None or len(ranges) == 1:
+        start, stop = ranges[0] if ranges else (0, size)
+        if ticket is None:
+            window = FileSlice(open(path, 'rb'), start, stop - start)
+        elif ticket.meters_reads:
+            window = MeteredFile(FileSlice(open(path, 'rb'), start, stop - start), ticket)
+        else:
+            window = TicketedFile(open(path, 'rb'), start, stop - start, ticket)
+        body = wrap_file(request.environ, window, BLOCK_SIZE)
+        response = Response(body, status=206 if ranges else 200, mimetype=mimetype,
+                            headers=headers, direct_passthrough=True)
+        response.content_length = stop - start
+        if ranges:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        return response
+
+    boundary = secrets.token_hex(16)
+    part_headers = [
+        (f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+         f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode('latin-1')
+        for start, stop in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    length = sum(len(h) for h in part_headers) + sum(stop - start for start, stop in ranges) + len(closing)
+    use_mmap = current_app.config.get('VIDEO_USE_MMAP', True)
+    body = _multipart_body(path, ranges, part_headers, closing, use_mmap)
+    if ticket is not None:
+        body = MeteredBody(body, ticket)
+    response = Response(body, status=206,
+                        content_type=f'multipart/byteranges; boundary={boundary}',
+                        headers=headers, direct_passthrough=True)
+    response.content_length = length
+    return response
@@ -1,32 +1,39 @@
 import pytest
 import os
 import tempfile
-from app import app as flask_app, db, User, Video
+from app import create_app, db, User, Video
 from werkzeug.security import generate_password_hash
+from sqlalchemy import event
 
 @pytest.fixture(scope='module')
 def app():
     """Instance of Main flask app"""
-    flask_app.config['TESTING'] = True
-    flask_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    flask_app.config['WTF_CSRF_ENABLED'] = False  # Disable CSRF for testing forms
-    flask_app.config['SECRET_KEY'] = 'test-secret-key' 
-
     # Create a temporary folder for uploads during tests
     temp_upload_folder = tempfile.mkdtemp()
-    flask_app.config['UPLOAD_FOLDER'] = temp_upload_folder
-    
+    temp_build_folder = tempfile.mkdtemp()
+    flask_app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'WTF_CSRF_ENABLED': False,  # Disable CSRF for testing forms
+        'SECRET_KEY': 'test-secret-key',
+        'PASSWORD_HASH_METHOD': 'scrypt', # What the users below are hashed with; no rehash on login
+        'UPLOAD_FOLDER': temp_upload_folder,
+        'TEMPLATE_CACHE_DIR': None,
+        'STATIC_BUILD_DIR': temp_build_folder,
+    })
+
     with flask_app.app_context():
         db.create_all()
         yield flask_app
         db.drop_all()
-        # Clean up the temporary upload folder
-        for root, dirs, files in os.walk(temp_upload_folder, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(temp_upload_folder)
+        # Clean up the temporary upload and static build folders
+        for folder in (temp_upload_folder, temp_build_folder):
+            for root, dirs, files in os.walk(folder, topdown=False):
+                for name in files:
+                    os.remove(os.path.join(root, name))
+                for name in dirs:
+                    os.rmdir(os.path.join(root, name))
+            os.rmdir(folder)
 
 
 @pytest.fixture(scope='module')
@@ -82,3 +89,12 @@ def login(client, email, password):
 # Helper function to log out a user
 def logout(client):
     return client.get('/logout', follow_redirects=True)
+
+# Helper to record the SQL statements the app runs; call the returned function to stop
+def count_queries(app):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return statements, lambda: event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
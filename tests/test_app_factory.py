@@ -0,0 +1,120 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import database
+from werkzeug.security import generate_password_hash
+from app import User, create_app, db
+from tests.conftest import login
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Starts the app in a fresh interpreter, as a new worker would. Reports how
+# long import, create_app() and the first request took, how many SQL statements
+# ran before the request, and how many templates the request loaded compiled
+# from the shared cache. With "eager" it also creates and checks the schema
+# before the request, as app.py did at import before it had a factory.
+STARTUP_SCRIPT = '''
+import json, os, sys, time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+workdir, eager = sys.argv[1], sys.argv[2] == 'eager'
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+started = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+application = module.create_app()
+if eager:
+    with application.app_context():
+        module.db.create_all()
+        module.ensure_schema()
+created = time.perf_counter()
+startup_statements = len(statements)
+before_request = sorted(os.listdir(workdir))
+cache = application.jinja_env.bytecode_cache
+loaded = []
+load_bytecode = cache.load_bytecode
+def counting_load(bucket):
+    load_bytecode(bucket)
+    loaded.append(bucket.code is not None)
+cache.load_bytecode = counting_load
+response = application.test_client().get('/login')
+served = time.perf_counter()
+print(json.dumps({
+    'import': imported - started, 'create_app': created - imported, 'first_request': served - created,
+    'startup_statements': startup_statements, 'status': response.status_code,
+    'files_before_request': before_request, 'templates': len(loaded), 'templates_from_cache': sum(loaded),
+}))
+'''
+
+def start_worker(workdir, mode='lazy'):
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{workdir / 'site.db'}",
+               LEARNAI_SECRET_KEY_FILE=str(workdir / 'secret_key'),
+               LEARNAI_TEMPLATE_CACHE_DIR=str(workdir / 'template-cache'),
+               LEARNAI_STATIC_BUILD_DIR=str(workdir / 'static-build'),
+               LEARNAI_UPLOAD_FOLDER=str(workdir / 'videos'))
+    output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, str(workdir), mode], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+def test_startup_defers_database_work_to_first_request(tmp_path):
+    (tmp_path / 'lazy').mkdir()
+    (tmp_path / 'eager').mkdir()
+    cold = start_worker(tmp_path / 'lazy')
+    warm = start_worker(tmp_path / 'lazy')
+    eager = start_worker(tmp_path / 'eager', 'eager')
+    for label, timings in (('cold', cold), ('warm', warm), ('eager', eager)):
+        print(f"{label} start: import {timings['import'] * 1000:.1f} ms, create_app {timings['create_app'] * 1000:.1f} ms, "
+              f"first request {timings['first_request'] * 1000:.1f} ms")
+    assert cold['status'] == warm['status'] == eager['status'] == 200
+    # Importing and building the app ran no SQL and only created the secret key
+    # and the cache directory: no database and no upload folder until the first request
+    assert cold['startup_statements'] == 0 and eager['startup_statements'] > 0
+    assert cold['files_before_request'] == ['secret_key', 'template-cache']
+    assert 'site.db' in eager['files_before_request']
+    # Both import the same modules, so compare the work after import, which for the
+    # eager worker includes the schema (import time alone varies by more than that)
+    assert min(cold['create_app'], warm['create_app']) < eager['create_app']
+    connection = sqlite3.connect(tmp_path / 'lazy' / 'site.db')
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == len(database.MIGRATIONS)
+    connection.close()
+    # The first worker compiled its templates; the second loaded every one of them instead
+    assert cold['templates'] > 0 and cold['templates_from_cache'] == 0
+    assert warm['templates_from_cache'] == warm['templates'] == cold['templates']
+    assert 'site.db' in warm['files_before_request']
+
+def test_workers_share_a_persistent_secret_key(tmp_path):
+    config = {'TESTING': True, 'WTF_CSRF_ENABLED': False, 'TEMPLATE_CACHE_DIR': None,
+              'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'site.db'}",
+              'STATIC_BUILD_DIR': str(tmp_path / 'static-build'),
+              'SECRET_KEY_FILE': str(tmp_path / 'keys' / 'secret_key')}
+    first, second = create_app(config), create_app(config)
+    assert len(first.secret_key) == 32 and first.secret_key == second.secret_key
+    assert os.stat(tmp_path / 'keys' / 'secret_key').st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path / 'keys') == ['secret_key']
+    with first.app_context():
+        db.create_all()
+        db.session.add(User(username='testuser', email='test@example.com',
+                            password_hash=generate_password_hash('password123')))
+        db.session.commit()
+
+    # A session signed by one worker is accepted by the other
+    client = first.test_client()
+    login(client, 'test@example.com', 'password123')
+    other = second.test_client()
+    other.set_cookie('session', client.get_cookie('session').value)
+    assert other.get('/videos').status_code == 200
+
+def test_config_comes_from_defaults_env_then_argument(monkeypatch):
+    monkeypatch.setenv('LEARNAI_VIDEOS_PER_PAGE', '5')
+    monkeypatch.setenv('LEARNAI_PAGE_CACHE_ENABLED', 'false')
+    monkeypatch.setenv('LEARNAI_SECRET_KEY', 'from-env')
+    flask_app = create_app({'VIDEOS_PER_PAGE': 7, 'TEMPLATE_CACHE_DIR': None})
+    assert flask_app.config['VIDEOS_PER_PAGE'] == 7
+    assert flask_app.config['PAGE_CACHE_ENABLED'] is False
+    assert flask_app.secret_key == 'from-env'
+    assert flask_app.config['SEARCH_MAX_PAGE'] == 50
+    assert flask_app.jinja_env.bytecode_cache is None
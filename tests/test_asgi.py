@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import throttle
+from asgi import VideoStreamer
+from tests.conftest import login
+
+CONTENT = bytes(range(256)) * 1024 # 256 KiB
+
+async def request(streamer, path, headers=(), method='GET', hold=None):
+    """Run one request through ``streamer``; returns (status, headers, body)."""
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+             'headers': [(name.lower().encode(), value.encode()) for name, value in headers],
+             'server': ('testserver', 80), 'scheme': 'http', 'http_version': '1.1', 'root_path': ''}
+    received = asyncio.Event()
+    messages = []
+
+    async def receive():
+        if not received.is_set():
+            received.set()
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await asyncio.Event().wait() # The client stays connected
+    async def send(message):
+        messages.append(message)
+        if hold is not None and message['type'] == 'http.response.body':
+            await hold.wait()
+
+    await streamer(scope, receive, send)
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, body
+
+@pytest.fixture
+def video_file(app):
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'stream.mp4')
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+    yield 'stream.mp4'
+    os.remove(path)
+
+@pytest.fixture
+def session_cookie(client, new_user_id):
+    login(client, 'test@example.com', 'password123')
+    return ('Cookie', f"session={client.get_cookie('session').value}")
+
+def test_streams_file_with_session_auth(app, video_file, session_cookie):
+    streamer = VideoStreamer(app)
+    streamer.chunk_size = 64 * 1024
+    status, headers, body = asyncio.run(request(streamer, f'/uploads/videos/{video_file}', [session_cookie]))
+    assert status == 200
+    assert body == CONTENT
+    assert headers['content-length'] == str(len(CONTENT))
+    assert headers['accept-ranges'] == 'bytes'
+
+    status, headers, _ = asyncio.run(request(streamer, f'/uploads/videos/{video_file}'))
+    assert status == 302 and '/login' in headers['location']
+    assert asyncio.run(request(streamer, '/videos', [session_cookie]))[0] == 404
+    assert streamer.active == 0
+
+def test_range_and_multipart_ranges(app, video_file, session_cookie):
+    streamer = VideoStreamer(app)
+    status, headers, body = asyncio.run(request(
+        streamer, f'/uploads/videos/{video_file}', [session_cookie, ('Range', 'bytes=1000-1999')]))
+    assert status == 206
+    assert headers['content-range'] == f'bytes 1000-1999/{len(CONTENT)}'
+    assert body == CONTENT[1000:2000]
+
+    status, headers, body = asyncio.run(request(
+        streamer, f'/uploads/videos/{video_file}', [session_cookie, ('Range', 'bytes=0-9,-10')]))
+    assert status == 206 and headers['content-type'].startswith('multipart/byteranges')
+    assert CONTENT[:10] in body and CONTENT[-10:] in body
+    assert len(body) == int(headers['content-length'])
+
+    status, _, body = asyncio.run(request(streamer, f'/uploads/videos/{video_file}', [session_cookie], method='HEAD'))
+    assert status == 200 and body == b''
+
+def test_per_connection_rate_limit(app, video_file, session_cookie):
+    streamer = VideoStreamer(app)
+    streamer.chunk_size = 32 * 1024
+    streamer.rate_limit = 1024 * 1024
+    started = time.perf_counter()
+    status, _, body = asyncio.run(request(streamer, f'/uploads/videos/{video_file}', [session_cookie]))
+    assert status == 200 and body == CONTENT
+    assert time.perf_counter() - started >= 0.2 # 256 KiB at 1 MiB/s
+
+def test_global_connection_limit(app, video_file, session_cookie):
+    streamer = VideoStreamer(app)
+    streamer.max_connections = 1
+
+    async def scenario():
+        hold = asyncio.Event()
+        first = asyncio.ensure_future(request(streamer, f'/uploads/videos/{video_file}', [session_cookie], hold=hold))
+        while streamer.active == 0:
+            await asyncio.sleep(0.01)
+        second = await request(streamer, f'/uploads/videos/{video_file}', [session_cookie])
+        hold.set()
+        return await first, second
+
+    first, second = asyncio.run(scenario())
+    assert first[0] == 200 and first[2] == CONTENT
+    assert second[0] == 503 and second[1]['retry-after'] == '1'
+    assert streamer.rejected == 1 and streamer.active == 0
+
+def test_throttled_streams_wait_in_the_event_loop(app, video_file, session_cookie, monkeypatch):
+    slept = []
+    admission = throttle.Admission({'viewer': {'bytes_per_second': 512 * 1024, 'byte_burst': 64 * 1024}},
+                                   max_streams=1, queue_timeout=0.1, sleep=slept.append)
+    monkeypatch.setitem(app.extensions, 'admission', admission)
+    streamer = VideoStreamer(app)
+    streamer.chunk_size = 32 * 1024
+    streamer.executor = ThreadPoolExecutor(1) # Any thread held by a waiting stream would stall the rest
+    path = f'/uploads/videos/{video_file}'
+
+    async def scenario():
+        finished = []
+        async def timed(name, *args, **kwargs):
+            result = await request(streamer, *args, **kwargs)
+            finished.append(name)
+            return result
+        first = asyncio.ensure_future(timed('paced', path, [session_cookie]))
+        while admission.active == 0:
+            await asyncio.sleep(0.01)
+        head, queued = await asyncio.gather(timed('head', path, [session_cookie], method='HEAD'),
+                                            timed('queued', path, [session_cookie]))
+        return await first, head, queued, finished
+
+    started = time.perf_counter()
+    first, head, queued, finished = asyncio.run(scenario())
+    streamer.executor.shutdown()
+    assert first[0] == 200 and first[2] == CONTENT
+    assert time.perf_counter() - started >= 0.3 # 192 KiB past the burst at 512 KiB/s
+    assert head[0] == 200 and queued[0] == 429 and queued[1]['retry-after'] == '1'
+    assert finished[-1] == 'paced' # The other two were served while it was paced
+    assert admission.rejected['streams'] == 1 and admission.active == 0 and slept == []
@@ -0,0 +1,68 @@
+import gzip
+import os
+import re
+import assets
+from tests.conftest import login
+
+GZIP = {'Accept-Encoding': 'gzip, deflate'}
+
+def stylesheet_url(client):
+    page = client.get('/login').get_data(as_text=True)
+    return re.search(r'href="(/static/css/style\.[0-9a-f]{12}\.css)"', page).group(1)
+
+def test_pages_link_fingerprinted_assets(app, client):
+    url = stylesheet_url(client)
+    source = open(os.path.join(app.root_path, 'static', 'css', 'style.css'), 'rb').read()
+
+    response = client.get(url)
+    assert response.data == source
+    assert response.headers['Cache-Control'] == assets.IMMUTABLE
+    assert response.mimetype == 'text/css' and 'Accept-Encoding' in response.vary
+    assert 'Content-Encoding' not in response.headers
+
+    response = client.get(url, headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == source
+    assert response.headers['Cache-Control'] == assets.IMMUTABLE
+
+    # The plain name still works but must be revalidated
+    response = client.get('/static/css/style.css')
+    assert response.data == source and 'immutable' not in response.headers.get('Cache-Control', '')
+    assert client.get('/static/css/style.000000000000.css').status_code == 404
+
+def test_manifest_follows_content(tmp_path):
+    source = tmp_path / 'static'
+    (source / 'js').mkdir(parents=True)
+    (source / 'js' / 'app.js').write_text('console.log(1);')
+    (source / 'logo.png').write_bytes(b'\x89PNG')
+    first = assets.AssetManifest(str(source), str(tmp_path / 'build')).build()
+    built = first.url_name('js/app.js')
+    assert re.fullmatch(r'js/app\.[0-9a-f]{12}\.js', built)
+    assert os.path.exists(tmp_path / 'build' / (built + '.gz'))
+    assert first.files[first.url_name('logo.png')][1] is None # Already compressed formats are left alone
+
+    (source / 'js' / 'app.js').write_text('console.log(2);')
+    assert assets.AssetManifest(str(source), str(tmp_path / 'build')).build().url_name('js/app.js') != built
+
+def test_html_is_gzipped_on_the_fly(client, new_user_id):
+    login(client, 'test@example.com', 'password123')
+    plain = client.get('/videos')
+    assert 'Content-Encoding' not in plain.headers and 'Accept-Encoding' in plain.vary
+    response = client.get('/videos', headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == plain.data
+    assert int(response.headers['Content-Length']) == len(response.data) < len(plain.data)
+    assert 'Content-Encoding' not in client.get('/videos', headers={'Accept-Encoding': 'gzip;q=0'}).headers
+
+def test_videos_are_never_compressed(app, client, new_user_id):
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'plain.mp4'), 'wb') as f:
+        f.write(b'\0' * 4096)
+    login(client, 'test@example.com', 'password123')
+    response = client.get('/uploads/videos/plain.mp4', headers=GZIP)
+    assert response.status_code == 200 and response.data == b'\0' * 4096
+    assert 'Content-Encoding' not in response.headers
+
+def test_build_assets_command(app):
+    result = app.test_cli_runner().invoke(args=['build-assets'])
+    assert result.exit_code == 0, result.output
+    assert re.search(r'css/style\.css -> css/style\.[0-9a-f]{12}\.css', result.output)
@@ -1,6 +1,6 @@
 import pytest
-from app import User, db
-from tests.conftest import login, logout # Import helper functions
+from app import User, db, load_user
+from tests.conftest import login, logout, count_queries # Import helper functions
 
 def test_register_success(client, init_database):
     response = client.post('/register', data=dict(
@@ -97,3 +97,25 @@ def test_login_required_for_view_video(client, init_database):
     assert response.status_code == 200
     assert b"Login" in response.data
     assert b"Please log in to access this page" in response.data
+
+def test_identity_cache_skips_user_lookup(app, new_user_id):
+    with app.test_request_context():
+        assert load_user(str(new_user_id)).username == 'testuser'
+        statements, stop = count_queries(app)
+        try:
+            identity = load_user(str(new_user_id))
+        finally:
+            stop()
+    assert identity.id == new_user_id
+    assert statements == []
+
+def test_identity_cache_invalidated_when_user_changes(app, new_user_id):
+    with app.test_request_context():
+        assert load_user(str(new_user_id)).is_editor is False
+        db.session.get(User, new_user_id).is_editor = True
+        db.session.commit()
+        assert load_user(str(new_user_id)).is_editor is True # Promoted without logging in again
+
+        db.session.delete(db.session.get(User, new_user_id))
+        db.session.commit()
+        assert load_user(str(new_user_id)) is None
@@ -0,0 +1,18 @@
+from benchmarks.loadgen import percentile
+from benchmarks.run import compare
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.95) == 7
+    assert percentile([], 0.5) is None
+
+def test_compare_flags_only_regressions_beyond_tolerance():
+    baseline = {'endpoints': {'video_list': {'throughput_rps': 100.0, 'p95_ms': 10.0, 'peak_rss_mb': 80.0}},
+                'micro': {'block_hash_1mb': {'ops_per_sec': 1000.0}}}
+    results = {'endpoints': {'video_list': {'throughput_rps': 70.0, 'p95_ms': 11.0, 'peak_rss_mb': 40.0}},
+               'micro': {'block_hash_1mb': {'ops_per_sec': 990.0}}}
+    regressions = compare(results, baseline, tolerance=0.25)
+    assert len(regressions) == 1
+    assert regressions[0].startswith('endpoints/video_list throughput_rps')
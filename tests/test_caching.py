@@ -0,0 +1,79 @@
+import tempfile
+import pytest
+from app import CATALOG_VERSION_SQL, Video, db, get_page_cache
+from caching import PageCache, TTLCache
+from tests.conftest import login
+
+def test_ttl_cache_evicts_least_recently_used_and_expired():
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a') # 'b' is now the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    now[0] = 11
+    assert cache.get('a') is None
+    assert len(cache) == 1 # Only 'c' remains until it is looked up
+
+def test_disk_tier_is_shared_and_invalidated_across_workers():
+    directory = tempfile.mkdtemp()
+    worker_a = PageCache(directory=directory)
+    worker_b = PageCache(directory=directory)
+    renders = []
+    def render():
+        renders.append(1)
+        return '<p>page</p>'
+
+    assert worker_a.get_or_render('list', render) == '<p>page</p>'
+    assert worker_b.get_or_render('list', render) == '<p>page</p>'
+    assert len(renders) == 1
+    assert worker_b.stats()['disk_hits'] == 1
+
+    worker_a.invalidate()
+    worker_b.get_or_render('list', render) # Worker B sees A's new generation
+    assert len(renders) == 2
+    assert worker_b.stats()['misses'] == 1
+
+def test_video_list_cached_until_catalog_changes(client, app, editor_user_id, uploaded_video_id):
+    login(client, 'editor@example.com', 'password123')
+    cache = get_page_cache()
+    client.get('/videos')
+    hits = cache.hits
+    assert b'Test Video' in client.get('/videos').data
+    assert cache.hits == hits + 1
+
+    with app.app_context():
+        db.session.add(Video(title='Fresh Upload', filename='fresh.mp4', user_id=editor_user_id))
+        db.session.commit()
+    assert b'Fresh Upload' in client.get('/videos').data
+
+    with app.app_context():
+        db.session.get(Video, uploaded_video_id).title = 'Renamed Video'
+        db.session.commit()
+    assert b'Renamed Video' in client.get(f'/video/{uploaded_video_id}').data
+
+def test_catalog_changes_from_other_processes_reach_the_cache(client, app, editor_user_id, uploaded_video_id):
+    login(client, 'editor@example.com', 'password123')
+    client.get('/videos')
+    # As `flask run-jobs` would from its own process: the change commits, but
+    # this worker's in-process invalidation never runs
+    with app.app_context(), db.engine.begin() as connection:
+        version = connection.execute(CATALOG_VERSION_SQL).scalar()
+        connection.execute(Video.__table__.update().where(Video.id == uploaded_video_id)
+                           .values(title='Processed Elsewhere', version=version))
+    assert b'Processed Elsewhere' in client.get('/videos').data
+
+def test_page_cache_can_be_disabled(client, app, editor_user_id, uploaded_video_id):
+    login(client, 'editor@example.com', 'password123')
+    cache = get_page_cache()
+    app.config['PAGE_CACHE_ENABLED'] = False
+    try:
+        before = cache.stats()
+        client.get(f'/video/{uploaded_video_id}')
+        client.get(f'/video/{uploaded_video_id}')
+        assert cache.stats()['hits'] == before['hits']
+        assert cache.stats()['misses'] == before['misses']
+    finally:
+        app.config['PAGE_CACHE_ENABLED'] = True
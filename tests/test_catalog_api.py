@@ -0,0 +1,110 @@
+import datetime
+import io
+from app import Video, db, get_dispatcher
+from tests.conftest import login
+
+def add_videos(editor_user_id, count):
+    start = datetime.datetime(2024, 1, 1)
+    videos = [Video(title=f'Lecture {i}', filename=f'lecture{i}.mp4', user_id=editor_user_id,
+                    uploaded_at=start + datetime.timedelta(hours=i)) for i in range(count)]
+    db.session.add_all(videos)
+    db.session.commit()
+    return [video.id for video in videos]
+
+def test_list_pages_and_revalidates(client, editor_user_id):
+    ids = add_videos(editor_user_id, 3)
+    login(client, 'editor@example.com', 'password123')
+    response = client.get('/api/videos?per_page=2')
+    assert response.status_code == 200
+    page = response.get_json()
+    assert [video['id'] for video in page['videos']] == [ids[2], ids[1]]
+    assert page['videos'][0]['uploader'] == 'editoruser'
+    assert page['videos'][0]['url'] == f'/uploads/videos/lecture2.mp4?v={ids[2]}'
+    assert [video['id'] for video in client.get(f"/api/videos?per_page=2&after={page['next']}").get_json()['videos']] == [ids[0]]
+
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    not_modified = client.get('/api/videos?per_page=2', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304 and not_modified.data == b''
+
+    # Any committed change to a video moves the catalog version
+    video = db.session.get(Video, ids[0])
+    video.title = 'Renamed'
+    db.session.commit()
+    response = client.get('/api/videos?per_page=2', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+def test_single_video(client, editor_user_id):
+    ready, processing = add_videos(editor_user_id, 2)
+    db.session.get(Video, processing).status = 'processing'
+    db.session.commit()
+    login(client, 'editor@example.com', 'password123')
+    response = client.get(f'/api/videos/{ready}')
+    assert response.get_json()['title'] == 'Lecture 0'
+    assert client.get(f'/api/videos/{ready}', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get(f'/api/videos/{processing}').status_code == 404
+    assert client.get('/api/videos/99999').status_code == 404
+
+def test_delta_sync_returns_only_changes_since_cursor(client, editor_user_id):
+    first_ids = add_videos(editor_user_id, 3)
+    login(client, 'editor@example.com', 'password123')
+    sync = client.get('/api/videos/changes?limit=2').get_json()
+    assert [video['id'] for video in sync['videos']] == first_ids[:2] and sync['has_more']
+    sync = client.get(f"/api/videos/changes?since={sync['cursor']}&limit=2").get_json()
+    assert [video['id'] for video in sync['videos']] == first_ids[2:] and not sync['has_more']
+    cursor = sync['cursor']
+
+    response = client.get(f'/api/videos/changes?since={cursor}')
+    assert response.get_json() == {'videos': [], 'removed': [], 'cursor': cursor, 'has_more': False}
+    assert client.get(f'/api/videos/changes?since={cursor}',
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    # One new video, one edited and one that failed reprocessing
+    new_id = add_videos(editor_user_id, 1)[0]
+    db.session.get(Video, first_ids[0]).description = 'Updated notes'
+    db.session.get(Video, first_ids[1]).status = 'failed'
+    db.session.commit()
+    sync = client.get(f'/api/videos/changes?since={cursor}').get_json()
+    assert [video['id'] for video in sync['videos']] == [new_id, first_ids[0]]
+    assert sync['videos'][1]['description'] == 'Updated notes'
+    assert sync['removed'] == [first_ids[1]]
+    assert client.get(f"/api/videos/changes?since={sync['cursor']}").get_json()['videos'] == []
+    assert client.get('/api/videos/changes?since=bogus').status_code == 400
+
+def test_delta_sync_lists_deleted_and_reprocessing_videos(client, editor_user_id):
+    kept, deleted, reprocessed = add_videos(editor_user_id, 3)
+    login(client, 'editor@example.com', 'password123')
+    cursor = client.get('/api/videos/changes').get_json()['cursor']
+
+    db.session.delete(db.session.get(Video, deleted))
+    db.session.commit()
+    db.session.get(Video, reprocessed).status = 'processing'
+    db.session.commit()
+    sync = client.get(f'/api/videos/changes?since={cursor}').get_json()
+    assert sync['videos'] == [] and sync['removed'] == [deleted, reprocessed]
+    assert client.get(f"/api/videos/changes?since={sync['cursor']}").get_json()['removed'] == []
+    # Paged like any other change
+    first = client.get(f'/api/videos/changes?since={cursor}&limit=1').get_json()
+    assert first['removed'] == [deleted] and first['has_more']
+    assert client.get(f"/api/videos/changes?since={first['cursor']}").get_json()['removed'] == [reprocessed]
+    assert client.get('/api/videos/changes').get_json()['removed'] == [reprocessed] # No tombstones in a full sync
+
+def test_processed_upload_shows_up_in_delta(client, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    client.post('/upload_video', data={'title': 'Fresh', 'description': '',
+                                       'video_file': (io.BytesIO(b'not an mp4'), 'fresh.avi')},
+                content_type='multipart/form-data')
+    sync = client.get('/api/videos/changes').get_json()
+    assert sync['videos'] == [] # Still processing
+    get_dispatcher().run_inline()
+    db.session.expire_all()
+    sync = client.get(f"/api/videos/changes?since={sync['cursor']}").get_json()
+    assert [video['title'] for video in sync['videos']] == ['Fresh']
+
+def test_imported_videos_get_a_catalog_version(app, client, editor_user_id, tmp_path):
+    (tmp_path / 'intro.mp4').write_bytes(b'intro')
+    result = app.test_cli_runner().invoke(args=['import-videos', str(tmp_path), '--uploader', 'editoruser'])
+    assert result.exit_code == 0, result.output
+    assert Video.query.one().version > 0
+    login(client, 'editor@example.com', 'password123')
+    assert [video['title'] for video in client.get('/api/videos/changes').get_json()['videos']] == ['intro']
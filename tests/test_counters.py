@@ -0,0 +1,94 @@
+import time
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+import counters
+from app import Video, VideoStats, db, get_page_cache, get_view_counter
+from tests.conftest import login
+
+@pytest.fixture
+def counter(app, init_database):
+    counter = get_view_counter()
+    counter.flush()
+    yield counter
+    counter.flush()
+
+def add_videos(editor_user_id, count):
+    videos = [Video(title=f'Lecture {i}', filename=f'lecture{i}.mp4', user_id=editor_user_id) for i in range(count)]
+    db.session.add_all(videos)
+    db.session.commit()
+    return [video.id for video in videos]
+
+def stats(video_id):
+    db.session.expire_all()
+    row = db.session.get(VideoStats, video_id)
+    return (row.views, row.bytes_served) if row else None
+
+def test_views_are_counted_in_memory_and_flushed_in_one_batch(client, app, editor_user_id, counter):
+    first, second = add_videos(editor_user_id, 2)
+    login(client, 'editor@example.com', 'password123')
+    for video_id in (first, first, second):
+        assert client.get(f'/video/{video_id}').status_code == 200
+    assert b'3 views' in client.get(f'/video/{first}').data # Pending counts are shown before a flush
+
+    assert counter.flush() == 2
+    assert stats(first) == (3, 0) and stats(second) == (1, 0)
+    assert counter.pending(first) == (0, 0)
+    assert b'4 views' in client.get(f'/video/{first}').data
+    counter.flush()
+    assert stats(first) == (4, 0)
+
+def test_bytes_served_are_credited_to_the_named_video(client, app, editor_user_id, counter):
+    video_id = add_videos(editor_user_id, 1)[0]
+    with open(f"{app.config['UPLOAD_FOLDER']}/lecture0.mp4", 'wb') as f:
+        f.write(b'x' * 1000)
+    login(client, 'editor@example.com', 'password123')
+    client.get(f'/uploads/videos/lecture0.mp4?v={video_id}', headers={'Range': 'bytes=0-99'})
+    client.get(f'/uploads/videos/lecture0.mp4?v={video_id}')
+    client.get('/uploads/videos/lecture0.mp4') # Not attributed to any video
+    client.get('/uploads/videos/lecture0.mp4?v=99999') # Unknown ids are dropped at flush time
+    assert b'1 view &middot; 1.1 kB served' in client.get(f'/video/{video_id}').data # Before a flush too
+    counter.flush()
+    assert stats(video_id) == (1, 1100)
+    assert stats(99999) is None
+    get_page_cache().invalidate() # The listing's counts are otherwise up to a page cache TTL old
+    assert b'1 view &middot; 1.1 kB served' in client.get('/videos').data
+
+def test_most_viewed_lists_top_videos_from_the_index(client, app, editor_user_id, counter):
+    ids = add_videos(editor_user_id, 4)
+    hidden = Video(title='Still Processing', filename='p.mp4', user_id=editor_user_id, status='processing')
+    db.session.add(hidden)
+    db.session.commit()
+    for video_id, views in zip(ids + [hidden.id], (5, 0, 9, 2, 50)):
+        if views:
+            counter.record(video_id, views=views)
+    counter.flush()
+
+    login(client, 'editor@example.com', 'password123')
+    page = client.get('/videos/popular').data.decode()
+    assert 'Most Viewed' in page
+    positions = [page.index(f'Lecture {i}<') for i in (2, 0, 3)]
+    assert positions == sorted(positions)
+    assert 'Lecture 1<' not in page and 'Still Processing' not in page
+
+    plan = ' '.join(row[-1] for row in db.session.execute(text(
+        'EXPLAIN QUERY PLAN SELECT video_id FROM video_stats ORDER BY views DESC, video_id DESC LIMIT 20')))
+    assert 'ix_video_stats_views' in plan and 'TEMP B-TREE' not in plan
+
+def test_flusher_thread_flushes_when_pending_is_full(app, editor_user_id):
+    video_ids = add_videos(editor_user_id, 3)
+    counter = counters.ViewCounter(db.engine, interval=60, max_pending=3)
+    for video_id in video_ids:
+        counter.record(video_id, views=1)
+    deadline = time.monotonic() + 5
+    while counter.flushes == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert counter.flushes == 1
+    assert [stats(video_id) for video_id in video_ids] == [(1, 0)] * 3
+
+def test_failed_flush_keeps_counts_for_the_next_attempt():
+    counter = counters.ViewCounter(create_engine('sqlite://'), interval=60)
+    counter._pending[7] = [2, 100]
+    with pytest.raises(OperationalError):
+        counter.flush()
+    assert counter.pending(7) == (2, 100)
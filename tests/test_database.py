@@ -0,0 +1,61 @@
+import os
+import tempfile
+import pytest
+from sqlalchemy import create_engine, inspect
+import database
+from app import db
+
+@pytest.fixture
+def engine():
+    path = os.path.join(tempfile.mkdtemp(), 'test.db')
+    engine = create_engine(f'sqlite:///{path}')
+    database.configure_sqlite(engine)
+    yield engine
+    engine.dispose()
+
+def test_migrations_produce_the_model_schema(engine):
+    assert database.migrate(engine) == database.MIGRATIONS[-1][0]
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        migrated = {column['name'] for column in inspector.get_columns(table.name)}
+        assert migrated == {column.name for column in table.columns}, table.name
+        migrated_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        assert {index.name for index in table.indexes} <= migrated_indexes, table.name
+
+def test_migrate_upgrades_legacy_database_in_place(engine):
+    legacy = [migration for migration in database.MIGRATIONS if migration[0] == 1]
+    database.migrate(engine, legacy)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO user (id, username, email, password_hash) VALUES (1, 'ed', 'ed@example.com', 'x')")
+        connection.exec_driver_sql("INSERT INTO video (title, filename, user_id) VALUES ('Old Lecture', 'old.mp4', 1)")
+
+    messages = []
+    assert database.migrate(engine, log=messages.append) == database.MIGRATIONS[-1][0]
+    assert len(messages) == len(database.MIGRATIONS) - 1
+    assert database.migrate(engine, log=messages.append) == database.MIGRATIONS[-1][0] # Nothing left to apply
+    assert len(messages) == len(database.MIGRATIONS) - 1
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT title FROM video").scalar() == 'Old Lecture'
+        # Existing rows were indexed for search by the FTS migration
+        assert connection.exec_driver_sql("SELECT rowid FROM video_fts WHERE video_fts MATCH 'lecture'").scalar() == 1
+
+def test_failed_migration_rolls_back(engine):
+    def broken(connection):
+        connection.exec_driver_sql('CREATE TABLE half_done (id INTEGER)')
+        raise RuntimeError('boom')
+    with pytest.raises(RuntimeError):
+        database.migrate(engine, database.MIGRATIONS[:1] + [(2, 'broken', broken)])
+    with engine.connect() as connection:
+        assert database.schema_version(connection) == 1
+        assert 'half_done' not in inspect(connection).get_table_names()
+
+def test_connection_pragmas(engine):
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+        assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1 # NORMAL
+
+def test_engine_options_depend_on_database():
+    assert database.engine_options('sqlite://') == {}
+    assert database.engine_options('sqlite:///:memory:') == {}
+    assert database.engine_options('sqlite:///site.db', pool_size=4)['pool_size'] == 4
@@ -0,0 +1,100 @@
+import json
+import os
+import pytest
+import importer
+import storage
+from app import ImportCheckpoint, Video, db, get_page_cache
+
+@pytest.fixture
+def library(tmp_path):
+    (tmp_path / 'term1').mkdir()
+    (tmp_path / 'term1' / 'intro_to_algebra.mp4').write_bytes(b'algebra' * 100)
+    (tmp_path / 'term1' / 'notes.txt').write_text('not a video')
+    (tmp_path / 'term2').mkdir()
+    (tmp_path / 'term2' / 'physics-lab.mov').write_bytes(b'physics' * 100)
+    (tmp_path / 'term2' / 'physics-copy.mov').write_bytes(b'physics' * 100)
+    return tmp_path
+
+def write_jsonl(path, rows):
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+    return path
+
+def test_read_manifest_csv_and_jsonl(tmp_path):
+    (tmp_path / 'a.csv').write_text('path,title,description,uploader\nclips/a.mp4,Lecture A,First,ed\nb.mp4,,,\n')
+    entries = importer.read_manifest(str(tmp_path / 'a.csv'))
+    assert [entry.title for entry in entries] == ['Lecture A', 'b']
+    assert entries[0].path == str(tmp_path / 'clips' / 'a.mp4')
+    assert entries[0].uploader == 'ed' and entries[1].uploader is None
+
+    write_jsonl(tmp_path / 'b.jsonl', [{'path': '/srv/x.mp4', 'title': 'X'}])
+    assert importer.read_manifest(str(tmp_path / 'b.jsonl'))[0].path == '/srv/x.mp4'
+    (tmp_path / 'bad.jsonl').write_text('{"path": "a.mp4"}\nnot json\n')
+    with pytest.raises(importer.ManifestError, match='Line 2'):
+        importer.read_manifest(str(tmp_path / 'bad.jsonl'))
+
+def test_import_directory(app, editor_user_id, library):
+    invalidations = get_page_cache().invalidations
+    result = app.test_cli_runner().invoke(args=['import-videos', str(library), '--uploader', 'editoruser',
+                                                '--workers', '2', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Imported 3 videos' in result.output
+
+    videos = Video.query.order_by(Video.id).all()
+    assert [video.title for video in videos] == ['intro to algebra', 'physics copy', 'physics lab']
+    assert all(video.user_id == editor_user_id for video in videos)
+    # Identical files share one blob
+    assert videos[1].filename == videos[2].filename
+    assert len({video.filename for video in videos}) == 2
+    blob = os.path.join(app.config['UPLOAD_FOLDER'], videos[0].filename)
+    assert storage.hash_file(blob).hexdigest() == videos[0].digest
+    assert videos[0].size == 700
+    assert get_page_cache().invalidations > invalidations
+
+def test_import_manifest_resumes_and_reports_failures(app, editor_user_id, library):
+    manifest = write_jsonl(library / 'manifest.jsonl', [
+        {'path': 'term1/intro_to_algebra.mp4', 'title': 'Algebra I', 'uploader': 'editor@example.com'},
+        {'path': 'term2/physics-lab.mov', 'title': 'Physics Lab', 'uploaded_at': '2019-09-01T10:00:00'},
+        {'path': 'term2/missing.mp4', 'title': 'Gone'},
+        {'path': 'term1/notes.txt', 'title': 'Notes'},
+        {'path': 'term2/physics-copy.mov', 'title': 'Physics Again', 'uploader': 'nobody'},
+    ])
+    # Pretend an earlier run committed the first entry before crashing
+    db.session.add(ImportCheckpoint(source=str(manifest), position=1))
+    db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['import-videos', str(manifest), '--uploader', 'editoruser', '--copy'])
+    assert result.exit_code == 0, result.output
+    assert 'Resuming after 1 of 5 entries' in result.output
+    assert 'Imported 1 videos' in result.output and '3 failed' in result.output
+    assert "unknown uploader 'nobody'" in result.output
+    video = Video.query.one()
+    assert video.title == 'Physics Lab'
+    assert video.uploaded_at.year == 2019
+    assert db.session.get(ImportCheckpoint, str(manifest)).position == 5
+
+    # Running again has nothing left to do; --restart imports from the top
+    result = runner.invoke(args=['import-videos', str(manifest), '--uploader', 'editoruser'])
+    assert Video.query.count() == 1
+    result = runner.invoke(args=['import-videos', str(manifest), '--uploader', 'editoruser', '--restart'])
+    assert result.exit_code == 0, result.output
+    assert sorted(video.title for video in Video.query) == ['Algebra I', 'Physics Lab', 'Physics Lab']
+
+def test_import_rejects_unknown_default_uploader(app, init_database, library):
+    result = app.test_cli_runner().invoke(args=['import-videos', str(library), '--uploader', 'ghost'])
+    assert result.exit_code != 0
+    assert "No user named 'ghost'" in result.output
+    assert Video.query.count() == 0
+
+def test_ingest_hardlinks_when_possible(tmp_path):
+    source = tmp_path / 'lecture.mp4'
+    source.write_bytes(b'lecture' * 10)
+    folder = tmp_path / 'blobs'
+    folder.mkdir()
+    blob, digest, size = importer.ingest(str(source), storage.LocalStore(str(folder)), str(folder), link=True)
+    assert os.path.samefile(source, folder / blob)
+    assert size == 70 and blob == storage.blob_name(digest, 'lecture.mp4')
+    assert os.listdir(folder) == [blob] # No temp file left behind
+
+    copy, _, _ = importer.ingest(str(source), storage.LocalStore(str(tmp_path)), str(tmp_path), link=False)
+    assert copy == blob
@@ -0,0 +1,166 @@
+import datetime
+import io
+import json
+import os
+import time
+import pytest
+import jobs
+from app import Job, Video, db, enqueue_job, get_dispatcher, get_job_queue
+from tests.conftest import login
+
+@pytest.fixture
+def handlers():
+    calls = []
+
+    def flaky(name, failures):
+        calls.append(name)
+        if calls.count(name) <= failures:
+            raise RuntimeError(f'{name} failed')
+
+    def touch(path):
+        with open(path, 'w') as f:
+            f.write(str(os.getpid()))
+
+    jobs.handler('test_flaky', on_give_up=lambda name, failures, error: calls.append(f'gave up on {name}'))(flaky)
+    jobs.handler('test_touch')(touch)
+    yield calls
+    del jobs.HANDLERS['test_flaky'], jobs.HANDLERS['test_touch']
+
+def queue(kind, **payload):
+    job = enqueue_job(kind, **payload)
+    db.session.commit()
+    return job.id
+
+def job_row(job_id):
+    db.session.expire_all()
+    return db.session.get(Job, job_id)
+
+def test_upload_is_hidden_until_processed(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    data = {'title': 'Queued Lecture', 'video_file': (io.BytesIO(b'not really an mp4'), 'queued.mp4')}
+    response = client.post('/upload_video', data=data, content_type='multipart/form-data', follow_redirects=True)
+    assert b'It will be listed once processing finishes.' in response.data
+
+    video = Video.query.filter_by(title='Queued Lecture').one()
+    assert video.status == 'processing'
+    assert b'Queued Lecture' not in client.get('/videos').data
+    assert b'still being processed' in client.get(f'/video/{video.id}').data
+    status = client.get(f'/api/videos/{video.id}/status').get_json()
+    assert status['status'] == 'processing'
+    assert status['job']['status'] == jobs.QUEUED
+
+    get_dispatcher().run_inline()
+    assert job_row(video.job_id).status == jobs.DONE
+    assert db.session.get(Video, video.id).status == 'ready'
+    assert b'Queued Lecture' in client.get('/videos').data
+    assert client.get(f'/api/videos/{video.id}/status').get_json()['status'] == 'ready'
+
+def test_status_is_private_to_uploader_and_editors(client, app, new_user_id, uploaded_video_id):
+    login(client, 'test@example.com', 'password123')
+    assert client.get(f'/api/videos/{uploaded_video_id}/status').status_code == 404
+
+def test_failed_jobs_are_retried_with_backoff(app, init_database, handlers):
+    job_id = queue('test_flaky', name='a', failures=1)
+    dispatcher = get_dispatcher()
+    dispatcher.run_inline()
+    job = job_row(job_id)
+    assert job.status == jobs.QUEUED and job.attempts == 1
+    assert 'RuntimeError: a failed' in job.last_error
+    assert job.run_at > datetime.datetime.utcnow() + datetime.timedelta(seconds=20)
+
+    dispatcher.run_inline() # Not due yet
+    assert handlers == ['a']
+    job.run_at = datetime.datetime.utcnow()
+    db.session.commit()
+    dispatcher.run_inline()
+    job = job_row(job_id)
+    assert job.status == jobs.DONE and job.attempts == 2 and job.last_error is None
+    assert jobs.retry_delay(1, 30) == 30 and jobs.retry_delay(3, 30) == 120 and jobs.retry_delay(20, 30) == 3600
+
+def test_job_gives_up_after_max_attempts(app, init_database, handlers):
+    app.config['JOB_MAX_ATTEMPTS'] = 1
+    try:
+        job_id = queue('test_flaky', name='b', failures=5)
+    finally:
+        app.config['JOB_MAX_ATTEMPTS'] = 5
+    get_dispatcher().run_inline()
+    assert job_row(job_id).status == jobs.FAILED
+    assert handlers == ['b', 'gave up on b']
+
+def test_processing_a_missing_file_marks_video_failed(app, uploaded_video_id):
+    video = db.session.get(Video, uploaded_video_id)
+    video.status = 'processing'
+    video.job = enqueue_job('process_video', video_id=video.id)
+    video.job.max_attempts = 1
+    db.session.commit()
+    get_dispatcher().run_inline()
+    db.session.expire_all()
+    assert video.status == 'failed'
+    assert 'FileNotFoundError' in video.job.last_error
+
+def test_expired_leases_are_requeued(app, init_database, handlers):
+    job_id = queue('test_flaky', name='c', failures=0)
+    queue_ = get_job_queue()
+    claimed = queue_.claim(db.engine, 'dead-worker')
+    assert claimed.id == job_id and claimed.attempts == 1
+    assert queue_.claim(db.engine, 'other-worker') is None
+    job = job_row(job_id)
+    job.locked_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=queue_.lease + 1)
+    db.session.commit()
+    get_dispatcher().run_inline()
+    job = job_row(job_id)
+    assert job.status == jobs.DONE and job.attempts == 2
+
+def test_expired_job_with_no_attempts_left_fails(app, init_database, handlers):
+    job_id = queue('test_flaky', name='d', failures=0)
+    queue_ = get_job_queue()
+    job = job_row(job_id)
+    job.max_attempts = 1
+    db.session.commit()
+    queue_.claim(db.engine, 'killed-worker') # e.g. the job took its worker process down
+    job = job_row(job_id)
+    job.locked_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=queue_.lease + 1)
+    db.session.commit()
+    dispatcher = get_dispatcher()
+    dispatcher.run_inline()
+    job = job_row(job_id)
+    assert job.status == jobs.FAILED and job.attempts == 1 and job.last_error == jobs.LEASE_EXPIRED
+    assert handlers == ['gave up on d'] and dispatcher.failed == 1
+
+def test_inline_jobs_renew_their_lease(app, init_database):
+    job_id = queue('test_slow')
+    queue_ = jobs.JobQueue(Job.__table__, lease=0.2)
+    renewed = []
+    renew = queue_.renew
+    queue_.renew = lambda engine, job_ids: renewed.append(job_ids) or renew(engine, job_ids)
+    dispatcher = jobs.Dispatcher(queue_, db.engine, lambda kind, payload: time.sleep(0.3), None)
+    dispatcher.run_inline()
+    assert job_row(job_id).status == jobs.DONE
+    assert renewed and all(job_ids == [job_id] for job_ids in renewed)
+
+def sleep_job(kind, payload):
+    time.sleep(json.loads(payload).get('seconds', 0))
+
+def test_busy_pool_still_requeues_lapsed_leases(app, init_database):
+    lost = queue('test_lost')
+    queue_ = jobs.JobQueue(Job.__table__, lease=0.4)
+    queue_.claim(db.engine, 'crashed-worker') # Its lease lapses while the pool is busy
+    busy = [queue('test_busy', seconds=0.1) for _ in range(10)]
+    db.session.remove()
+    dispatcher = jobs.Dispatcher(queue_, db.engine, sleep_job, None, processes=1, poll_interval=0.05)
+    dispatcher.run(drain=True)
+    assert dispatcher.succeeded == 11
+    job = job_row(lost)
+    assert job.status == jobs.DONE and job.attempts == 2
+    assert all(job_row(job_id).status == jobs.DONE for job_id in busy)
+
+def test_process_pool_runs_jobs_in_worker_processes(app, init_database, handlers, tmp_path):
+    paths = [str(tmp_path / f'{i}.txt') for i in range(4)]
+    job_ids = [queue('test_touch', path=path) for path in paths]
+    db.session.remove()
+    dispatcher = get_dispatcher(processes=2, poll_interval=0.05)
+    dispatcher.run(drain=True)
+    assert dispatcher.succeeded == 4
+    assert all(job_row(job_id).status == jobs.DONE for job_id in job_ids)
+    pids = {open(path).read() for path in paths}
+    assert str(os.getpid()) not in pids
@@ -0,0 +1,65 @@
+import logging
+import os
+from app import instrumentation
+from metrics import Histogram
+from tests.conftest import login
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('latency_seconds', 'Test latency.', ('endpoint',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value, 'home')
+    text = '\n'.join(histogram.render())
+    assert 'latency_seconds_bucket{endpoint="home",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{endpoint="home",le="1.0"} 3' in text
+    assert 'latency_seconds_bucket{endpoint="home",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{endpoint="home"} 4' in text
+
+def test_metrics_endpoint_reports_requests_queries_and_renders(client, app, uploaded_video_id):
+    login(client, 'editor@example.com', 'password123')
+    before = instrumentation.query_count.count('video_list')
+    client.get('/videos')
+    assert instrumentation.query_count.count('video_list') == before + 1
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    assert 'learnai_http_requests_total{endpoint="video_list",method="GET",status="200"}' in body
+    assert 'learnai_sql_queries_per_request_bucket{endpoint="video_list"' in body
+    assert 'learnai_template_render_seconds_count{endpoint="video_list"}' in body
+    assert 'learnai_page_cache_misses_total' in body
+
+def test_video_bytes_are_counted(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'counted.mp4')
+    with open(path, 'wb') as f:
+        f.write(b"x" * 1000)
+    before = instrumentation.bytes_sent.value()
+    response = client.get('/uploads/videos/counted.mp4', headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert instrumentation.bytes_sent.value() == before + 100
+    os.remove(path)
+
+def test_slow_requests_are_logged_with_their_queries(client, app, uploaded_video_id, caplog):
+    login(client, 'editor@example.com', 'password123')
+    app.config['SLOW_REQUEST_THRESHOLD'] = 0
+    app.config['PAGE_CACHE_ENABLED'] = False
+    try:
+        with caplog.at_level(logging.WARNING, logger=app.logger.name):
+            client.get(f'/video/{uploaded_video_id}')
+    finally:
+        app.config['SLOW_REQUEST_THRESHOLD'] = None
+        app.config['PAGE_CACHE_ENABLED'] = True
+    messages = [record.getMessage() for record in caplog.records if 'Slow request' in record.getMessage()]
+    assert messages
+    assert f'GET /video/{uploaded_video_id}' in messages[0]
+    assert 'FROM video' in messages[0]
+
+def test_metrics_token(client, app):
+    app.config['METRICS_TOKEN'] = 'scrape-secret'
+    try:
+        assert client.get('/metrics').status_code == 401
+        response = client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        assert response.status_code == 200
+    finally:
+        app.config['METRICS_TOKEN'] = None
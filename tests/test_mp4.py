@@ -0,0 +1,162 @@
+import io
+import os
+import re
+import struct
+import pytest
+import mp4
+import storage
+from app import Video, db, get_dispatcher
+from tests.conftest import login
+
+VIDEO_SAMPLES = [b'keyframe-0' * 3, b'delta-1' * 2]
+AUDIO_SAMPLES = [b'aac-0' * 4]
+
+def box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def full_box(box_type, payload, version=0):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+def header_times(version, timescale, duration):
+    if version == 1:
+        return struct.pack('>QQIQ', 0, 0, timescale, duration)
+    return struct.pack('>IIII', 0, 0, timescale, duration)
+
+def chunk_offsets_box(offsets, co64):
+    if co64:
+        return full_box(b'co64', struct.pack(f'>I{len(offsets)}Q', len(offsets), *offsets))
+    return full_box(b'stco', struct.pack(f'>I{len(offsets)}I', len(offsets), *offsets))
+
+def trak(handler, entry, offsets, co64, version, width=0, height=0):
+    if version == 1:
+        tkhd_times = struct.pack('>QQIIQ', 0, 0, 1, 0, 0)
+    else:
+        tkhd_times = struct.pack('>IIIII', 0, 0, 1, 0, 0)
+    tkhd = full_box(b'tkhd', tkhd_times + bytes(52) + struct.pack('>II', width << 16, height << 16), version)
+    mdhd = full_box(b'mdhd', header_times(version, 90000, 90000 * 125) + bytes(4), version)
+    hdlr = full_box(b'hdlr', bytes(4) + handler + bytes(12) + b'\x00')
+    stsd = full_box(b'stsd', struct.pack('>I', 1) + entry)
+    stbl = box(b'stbl', stsd + chunk_offsets_box(offsets, co64))
+    return box(b'trak', tkhd + box(b'mdia', mdhd + hdlr + box(b'minf', stbl)))
+
+def make_mp4(moov_first=False, co64=False, version=0, trailing=b''):
+    """A tiny MP4 with one video and one audio track, each sample stored as its own chunk."""
+    ftyp = box(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomavc1')
+    mdat = box(b'mdat', b''.join(VIDEO_SAMPLES + AUDIO_SAMPLES))
+    avc1 = box(b'avc1', bytes(24) + struct.pack('>HH', 640, 360) + bytes(50))
+    mp4a = box(b'mp4a', bytes(28))
+
+    def moov(mdat_offset):
+        offsets, position = [], mdat_offset + 8
+        for sample in VIDEO_SAMPLES + AUDIO_SAMPLES:
+            offsets.append(position)
+            position += len(sample)
+        mvhd = full_box(b'mvhd', header_times(version, 1000, 125500) + bytes(80), version)
+        video = trak(b'vide', avc1, offsets[:2], co64, version, 1280, 720)
+        audio = trak(b'soun', mp4a, offsets[2:], co64, version)
+        return box(b'moov', mvhd + video + audio)
+
+    if moov_first:
+        moov_size = len(moov(0))
+        return ftyp + moov(len(ftyp) + moov_size) + mdat + trailing
+    return ftyp + mdat + moov(len(ftyp)) + trailing
+
+def chunk_samples(data):
+    """Bytes found at every chunk offset, in table order, assuming the fixture's sample sizes."""
+    offsets = []
+    for match in re.finditer(rb'stco|co64', data):
+        count = struct.unpack_from('>I', data, match.end() + 4)[0]
+        width = 4 if match.group() == b'stco' else 8
+        offsets += struct.unpack_from(f'>{count}{"I" if width == 4 else "Q"}', data, match.end() + 8)
+    return [data[offset:offset + len(sample)] for offset, sample in zip(offsets, VIDEO_SAMPLES + AUDIO_SAMPLES)]
+
+def top_level_types(data):
+    types, offset = [], 0
+    while offset < len(data):
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        types.append(box_type)
+        offset += size
+    return types
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_probe_reads_track_metadata(tmp_path, version):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(make_mp4(version=version))
+    info = mp4.probe(str(path))
+    assert info.duration == pytest.approx(125.5)
+    assert (info.width, info.height) == (1280, 720)
+    assert info.codec == 'avc1'
+    assert info.bitrate == int(os.path.getsize(path) * 8 / 125.5)
+    assert info.needs_faststart
+
+    path.write_bytes(make_mp4(moov_first=True, version=version))
+    assert not mp4.probe(str(path)).needs_faststart
+
+@pytest.mark.parametrize('co64', [False, True])
+def test_faststart_moves_moov_and_shifts_chunk_offsets(tmp_path, co64):
+    source = tmp_path / 'tail.mp4'
+    source.write_bytes(make_mp4(co64=co64, trailing=box(b'free', bytes(16))))
+    destination = tmp_path / 'front.mp4'
+    hasher = storage.BlockHasher(block_size=32)
+
+    assert mp4.faststart(str(source), str(destination), hasher)
+    data = destination.read_bytes()
+    assert top_level_types(data) == [b'ftyp', b'moov', b'mdat', b'free']
+    assert len(data) == os.path.getsize(source)
+    assert chunk_samples(data) == VIDEO_SAMPLES + AUDIO_SAMPLES
+    assert chunk_samples(source.read_bytes()) == VIDEO_SAMPLES + AUDIO_SAMPLES
+    assert hasher.hexdigest() == storage.hash_file(str(destination), block_size=32).hexdigest()
+    assert not mp4.probe(str(destination)).needs_faststart
+
+def test_faststart_leaves_faststart_files_alone(tmp_path):
+    source = tmp_path / 'front.mp4'
+    source.write_bytes(make_mp4(moov_first=True))
+    assert not mp4.faststart(str(source), str(tmp_path / 'out.mp4'))
+    assert not (tmp_path / 'out.mp4').exists()
+
+def test_probe_rejects_other_containers(tmp_path):
+    path = tmp_path / 'clip.avi'
+    path.write_bytes(b'RIFF\x10\x00\x00\x00AVI LIST' + bytes(16))
+    with pytest.raises(mp4.InvalidContainer):
+        mp4.probe(str(path))
+    truncated = tmp_path / 'truncated.mp4'
+    truncated.write_bytes(make_mp4()[:-10])
+    with pytest.raises(mp4.InvalidContainer):
+        mp4.probe(str(truncated))
+
+def test_processing_remuxes_uploads_for_faststart(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    content = make_mp4()
+    response = client.post('/upload_video', data={
+        'title': 'Tail Moov', 'description': '',
+        'video_file': (io.BytesIO(content), 'tail.mp4'),
+    }, content_type='multipart/form-data', follow_redirects=True)
+    assert response.status_code == 200
+    get_dispatcher().run_inline()
+    db.session.expire_all()
+
+    video = Video.query.one()
+    assert video.status == 'ready'
+    assert video.duration == pytest.approx(125.5)
+    assert (video.width, video.height, video.codec) == (1280, 720, 'avc1')
+    stored = os.path.join(app.config['UPLOAD_FOLDER'], video.filename)
+    data = open(stored, 'rb').read()
+    assert top_level_types(data)[:2] == [b'ftyp', b'moov']
+    assert video.digest == storage.hash_file(stored).hexdigest()
+    assert video.size == len(content)
+    assert b'2:05' in client.get(f'/video/{video.id}').data
+
+def test_processing_remuxes_chunked_uploads_for_faststart(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    content = make_mp4()
+    upload = client.post('/api/uploads', json=dict(title='Chunked Tail', filename='tail.mp4', size=len(content))).get_json()
+    client.put(f"/api/uploads/{upload['upload_id']}/chunks/0", data=content, content_type='application/octet-stream')
+    assert client.post(f"/api/uploads/{upload['upload_id']}/complete").status_code == 201
+    get_dispatcher().run_inline()
+    db.session.expire_all()
+
+    video = db.session.query(Video).one()
+    stored = os.path.join(app.config['UPLOAD_FOLDER'], video.filename)
+    assert top_level_types(open(stored, 'rb').read())[1] == b'moov'
+    assert video.digest == storage.hash_file(stored).hexdigest()
+    assert video.codec == 'avc1'
@@ -0,0 +1,54 @@
+import threading
+import pytest
+from werkzeug.security import generate_password_hash
+import passwords
+from app import User, db
+from tests.conftest import login
+
+def test_normalize_method():
+    assert passwords.normalize_method('pbkdf2:sha256:600000') == 'pbkdf2:sha256:600000'
+    assert passwords.normalize_method('pbkdf2') == f'pbkdf2:sha256:{passwords.DEFAULT_PBKDF2_ITERATIONS}'
+    assert passwords.normalize_method('scrypt:16384') == 'scrypt:16384:8:1'
+    with pytest.raises(ValueError):
+        passwords.normalize_method('md5')
+
+def test_old_hash_is_upgraded_on_login(client, init_database):
+    user = User(username='olduser', email='old@example.com',
+                password_hash=generate_password_hash('password123', 'pbkdf2:sha256:1000'))
+    db.session.add(user)
+    db.session.commit()
+    assert b'Login unsuccessful' in login(client, 'old@example.com', 'wrong').data
+    assert db.session.get(User, user.id).password_hash.startswith('pbkdf2:sha256:1000$')
+
+    assert b'Login successful' in login(client, 'old@example.com', 'password123').data
+    db.session.expire_all()
+    assert db.session.get(User, user.id).password_hash.startswith('scrypt:32768:8:1$')
+    client.get('/logout')
+    assert b'Login successful' in login(client, 'old@example.com', 'password123').data
+    client.get('/logout')
+
+@pytest.fixture
+def small_hasher(app):
+    hasher = passwords.PasswordHasher('scrypt', workers=1, max_pending=0)
+    previous = app.extensions.get('password_hasher')
+    app.extensions['password_hasher'] = hasher
+    yield hasher
+    app.extensions['password_hasher'] = previous
+
+def test_saturated_hasher_answers_503(client, new_user_id, small_hasher):
+    started, release = threading.Event(), threading.Event()
+    def occupy():
+        started.set()
+        release.wait()
+    blocker = threading.Thread(target=small_hasher._run, args=(occupy,))
+    blocker.start()
+    started.wait()
+    response = login(client, 'test@example.com', 'password123')
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert small_hasher.rejected == 1
+    release.set()
+    blocker.join()
+
+    assert b'Login successful' in login(client, 'test@example.com', 'password123').data
+    assert 'learnai_password_hash_rejected_total 1' in client.get('/metrics').get_data(as_text=True)
+    client.get('/logout')
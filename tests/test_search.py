@@ -0,0 +1,85 @@
+import pytest
+from app import User, Video, db
+from tests.conftest import login
+
+@pytest.fixture
+def catalog(app, editor_user_id):
+    with app.app_context():
+        videos = [
+            Video(title='Introduction to Python', description='Variables, loops and functions.', filename='a.mp4', user_id=editor_user_id),
+            Video(title='Advanced SQL', description='Window functions and a short <b>Python</b> section.', filename='b.mp4', user_id=editor_user_id),
+            Video(title='Linear Algebra', description='Matrices and vectors.', filename='c.mp4', user_id=editor_user_id),
+        ]
+        db.session.add_all(videos)
+        db.session.commit()
+        return [video.id for video in videos]
+
+def test_search_ranks_title_matches_first(client, app, catalog):
+    login(client, 'editor@example.com', 'password123')
+    response = client.get('/search?q=python')
+    assert response.status_code == 200
+    body = response.data
+    assert body.index(b'<mark>Python</mark></a>') < body.index(b'Advanced SQL')
+    assert b'Linear Algebra' not in body
+    # Video text is escaped; only the highlight markup is real HTML
+    assert b'&lt;b&gt;<mark>Python</mark>&lt;/b&gt;' in body
+
+def test_search_prefix_terms_and_bad_syntax(client, app, catalog):
+    login(client, 'editor@example.com', 'password123')
+    assert b'<mark>Introduction</mark> to <mark>Python</mark>' in client.get('/search?q=intro+pyth').data
+    response = client.get('/search?q=%22unbalanced+AND+(')
+    assert response.status_code == 200
+    assert b'No videos match' in response.data
+
+def test_search_index_follows_updates_and_deletes(client, app, catalog):
+    login(client, 'editor@example.com', 'password123')
+    with app.app_context():
+        video = db.session.get(Video, catalog[2])
+        video.title = 'Calculus Refresher'
+        db.session.commit()
+        db.session.delete(db.session.get(Video, catalog[0]))
+        db.session.commit()
+    assert b'Calculus' in client.get('/search?q=calculus').data
+    assert b'No videos match' in client.get('/search?q=linear').data
+    assert b'Introduction' not in client.get('/search?q=python').data
+
+def test_search_pagination(client, app, editor_user_id):
+    app.config['SEARCH_RESULTS_PER_PAGE'] = 2
+    try:
+        with app.app_context():
+            db.session.add_all([Video(title=f'Physics {i}', filename=f'{i}.mp4', user_id=editor_user_id) for i in range(5)])
+            db.session.commit()
+        login(client, 'editor@example.com', 'password123')
+        first = client.get('/search?q=physics').data
+        assert first.count(b'<mark>Physics</mark>') == 2
+        assert b'page=2' in first
+        last = client.get('/search?q=physics&page=3').data
+        assert last.count(b'<mark>Physics</mark>') == 1
+        assert b'Next' not in last
+    finally:
+        app.config['SEARCH_RESULTS_PER_PAGE'] = 20
+
+def test_search_pages_count_only_ready_videos(client, app, editor_user_id):
+    app.config['SEARCH_RESULTS_PER_PAGE'] = 2
+    try:
+        with app.app_context():
+            db.session.add_all([Video(title=f'Chemistry {i}', filename=f'{i}.mp4', user_id=editor_user_id,
+                                      status='ready' if i % 2 else 'processing') for i in range(6)])
+            db.session.commit()
+        login(client, 'editor@example.com', 'password123')
+        first = client.get('/search?q=chemistry').data
+        assert first.count(b'<mark>Chemistry</mark>') == 2 and b'page=2' in first
+        last = client.get('/search?q=chemistry&page=2').data
+        assert last.count(b'<mark>Chemistry</mark>') == 1 and b'Next' not in last
+    finally:
+        app.config['SEARCH_RESULTS_PER_PAGE'] = 20
+
+def test_rebuild_search_index_command(client, app, catalog):
+    with app.app_context():
+        db.session.execute(db.text("INSERT INTO video_fts(video_fts) VALUES ('delete-all')"))
+        db.session.commit()
+    login(client, 'editor@example.com', 'password123')
+    assert b'No videos match' in client.get('/search?q=matrices').data
+    result = app.test_cli_runner().invoke(args=['rebuild-search-index'])
+    assert 'Indexed 3 videos.' in result.output
+    assert b'Linear Algebra' in client.get('/search?q=matrices').data
@@ -0,0 +1,129 @@
+import io
+import os
+import pytest
+import storage
+from app import Video, create_app, db
+from tests.conftest import login
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+def age(path, seconds):
+    # Pretend the file was last read `seconds` ago
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime - seconds, stat.st_mtime))
+
+def test_local_store(tmp_path):
+    store = storage.LocalStore(str(tmp_path / 'blobs'))
+    assert store.put(write(tmp_path / 'a.tmp', b'abc'), 'aaa.mp4')
+    assert not store.put(write(tmp_path / 'b.tmp', b'abc'), 'aaa.mp4') # Already stored; temp file dropped
+    assert not (tmp_path / 'b.tmp').exists()
+    assert open(store.local_path('aaa.mp4'), 'rb').read() == b'abc'
+    assert store.local_path('../a.tmp') is None and store.local_path('missing.mp4') is None
+    assert store.names() == ['aaa.mp4']
+    assert store.delete('aaa.mp4') and not store.exists('aaa.mp4')
+
+def test_cached_store_reads_through_and_evicts_least_recently_used(tmp_path):
+    tier = storage.DirectoryTier(str(tmp_path / 'slow'))
+    cache = tmp_path / 'cache'
+    store = storage.CachedStore(tier, str(cache), max_bytes=250)
+    for name in ('a.mp4', 'b.mp4', 'c.mp4'):
+        assert tier.upload(write(tmp_path / 'upload.tmp', name.encode() * 25), name) # 125 bytes each
+    assert not tier.upload(str(tmp_path / 'upload.tmp'), 'c.mp4')
+    assert sorted(store.names()) == ['a.mp4', 'b.mp4', 'c.mp4']
+
+    path = store.local_path('a.mp4')
+    assert path == str(cache / 'a.mp4') and open(path, 'rb').read() == b'a.mp4' * 25
+    age(path, 3600)
+    store.local_path('b.mp4')
+    age(cache / 'b.mp4', 1800)
+    store.local_path('a.mp4') # A hit makes a.mp4 the most recently used again
+    assert store.stats() == {'hits': 1, 'misses': 2, 'fetched_bytes': 250, 'evictions': 0, 'evicted_bytes': 0}
+
+    store.local_path('c.mp4') # Over budget: b.mp4 is the least recently used
+    assert sorted(os.listdir(cache)) == ['a.mp4', 'c.mp4']
+    assert store.stats()['evictions'] == 1 and store.stats()['evicted_bytes'] == 125
+    assert tier.exists('b.mp4') # Eviction only drops the cached copy
+    assert store.local_path('missing.mp4') is None
+    assert store.local_path('../slow/a.mp4') is None
+
+def test_cached_store_put_writes_the_slow_tier_and_keeps_a_cached_copy(tmp_path):
+    tier = storage.DirectoryTier(str(tmp_path / 'slow'))
+    store = storage.CachedStore(tier, str(tmp_path / 'cache'), max_bytes=1000)
+    assert store.put(write(tmp_path / 'upload.tmp', b'new upload'), 'new.mp4')
+    assert not (tmp_path / 'upload.tmp').exists()
+    assert (tmp_path / 'slow' / 'new.mp4').read_bytes() == b'new upload'
+    assert (tmp_path / 'cache' / 'new.mp4').read_bytes() == b'new upload'
+    assert store.delete('new.mp4') and not store.exists('new.mp4')
+
+def test_cached_store_scans_only_when_over_budget_or_due(tmp_path, monkeypatch):
+    scans = []
+    scan = storage._scan
+    monkeypatch.setattr(storage, '_scan', lambda folder: scans.append(folder) or scan(folder))
+    now = [0.0]
+    cache = tmp_path / 'cache'
+    store = storage.CachedStore(storage.DirectoryTier(str(tmp_path / 'slow')), str(cache), max_bytes=300,
+                                clock=lambda: now[0])
+    store.put(write(tmp_path / 'upload.tmp', b'a' * 100), 'a.mp4')
+    assert len(scans) == 1 # The first put learns the folder's size
+    store.put(write(tmp_path / 'upload.tmp', b'b' * 100), 'b.mp4')
+    store.delete('b.mp4')
+    store.put(write(tmp_path / 'upload.tmp', b'c' * 100), 'c.mp4')
+    assert len(scans) == 1 and store.evict() == 200
+
+    write(cache / 'd.mp4', b'd' * 100) # Cached by another worker
+    store.put(write(tmp_path / 'upload.tmp', b'e' * 100), 'e.mp4')
+    assert len(scans) == 1 and store.stats()['evictions'] == 0 # Not seen yet
+    now[0] = storage.CachedStore.RESYNC_INTERVAL
+    assert store.evict() == 300 and len(scans) == 2
+    assert store.stats()['evictions'] == 1 and not (cache / 'a.mp4').exists()
+
+@pytest.fixture
+def tiered_store(app, tmp_path):
+    store = storage.CachedStore(storage.DirectoryTier(str(tmp_path / 'slow')), app.config['UPLOAD_FOLDER'], 10 ** 6)
+    previous = app.extensions.get('blob_store')
+    app.extensions['blob_store'] = store
+    yield store
+    app.extensions['blob_store'] = previous
+
+def test_uploads_and_playback_go_through_the_slow_tier(client, app, editor_user_id, tiered_store):
+    login(client, 'editor@example.com', 'password123')
+    client.post('/upload_video', data={'title': 'Tiered', 'description': '',
+                                       'video_file': (io.BytesIO(b'tiered video' * 100), 'tiered.mp4')},
+                content_type='multipart/form-data')
+    video = db.session.query(Video).one()
+    assert tiered_store.tier.exists(video.filename)
+
+    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], video.filename)) # Evicted
+    response = client.get(f'/uploads/videos/{video.filename}', headers={'Range': 'bytes=0-5'})
+    assert response.status_code == 206 and response.data == b'tiered'
+    assert client.get(f'/uploads/videos/{video.filename}').data == b'tiered video' * 100
+    assert tiered_store.stats()['misses'] == 1 and tiered_store.stats()['hits'] == 1
+    assert client.get('/uploads/videos/nothing.mp4').status_code == 404
+    assert 'learnai_blob_cache_misses_total 1' in client.get('/metrics').get_data(as_text=True)
+
+def test_playback_refetches_a_copy_evicted_before_it_was_opened(client, app, editor_user_id, tiered_store,
+                                                               monkeypatch):
+    login(client, 'editor@example.com', 'password123')
+    client.post('/upload_video', data={'title': 'Evicted', 'description': '',
+                                       'video_file': (io.BytesIO(b'evicted video' * 100), 'evicted.mp4')},
+                content_type='multipart/form-data')
+    video = db.session.query(Video).one()
+    local_path = tiered_store.local_path
+    lookups = []
+
+    def evicted_by_another_worker(name):
+        path = local_path(name)
+        if not lookups:
+            os.remove(path)
+        lookups.append(name)
+        return path
+    monkeypatch.setattr(tiered_store, 'local_path', evicted_by_another_worker)
+    response = client.get(f'/uploads/videos/{video.filename}')
+    assert response.status_code == 200 and response.data == b'evicted video' * 100
+    assert lookups == [video.filename] * 2 and tiered_store.stats()['misses'] == 1
+
+def test_tiered_backend_needs_a_slow_folder():
+    with pytest.raises(ValueError, match='STORAGE_SLOW_FOLDER'):
+        create_app({'STORAGE_BACKEND': 'tiered', 'TEMPLATE_CACHE_DIR': None})
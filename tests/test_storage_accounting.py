@@ -0,0 +1,162 @@
+import datetime
+import io
+import os
+import pytest
+import uploads
+from app import Blob, UploadChunk, UploadSession, User, Video, db
+from tests.conftest import login
+
+def used(user_id):
+    db.session.expire_all()
+    return db.session.get(User, user_id).storage_used
+
+def upload(client, content, name='lecture.mp4'):
+    return client.post('/upload_video', data={'title': 'Lecture', 'description': '',
+                                              'video_file': (io.BytesIO(content), name)},
+                       content_type='multipart/form-data')
+
+@pytest.fixture
+def gc(app):
+    app.config['BLOB_GC_GRACE'] = 0
+    yield lambda *args: app.test_cli_runner().invoke(args=['gc-blobs', *args])
+    app.config['BLOB_GC_GRACE'] = 24 * 3600
+
+def test_usage_follows_video_rows(new_user_id, editor_user_id):
+    first = Video(title='A', filename='a.mp4', size=100, user_id=editor_user_id)
+    second = Video(title='B', filename='b.mp4', size=50, user_id=editor_user_id)
+    db.session.add_all([first, second])
+    db.session.commit()
+    assert used(editor_user_id) == 150
+
+    db.session.get(Video, first.id).size = 120 # e.g. remuxed by process_video
+    db.session.commit()
+    assert used(editor_user_id) == 170
+    db.session.get(Video, second.id).user_id = new_user_id
+    db.session.commit()
+    assert used(editor_user_id) == 120 and used(new_user_id) == 50
+    db.session.delete(db.session.get(Video, first.id))
+    db.session.commit()
+    assert used(editor_user_id) == 0
+
+def test_form_upload_over_quota_is_refused_before_it_is_stored(app, client, editor_user_id):
+    db.session.get(User, editor_user_id).storage_quota = 2000
+    db.session.commit()
+    login(client, 'editor@example.com', 'password123')
+    response = upload(client, b'x' * 5000)
+    assert response.status_code == 302 and response.headers['Location'].endswith('/upload_video')
+    assert Video.query.count() == 0
+    assert [name for name in os.listdir(app.config['UPLOAD_FOLDER']) if not name.startswith('.')] == []
+
+    upload(client, b'y' * 1000)
+    assert used(editor_user_id) == 1000
+    # 1000 bytes left, but the multipart body around the file is larger than that
+    response = client.get(upload(client, b'z' * 1000, 'second.mp4').headers['Location'])
+    assert b'exceed your storage quota' in response.data and Video.query.count() == 1
+    client.get('/logout')
+
+def idle(upload_id, seconds):
+    db.session.get(UploadSession, upload_id).updated_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+    db.session.commit()
+
+def test_resumable_upload_quota_counts_open_uploads(app, client, editor_user_id):
+    app.config['STORAGE_QUOTA'] = 10000
+    try:
+        login(client, 'editor@example.com', 'password123')
+        new = lambda size: client.post('/api/uploads', json={'title': 'T', 'filename': 'big.mp4', 'size': size})
+        assert new(20000).status_code == 413
+        first = new(6000).get_json()['upload_id']
+        assert new(6000).status_code == 413 # The first upload has reserved 6000 bytes
+        second = new(4000).get_json()['upload_id']
+        idle(first, 23 * 3600)
+        assert new(1).status_code == 413 # Quiet, but not abandoned yet
+
+        idle(first, 25 * 3600) # Past BLOB_GC_GRACE: a forgotten tab no longer holds the quota
+        idle(second, 25 * 3600)
+        assert client.put(f'/api/uploads/{second}/chunks/0', data=b'x' * 4000).status_code == 200 # Active again
+        assert new(6000).status_code == 201
+        client.get('/logout')
+    finally:
+        app.config['STORAGE_QUOTA'] = None
+
+def test_gc_expires_idle_uploads(app, client, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    new = lambda: client.post('/api/uploads', json={'title': 'T', 'filename': 'big.mp4', 'size': 100}).get_json()['upload_id']
+    forgotten, active = new(), new()
+    client.put(f'/api/uploads/{forgotten}/chunks/0', data=b'x' * 100)
+    idle(forgotten, 25 * 3600)
+    partial_folder = os.path.join(app.config['UPLOAD_FOLDER'], '.partial')
+
+    gc = lambda *args: app.test_cli_runner().invoke(args=['gc-blobs', *args]).output
+    assert '1 expired uploads' in gc('--dry-run') and db.session.get(UploadSession, forgotten) is not None
+    assert '1 expired uploads and 1 abandoned partial files' in gc()
+    assert db.session.get(UploadSession, forgotten) is None and UploadChunk.query.count() == 0
+    assert not os.path.exists(uploads.partial_path(partial_folder, forgotten))
+    assert os.path.exists(uploads.partial_path(partial_folder, active))
+    assert client.get(f'/api/uploads/{forgotten}').status_code == 404
+    assert client.get(f'/api/uploads/{active}').status_code == 200
+    client.get('/logout')
+
+def test_gc_reclaims_orphans_only(app, client, editor_user_id, gc):
+    login(client, 'editor@example.com', 'password123')
+    upload(client, b'kept' * 500, 'kept.mp4')
+    upload(client, b'gone' * 500, 'gone.mp4')
+    upload(client, b'gone' * 500, 'copy.mp4') # Same content, shares the blob
+    client.get('/logout')
+    kept, gone, copy = Video.query.order_by(Video.id).all()
+    assert gone.filename == copy.filename and Blob.query.count() == 2
+    folder = app.config['UPLOAD_FOLDER']
+
+    db.session.delete(gone)
+    db.session.commit()
+    assert 'Deleted 0 orphaned blobs' in gc().output # The copy still names it
+    db.session.delete(db.session.get(Video, copy.id))
+    db.session.commit()
+    assert used(editor_user_id) == 2000
+
+    app.config['BLOB_GC_GRACE'] = 3600
+    assert 'Deleted 0 orphaned blobs' in gc().output # Too recent to be sure
+    app.config['BLOB_GC_GRACE'] = 0
+    assert 'Would delete 1 orphaned blobs' in gc('--dry-run').output
+    assert os.path.exists(os.path.join(folder, copy.filename))
+    result = gc('--batch-size', '1')
+    assert 'Deleted 1 orphaned blobs (0.0 MB)' in result.output, result.output
+    assert not os.path.exists(os.path.join(folder, copy.filename))
+    assert os.path.exists(os.path.join(folder, kept.filename))
+    assert [blob.name for blob in Blob.query] == [kept.filename]
+
+def test_gc_scan_finds_unrecorded_files_and_abandoned_partials(app, client, editor_user_id, gc):
+    folder = app.config['UPLOAD_FOLDER']
+    for name in os.listdir(folder): # Blobs left by earlier tests, whose rows are gone
+        if not name.startswith('.'):
+            os.remove(os.path.join(folder, name))
+    with open(os.path.join(folder, 'legacy.mp4'), 'wb') as f:
+        f.write(b'legacy')
+    assert 'Deleted 0 orphaned blobs' in gc().output # Not in the ledger yet
+    partial_folder = os.path.join(folder, '.partial')
+    os.makedirs(partial_folder, exist_ok=True)
+    open(uploads.partial_path(partial_folder, 'crashed'), 'wb').close()
+    db.session.add(UploadSession(id='open', title='T', filename='t.mp4', total_size=1, chunk_size=1,
+                                 user_id=editor_user_id))
+    db.session.commit()
+    open(uploads.partial_path(partial_folder, 'open'), 'wb').close()
+
+    app.config['BLOB_GC_GRACE'] = 3600
+    assert '0 abandoned partial files' in gc().output # Both written too recently
+    app.config['BLOB_GC_GRACE'] = 0
+    result = gc('--scan')
+    assert 'Scanned 1 stored blobs' in result.output, result.output
+    # The session has had no chunk for BLOB_GC_GRACE, so it goes along with its partial file
+    assert '1 expired uploads and 2 abandoned partial files' in result.output, result.output
+    assert os.listdir(partial_folder) == [] and UploadSession.query.count() == 0
+    # Newly recorded, so it first waits out the grace period like any new blob
+    assert os.path.exists(os.path.join(folder, 'legacy.mp4'))
+    assert 'Deleted 1 orphaned blobs' in gc().output
+    assert not os.path.exists(os.path.join(folder, 'legacy.mp4'))
+
+def test_import_charges_storage(app, editor_user_id, tmp_path):
+    (tmp_path / 'one.mp4').write_bytes(b'1' * 300)
+    (tmp_path / 'two.mp4').write_bytes(b'2' * 200)
+    result = app.test_cli_runner().invoke(args=['import-videos', str(tmp_path), '--uploader', 'editoruser'])
+    assert result.exit_code == 0, result.output
+    assert used(editor_user_id) == 500
+    assert sorted(blob.size for blob in Blob.query) == [200, 300]
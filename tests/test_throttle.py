@@ -0,0 +1,153 @@
+import os
+import pytest
+import throttle
+from werkzeug.test import EnvironBuilder
+from tests.conftest import login
+
+CONTENT = b'v' * (256 * 1024)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+        self.advance = True # False: sleeping takes no time, like a sleep cut short by another stream
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        if self.advance:
+            self.now += seconds
+
+def test_token_bucket():
+    bucket = throttle.TokenBucket(10, 20, now=0)
+    assert bucket.take(20, 0) == 0
+    assert bucket.take(5, 0) == 0.5 # Nothing left; 5 tokens take half a second
+    assert bucket.take(5, 0.5) == 0
+    assert bucket.charge(30, 1.0) == 2.5 # 5 refilled, 30 charged: 25 in debt at 10/s
+    assert not bucket.full(3.5) and bucket.full(5.5)
+
+def test_admission_limits_requests_and_bytes_per_user():
+    clock = FakeClock()
+    admission = throttle.Admission({'viewer': {'requests_per_second': 2, 'request_burst': 2,
+                                               'bytes_per_second': 1000, 'byte_burst': 1000}},
+                                   clock=clock, sleep=clock.sleep)
+    first = admission.admit(1, 'viewer')
+    admission.admit(1, 'viewer').close()
+    with pytest.raises(throttle.Throttled) as refused:
+        admission.admit(1, 'viewer')
+    assert refused.value.reason == 'requests' and refused.value.retry_after == 0.5
+    admission.admit(2, 'viewer').close() # Another user has buckets of their own
+    assert admission.admit(3, 'editor').metered is False # No limits for a tier that is not configured
+
+    first.charge(600)
+    assert clock.slept == []
+    first.charge(600) # 200 bytes in debt at 1000/s
+    assert clock.slept == [pytest.approx(0.2)]
+    clock.advance = False
+    first.charge(1500)
+    with pytest.raises(throttle.Throttled) as refused:
+        admission.admit(1, 'viewer') # Another stream of theirs is still paying off its last block
+    assert refused.value.reason == 'bytes' and refused.value.retry_after == pytest.approx(1.5)
+    assert admission.rejected == {'requests': 1, 'bytes': 1, 'streams': 0}
+
+def test_admission_caps_concurrent_streams():
+    admission = throttle.Admission({}, max_streams=2, queue_timeout=0)
+    first, second = admission.admit(1, 'viewer'), admission.admit(2, 'viewer')
+    with pytest.raises(throttle.Throttled) as refused:
+        admission.admit(3, 'viewer')
+    assert refused.value.reason == 'streams'
+    first.close()
+    first.close() # Closing twice gives back one slot only
+    third = admission.admit(3, 'viewer')
+    assert admission.active == 2
+    second.close()
+    third.close()
+    assert admission.active == 0
+
+def test_admission_forgets_least_recently_seen_users_past_the_cap(monkeypatch):
+    monkeypatch.setattr(throttle, 'MAX_TRACKED_USERS', 10)
+    clock = FakeClock()
+    admission = throttle.Admission({'viewer': {'bytes_per_second': 1000}}, clock=clock, sleep=clock.sleep)
+    clock.advance = False
+    for user_id in range(10):
+        admission.admit(user_id, 'viewer').charge(5000) # All in debt, so none can be pruned as idle
+    with pytest.raises(throttle.Throttled):
+        admission.admit(0, 'viewer') # Seen again: now the most recently used
+    admission.admit(10, 'viewer')
+    assert len(admission._buckets) == 10 and 1 not in admission._buckets and 0 in admission._buckets
+
+@pytest.fixture
+def video(app):
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'throttled.mp4')
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+    yield '/uploads/videos/throttled.mp4'
+    os.remove(path)
+
+@pytest.fixture
+def admission(app):
+    previous = app.extensions.get('admission')
+    def install(*args, **kwargs):
+        app.extensions['admission'] = throttle.Admission(*args, **kwargs)
+        return app.extensions['admission']
+    yield install
+    app.extensions['admission'] = previous
+
+def test_request_rate_answers_429_with_retry_after(client, new_user_id, video, admission):
+    admission({'viewer': {'requests_per_second': 0.1, 'request_burst': 2}})
+    login(client, 'test@example.com', 'password123')
+    assert client.get(video).status_code == 200
+    assert client.head(video).status_code == 200 # Not counted
+    assert client.get(video, headers={'Range': 'bytes=0-9'}).status_code == 206
+    response = client.get(video)
+    assert response.status_code == 429 and response.headers['Retry-After'] == '10'
+    assert 'learnai_video_rejected_requests_total 1' in client.get('/metrics').get_data(as_text=True)
+    client.get('/logout')
+
+def test_byte_rate_paces_the_body(client, new_user_id, video, admission):
+    clock = FakeClock()
+    limits = admission({'viewer': {'bytes_per_second': 64 * 1024, 'byte_burst': 64 * 1024}},
+                       clock=clock, sleep=clock.sleep)
+    login(client, 'test@example.com', 'password123')
+    response = client.get(video, buffered=True)
+    assert response.data == CONTENT
+    assert sum(clock.slept) == pytest.approx(3.0) # 256 KiB at 64 KiB/s after a 64 KiB burst
+    clock.advance = False
+    assert client.get(video, buffered=True).data == CONTENT # Now 256 KiB in debt
+    response = client.get(video, headers={'Range': 'bytes=0-9,-10'})
+    assert response.status_code == 429 and response.headers['Retry-After'] == '4'
+    clock.now += 10
+    ranges = client.get(video, headers={'Range': 'bytes=0-9,-10'}, buffered=True)
+    assert ranges.status_code == 206 and CONTENT[:10] in ranges.data
+    assert limits.active == 0
+    client.get('/logout')
+
+def test_stream_cap(client, new_user_id, video, admission):
+    limits = admission({}, max_streams=1, queue_timeout=0)
+    login(client, 'test@example.com', 'password123')
+    streaming = client.get(video, buffered=False)
+    assert limits.active == 1
+    response = client.get(video)
+    assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+    assert client.get(video, headers={'If-None-Match': streaming.headers['ETag']}).status_code == 429
+    streaming.close()
+    assert limits.active == 0
+    assert client.get(video, headers={'If-None-Match': streaming.headers['ETag']}).status_code == 304
+    assert client.get(video, buffered=True).status_code == 200 and limits.active == 0
+    client.get('/logout')
+
+def test_throttled_multipart_body_closed_unread_frees_its_slot(app, client, new_user_id, video, admission):
+    limits = admission({'viewer': {'bytes_per_second': 64 * 1024}}, max_streams=1, queue_timeout=0)
+    login(client, 'test@example.com', 'password123')
+    # Called directly: the test client would read the first block before handing the body over
+    environ = EnvironBuilder(path=video, headers={'Range': 'bytes=0-9,-10',
+                                                  'Cookie': f"session={client.get_cookie('session').value}"}).get_environ()
+    started = []
+    body = app(environ, lambda status, headers, exc_info=None: started.append(status))
+    assert started == ['206 PARTIAL CONTENT'] and limits.active == 1
+    body.close() # e.g. the client went away before the first block
+    assert limits.active == 0 and limits.reserve()
+    limits.release_reserved()
+    client.get('/logout')
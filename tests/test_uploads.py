@@ -0,0 +1,166 @@
+import io
+import os
+import pytest
+import storage
+from app import Video, UploadSession, db, get_blob_store
+from tests.conftest import login
+
+VIDEO_BYTES = b"0123456789" * 5 # 50 bytes -> chunks of 16, 16, 16, 2
+
+@pytest.fixture
+def small_chunks(app, monkeypatch):
+    monkeypatch.setattr(storage, 'HASH_BLOCK_SIZE', 8)
+    original = app.config['UPLOAD_CHUNK_SIZE']
+    app.config['UPLOAD_CHUNK_SIZE'] = 16
+    yield 16
+    app.config['UPLOAD_CHUNK_SIZE'] = original
+
+def init_upload(client, **overrides):
+    payload = dict(title='Chunked Lecture', description='Sent in pieces', filename='lecture.mp4', size=len(VIDEO_BYTES))
+    payload.update(overrides)
+    return client.post('/api/uploads', json=payload)
+
+def put_chunk(client, upload_id, index, chunk_size=16):
+    data = VIDEO_BYTES[index * chunk_size:(index + 1) * chunk_size]
+    return client.put(f'/api/uploads/{upload_id}/chunks/{index}', data=data,
+                      content_type='application/octet-stream')
+
+def test_chunked_upload_out_of_order_and_resume(client, app, editor_user_id, small_chunks):
+    login(client, 'editor@example.com', 'password123')
+    response = init_upload(client)
+    assert response.status_code == 201
+    upload = response.get_json()
+    upload_id = upload['upload_id']
+    assert upload['chunk_count'] == 4
+    assert upload['offset'] == 0
+
+    assert put_chunk(client, upload_id, 0).status_code == 200
+    assert put_chunk(client, upload_id, 2).status_code == 200
+    status = client.get(f'/api/uploads/{upload_id}').get_json()
+    assert status['received'] == [0, 2]
+    assert status['offset'] == 16 # Only chunk 0 is contiguous from the start
+
+    response = client.post(f'/api/uploads/{upload_id}/complete')
+    assert response.status_code == 409
+    assert response.get_json()['missing'] == [1, 3]
+
+    # Resume with the missing chunks, re-sending one that already arrived
+    for index in (1, 3, 2):
+        assert put_chunk(client, upload_id, index).status_code == 200
+    response = client.post(f'/api/uploads/{upload_id}/complete')
+    assert response.status_code == 201
+
+    with app.app_context():
+        video = db.session.get(Video, response.get_json()['video_id'])
+        assert video.title == 'Chunked Lecture'
+        assert video.user_id == editor_user_id
+        assert video.original_filename == 'lecture.mp4'
+        assert video.size == len(VIDEO_BYTES)
+        hasher = storage.BlockHasher()
+        hasher.update(VIDEO_BYTES)
+        assert video.digest == hasher.hexdigest() # Same digest as hashing the file in one pass
+        assert video.filename == f'{video.digest}.mp4'
+        assert db.session.get(UploadSession, upload_id) is None
+        path = os.path.join(app.config['UPLOAD_FOLDER'], video.filename)
+    with open(path, 'rb') as f:
+        assert f.read() == VIDEO_BYTES
+    os.remove(path)
+
+def test_racing_completes_create_one_video(client, app, editor_user_id, small_chunks, monkeypatch):
+    login(client, 'editor@example.com', 'password123')
+    store = get_blob_store()
+    put = store.put
+    for race in ('complete', 'abort'):
+        upload_id = init_upload(client).get_json()['upload_id']
+        for index in range(4):
+            put_chunk(client, upload_id, index)
+        other = []
+
+        def racing_put(temp_path, name):
+            monkeypatch.setattr(store, 'put', put)
+            if race == 'complete': # The other request gets the file first
+                other.append(client.post(f'/api/uploads/{upload_id}/complete'))
+                return put(temp_path, name)
+            new = put(temp_path, name) # The session is aborted just after our put
+            other.append(client.delete(f'/api/uploads/{upload_id}'))
+            return new
+        monkeypatch.setattr(store, 'put', racing_put)
+        response = client.post(f'/api/uploads/{upload_id}/complete')
+        assert response.status_code == 404 and response.get_json()['error'] == 'Unknown upload.'
+        assert other[0].status_code == (201 if race == 'complete' else 204)
+        assert client.post(f'/api/uploads/{upload_id}/complete').status_code == 404
+    db.session.expire_all()
+    assert Video.query.count() == 1 and UploadSession.query.count() == 0
+    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], Video.query.one().filename))
+
+def test_chunk_with_wrong_length_is_rejected(client, app, editor_user_id, small_chunks):
+    login(client, 'editor@example.com', 'password123')
+    upload_id = init_upload(client).get_json()['upload_id']
+    response = client.put(f'/api/uploads/{upload_id}/chunks/0', data=b"short",
+                          content_type='application/octet-stream')
+    assert response.status_code == 400
+    assert put_chunk(client, upload_id, 4).status_code == 416
+    assert client.delete(f'/api/uploads/{upload_id}').status_code == 204
+    assert client.get(f'/api/uploads/{upload_id}').status_code == 404
+
+def test_upload_init_validation(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    assert init_upload(client, title='').status_code == 400
+    response = init_upload(client, filename='notes.txt')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Videos only!'
+    assert init_upload(client, size=0).status_code == 400
+
+def test_non_editor_cannot_start_chunked_upload(client, app, new_user_id):
+    login(client, 'test@example.com', 'password123')
+    assert init_upload(client).status_code == 403
+
+def test_identical_uploads_share_one_blob(client, app, editor_user_id, small_chunks):
+    login(client, 'editor@example.com', 'password123')
+    for title in ('First Copy', 'Second Copy'):
+        data = {'title': title, 'video_file': (io.BytesIO(VIDEO_BYTES), 'lecture.mp4')}
+        response = client.post('/upload_video', data=data, content_type='multipart/form-data', follow_redirects=True)
+        assert b"Video uploaded successfully!" in response.data
+
+    upload_id = init_upload(client, filename='LECTURE.MP4').get_json()['upload_id']
+    for index in range(4):
+        put_chunk(client, upload_id, index)
+    client.post(f'/api/uploads/{upload_id}/complete')
+
+    with app.app_context():
+        videos = Video.query.all()
+        assert len(videos) == 3
+        assert len({video.filename for video in videos}) == 1
+        blob = videos[0].filename
+    folder = app.config['UPLOAD_FOLDER']
+    assert os.path.isfile(os.path.join(folder, blob))
+
+    response = client.get(f'/uploads/videos/{blob}')
+    assert response.data == VIDEO_BYTES
+    assert response.headers['ETag'] == f'"{blob.split(".")[0]}"'
+    assert 'immutable' in response.headers['Cache-Control']
+    os.remove(os.path.join(folder, blob))
+
+def test_migrate_blobs_command(client, app, editor_user_id):
+    folder = app.config['UPLOAD_FOLDER']
+    with open(os.path.join(folder, 'old_lecture.mp4'), 'wb') as f:
+        f.write(VIDEO_BYTES)
+    with app.app_context():
+        for title in ('Old Lecture', 'Old Lecture Again'):
+            db.session.add(Video(title=title, filename='old_lecture.mp4', user_id=editor_user_id))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['migrate-blobs'])
+    assert 'Migrated 2 videos' in result.output
+
+    with app.app_context():
+        videos = Video.query.all()
+        assert {video.original_filename for video in videos} == {'old_lecture.mp4'}
+        assert len({video.filename for video in videos}) == 1
+        blob = videos[0].filename
+        assert blob == f'{videos[0].digest}.mp4'
+        assert videos[0].size == len(VIDEO_BYTES)
+    assert not os.path.exists(os.path.join(folder, 'old_lecture.mp4'))
+    with open(os.path.join(folder, blob), 'rb') as f:
+        assert f.read() == VIDEO_BYTES
+    os.remove(os.path.join(folder, blob))
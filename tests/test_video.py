@@ -1,8 +1,10 @@
 import pytest
 from app import User, Video, db # Added User import
-from tests.conftest import login, logout
+from tests.conftest import login, logout, count_queries
 import io
 import os # Added os import
+import re
+import datetime
 
 # --- Video Upload Tests ---
 
@@ -60,7 +62,8 @@ def test_successful_video_upload_by_editor(client, app, editor_user_id):
         video = Video.query.filter_by(title='Editor Upload Test').first()
         assert video is not None
         assert video.description == 'A video uploaded by an editor.'
-        assert video.filename == 'cool_video.mp4' # Check if secure_filename worked as expected
+        assert video.original_filename == 'cool_video.mp4' # Check if secure_filename worked as expected
+        assert video.filename == f'{video.digest}.mp4' # Stored under its content address
         assert video.user_id == editor_user_id # Compare with ID
         # Check if file exists (optional, as we are mocking file saving here by not checking content)
         # For a real test, you might want to check os.path.exists(os.path.join(client.application.config['UPLOAD_FOLDER'], video.filename))
@@ -204,3 +207,116 @@ def test_video_file_serving_unauthorized(client, app, init_database, uploaded_vi
     assert redirected_response.status_code == 200
     assert b"<h2>Login</h2>" in redirected_response.data # More specific check for login page
     assert b"Please log in to access this page" in redirected_response.data # Flask-Login message
+
+def _write_upload(client, filename, content):
+    path = os.path.join(client.application.config['UPLOAD_FOLDER'], filename)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+def test_video_file_range_request(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    path = _write_upload(client, 'range.mp4', b"0123456789abcdef")
+
+    response = client.get('/uploads/videos/range.mp4', headers={'Range': 'bytes=2-5'})
+    assert response.status_code == 206
+    assert response.data == b"2345"
+    assert response.headers['Content-Range'] == 'bytes 2-5/16'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.mimetype == 'video/mp4'
+
+    response = client.get('/uploads/videos/range.mp4', headers={'Range': 'bytes=-3'})
+    assert response.status_code == 206
+    assert response.data == b"def"
+
+    response = client.get('/uploads/videos/range.mp4', headers={'Range': 'bytes=100-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */16'
+    os.remove(path)
+
+def test_video_file_multi_range_request(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    path = _write_upload(client, 'multi.mov', b"0123456789abcdef")
+
+    response = client.get('/uploads/videos/multi.mov', headers={'Range': 'bytes=0-1,10-11,1-2'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert b"Content-Type: video/quicktime" in response.data
+    assert b"Content-Range: bytes 0-2/16\r\n\r\n012\r\n" in response.data # Overlapping ranges are merged
+    assert b"Content-Range: bytes 10-11/16\r\n\r\nab\r\n" in response.data
+    os.remove(path)
+
+def test_video_file_conditional_get(client, app, editor_user_id):
+    login(client, 'editor@example.com', 'password123')
+    path = _write_upload(client, 'cond.mkv', b"some matroska bytes")
+
+    response = client.get('/uploads/videos/cond.mkv')
+    assert response.status_code == 200
+    assert response.mimetype == 'video/x-matroska'
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    assert client.get('/uploads/videos/cond.mkv', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/uploads/videos/cond.mkv', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    # A stale If-Range validator means the client gets the whole file back
+    response = client.get('/uploads/videos/cond.mkv', headers={'Range': 'bytes=0-3', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == b"some matroska bytes"
+    assert client.get('/uploads/videos/cond.mkv', headers={'Range': 'bytes=0-3', 'If-Range': etag}).status_code == 206
+    # If-Range uses strong comparison, so a weak validator never matches
+    response = client.get('/uploads/videos/cond.mkv', headers={'Range': 'bytes=0-3', 'If-Range': f'W/{etag}'})
+    assert response.status_code == 200
+    os.remove(path)
+
+def test_view_video_uses_extension_mime_type(client, app, editor_user_id):
+    with app.app_context():
+        video = Video(title='AVI Video', filename='clip.avi', user_id=editor_user_id)
+        db.session.add(video)
+        db.session.commit()
+        video_id = video.id
+    login(client, 'editor@example.com', 'password123')
+    response = client.get(f'/video/{video_id}')
+    assert b'type="video/x-msvideo"' in response.data
+
+# --- Video List Pagination Tests ---
+
+@pytest.fixture
+def many_videos(app, init_database):
+    with app.app_context():
+        uploaders = [User(username=f'uploader{i}', email=f'uploader{i}@example.com', password_hash='x', is_editor=True)
+                     for i in range(5)]
+        db.session.add_all(uploaders)
+        start = datetime.datetime(2024, 1, 1)
+        for i in range(25):
+            # Pairs of videos share a timestamp so the id tie-breaker is exercised
+            db.session.add(Video(title=f'Lecture {i:02d}', filename=f'{i}.mp4', uploader=uploaders[i % 5],
+                                 uploaded_at=start + datetime.timedelta(minutes=i // 2)))
+        db.session.commit()
+
+def test_video_list_keyset_pagination(client, app, new_user_id, many_videos):
+    login(client, 'test@example.com', 'password123')
+    seen = []
+    url = '/videos?per_page=10'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = re.findall(rb'Lecture (\d\d)', response.data)
+        assert len(page) <= 10
+        seen.extend(int(n) for n in page)
+        match = re.search(rb'href="(/videos\?after=[^"]+)"', response.data)
+        url = match.group(1).decode().replace('&amp;', '&') if match else None
+    assert seen == list(range(24, -1, -1)) # Newest first, every video exactly once
+
+def test_video_list_query_count_is_bounded(client, app, new_user_id, many_videos):
+    login(client, 'test@example.com', 'password123')
+    statements, stop = count_queries(app)
+    try:
+        response = client.get('/videos?per_page=25')
+    finally:
+        stop()
+    assert response.status_code == 200
+    assert response.data.count(b'Uploaded by: uploader') == 25
+    # One query for the logged-in user and one for the page with its uploaders, not one per video
+    assert len(statements) <= 2
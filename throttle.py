@@ -0,0 +1,200 @@
+"""Admission control for video delivery: per-user token buckets and a stream cap.
+
+Every user gets two token buckets, with rates set by their tier ('editor'
+or 'viewer'):
+
+- a request bucket, which each video request takes one token from;
+- a byte bucket, which every block of a response body is charged to as it
+  is read.
+
+A request is refused with ``Throttled`` while the user is out of request
+tokens or still in debt to their byte bucket. A response that runs the byte
+bucket into debt pauses until it is paid off. All of one user's parallel
+downloads share these buckets, so together they average at most the tier's
+rate. A charge is a lock, a clock read and a few float operations, cheap
+enough for every block.
+
+Separately, at most ``max_streams`` responses may be open at once across
+the process. A request past that waits up to ``queue_timeout`` seconds for
+one to finish, and is then refused too.
+
+Both waits block the calling thread. A server that waits in an event loop
+instead (``asgi.VideoStreamer``) takes a stream slot with ``reserve`` before
+calling the view and sets ``TICKET_ENVIRON`` in the WSGI environ to None; the
+view then admits with ``reserved=True`` and leaves its ticket there, marked
+``paced_by_server``, for the server to charge as it sends.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+MAX_TRACKED_USERS = 10000 # Past this, idle buckets are dropped, then the least recently used
+TICKET_ENVIRON = 'learnai.video_ticket'
+
+
+class Throttled(Exception):
+    """A video request refused for now; retry after ``retry_after`` seconds."""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    """``rate`` tokens a second, holding at most ``capacity``; charges may run it into debt."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount, now):
+        """Take ``amount`` tokens if there are enough; returns 0, or the seconds until there will be."""
+        self._refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def charge(self, amount, now):
+        """Take ``amount`` tokens regardless; returns the seconds until the bucket is out of debt."""
+        self._refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class Ticket:
+    """One admitted response: holds a stream slot until closed and meters its bytes."""
+
+    def __init__(self, admission, bytes_bucket):
+        self.admission = admission
+        self.bytes_bucket = bytes_bucket
+        self.paced_by_server = False # The server waits out each charge itself, without sleeping here
+        self._closed = False
+
+    @property
+    def metered(self):
+        return self.bytes_bucket is not None
+
+    @property
+    def meters_reads(self):
+        """Whether reading the body should charge (and sleep) as it goes."""
+        return self.metered and not self.paced_by_server
+
+    def charge(self, count):
+        """Charge ``count`` bytes sent; returns the seconds to wait before sending more.
+
+        The wait is slept here unless ``paced_by_server`` is set.
+        """
+        delay = self.admission._charge(self.bytes_bucket, count)
+        if delay > 0 and not self.paced_by_server:
+            self.admission.sleep(delay)
+        return delay
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.admission._release()
+
+
+class Admission:
+    def __init__(self, tiers, max_streams=None, queue_timeout=0, clock=time.monotonic, sleep=time.sleep):
+        """``tiers`` maps a tier name to its limits: ``requests_per_second``,
+        ``request_burst``, ``bytes_per_second`` and ``byte_burst``. A missing
+        tier or rate means no limit."""
+        self.tiers = tiers
+        self.max_streams = max_streams
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self._slots = threading.Semaphore(max_streams) if max_streams else None
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # user id -> (tier, request bucket, byte bucket), least recently used first
+        self.active = 0
+        self.rejected = {'requests': 0, 'bytes': 0, 'streams': 0}
+
+    def _user_buckets(self, user_id, tier, now):
+        entry = self._buckets.get(user_id)
+        if entry is not None:
+            self._buckets.move_to_end(user_id)
+        if entry is None or entry[0] != tier:
+            if len(self._buckets) >= MAX_TRACKED_USERS:
+                self._prune(now)
+            limits = self.tiers.get(tier) or {}
+            requests = limits.get('requests_per_second')
+            data = limits.get('bytes_per_second')
+            entry = (tier,
+                     TokenBucket(requests, limits.get('request_burst'), now) if requests else None,
+                     TokenBucket(data, limits.get('byte_burst'), now) if data else None)
+            self._buckets[user_id] = entry
+        return entry[1], entry[2]
+
+    def _prune(self, now):
+        # A full bucket holds nothing a fresh one would not
+        for user_id, (_, requests, data) in list(self._buckets.items()):
+            if (requests is None or requests.full(now)) and (data is None or data.full(now)):
+                del self._buckets[user_id]
+        # Everyone is busy; forgetting the least recently seen hands them a fresh
+        # allowance, but memory stays bounded. Down to 90% so this is not run per new user.
+        while len(self._buckets) > MAX_TRACKED_USERS * 9 // 10:
+            self._buckets.popitem(last=False)
+
+    def reserve(self):
+        """Take a stream slot if one is free, without waiting; returns whether one was taken.
+
+        Pass ``reserved=True`` to ``admit`` to hand the slot to the ticket, or
+        give it back with ``release_reserved`` if ``admit`` is never reached or refuses.
+        """
+        return self._slots is None or self._slots.acquire(blocking=False)
+
+    def release_reserved(self):
+        if self._slots is not None:
+            self._slots.release()
+
+    def refuse_stream(self):
+        """Count a request whose caller gave up waiting for a ``reserve``."""
+        with self._lock:
+            self.rejected['streams'] += 1
+
+    def admit(self, user_id, tier, reserved=False):
+        """Admit one response for ``user_id``; returns a ``Ticket`` to close when it ends, or raises ``Throttled``.
+
+        With ``reserved``, the caller already holds a stream slot from ``reserve``.
+        """
+        with self._lock:
+            now = self.clock()
+            requests, data = self._user_buckets(user_id, tier, now)
+            wait = data.charge(0, now) if data is not None else 0.0
+            if wait:
+                self.rejected['bytes'] += 1
+                raise Throttled(wait, 'bytes')
+            wait = requests.take(1, now) if requests is not None else 0.0
+            if wait:
+                self.rejected['requests'] += 1
+                raise Throttled(wait, 'requests')
+        if not reserved and self._slots is not None and not self._slots.acquire(timeout=self.queue_timeout):
+            self.refuse_stream()
+            raise Throttled(1, 'streams')
+        with self._lock:
+            self.active += 1
+        return Ticket(self, data)
+
+    def _charge(self, bucket, count):
+        with self._lock:
+            return bucket.charge(count, self.clock())
+
+    def _release(self):
+        with self._lock:
+            self.active -= 1
+        if self._slots is not None:
+            self._slots.release()
@@ -0,0 +1,63 @@
+"""Disk side of the resumable upload API: partial files and chunk bookkeeping."""
+import os
+
+BLOCK_SIZE = 64 * 1024
+
+
+class IncompleteChunk(Exception):
+    """The client disconnected before sending the whole chunk."""
+
+
+def partial_path(folder, upload_id):
+    return os.path.join(folder, f'{upload_id}.part')
+
+
+def create_partial(path, size):
+    # Reserve the final size up front; chunks then land at their own offsets
+    # in any order and the file stays sparse until they arrive.
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def write_chunk(path, offset, stream, length, hasher=None, block_size=BLOCK_SIZE):
+    """Copy ``length`` bytes from ``stream`` into ``path`` starting at ``offset``.
+
+    Only one block is held in memory at a time, whatever the chunk size.
+    Each block is also fed to ``hasher`` when one is given.
+    """
+    remaining = length
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        while remaining:
+            block = stream.read(min(block_size, remaining))
+            if not block:
+                raise IncompleteChunk()
+            if hasher is not None:
+                hasher.update(block)
+            f.write(block)
+            remaining -= len(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def aligned_chunk_size(chunk_size, hash_block_size):
+    # Chunks must start on hash block boundaries so each one can be hashed
+    # on its own as it streams in.
+    return max(1, -(-chunk_size // hash_block_size)) * hash_block_size
+
+
+def chunk_count(total_size, chunk_size):
+    return max(1, -(-total_size // chunk_size))
+
+
+def chunk_length(index, total_size, chunk_size):
+    return min(chunk_size, total_size - index * chunk_size)
+
+
+def contiguous_offset(received, total_size, chunk_size):
+    """Number of bytes from the start of the file that have all arrived."""
+    received = set(received)
+    index = 0
+    while index in received:
+        index += 1
+    return min(index * chunk_size, total_size)